@@ -5,12 +5,20 @@
 # source: https://github.com/chris-siedell/PyCrow
 
 
+import json
+import struct
 import time
 import crow.utils
+import crow.details
 import crow.errors
 import crow.host
 
 
+# The fixed part of the get_device_info response (after the header): crow_version,
+#  crow_admin_version, max_command_size, max_response_size.
+_DEVICE_INFO_HEADER = struct.Struct('>BBHH')
+
+
 class CrowAdmin():
 
 
@@ -29,46 +37,163 @@ class CrowAdmin():
 
     def ping(self, address=None, port=None):
         """Returns the time, in seconds, taken to perform a successful ping."""
-        start = time.perf_counter()
+        clock = self.host.serial_port.clock
+        start = clock()
         transaction = self._send_command(address, port, None)
-        CrowAdmin.validate_ping(transaction)
-        return time.perf_counter() - start
+        try:
+            CrowAdmin.validate_ping(transaction)
+        finally:
+            self.host.release_transaction(transaction)
+        return clock() - start
 
 
     def echo(self, data=None, address=None, port=None):
         """Sends an echo command. Returns nothing. Raises an error if the echo fails."""
         transaction = self._send_command(address, port, 0, data)
-        CrowAdmin.validate_echo(transaction)
+        try:
+            CrowAdmin.validate_echo(transaction)
+        finally:
+            self.host.release_transaction(transaction)
 
 
     def host_presence(self, data=None, address=None, port=None):
         """Sends a host presence packet. Returns nothing since there is no response."""
-        self._send_command(address, port, 0, data, response_expected=False)
+        transaction = self._send_command(address, port, 0, data, response_expected=False)
+        self.host.release_transaction(transaction)
 
 
     def get_device_info(self, address=None, port=None):
         """Returns a dictionary with information about the device."""
-        transaction = self._send_command(address, port, 1)
-        return CrowAdmin.parse_get_device_info(transaction)
+        transaction = self._send_command(address, port, 1, cacheable=True)
+        try:
+            return CrowAdmin.parse_get_device_info(transaction)
+        finally:
+            self.host.release_transaction(transaction)
 
 
     def get_open_ports(self, address=None, port=None):
         """Returns a list of open ports on the device."""
-        transaction = self._send_command(address, port, 2)
-        return CrowAdmin.parse_get_open_ports(transaction)
+        transaction = self._send_command(address, port, 2, cacheable=True)
+        try:
+            return CrowAdmin.parse_get_open_ports(transaction)
+        finally:
+            self.host.release_transaction(transaction)
 
 
     def get_port_info(self, query_port, address=None, admin_port=None):
         """Returns a dictionary with information about the given port."""
         if query_port < 0 or query_port > 255:
             raise ValueError("query_port must be 0 to 255.")
-        transaction = self._send_command(address, admin_port, 3, query_port.to_bytes(1, 'big'))
-        return CrowAdmin.parse_get_port_info(transaction)
+        transaction = self._send_command(address, admin_port, 3, query_port.to_bytes(1, 'big'), cacheable=True)
+        try:
+            return CrowAdmin.parse_get_port_info(transaction)
+        finally:
+            self.host.release_transaction(transaction)
+
+
+    def survey(self, addresses=None, port=None, discovery_timeout=0.02, previous=None):
+        """Discovers the devices on the bus. Returns a BusSnapshot."""
+        # Each address (1 to 31 by default) is pinged on the admin port (port, or the default
+        #  port) with a short discovery_timeout instead of the transaction timeout, so absent
+        #  devices are cheap. The devices that respond are asked for their device info and
+        #  open ports, and then for the info of each open port.
+        # previous is an optional earlier BusSnapshot to refresh. A device found at the same
+        #  address in previous whose open ports have not changed keeps its previous record,
+        #  so only new or changed devices are queried in full.
+        if port is None:
+            port = self.default_port
+        snapshot = BusSnapshot(self.host.serial_port_name, port)
+        for address in CrowAdmin._survey_addresses(addresses):
+            try:
+                ping_time = self._survey_ping(address, port, discovery_timeout)
+            except crow.errors.NoResponseError as e:
+                if e.cause == 'silence':
+                    continue
+                # Something responded, but not intelligibly (e.g. two devices with the same
+                #  address, or the wrong baudrate).
+                snapshot.devices[address] = DeviceRecord(address, error=str(e))
+                continue
+            except crow.errors.CrowError as e:
+                snapshot.devices[address] = DeviceRecord(address, error=str(e))
+                continue
+            cache = self.host.serial_port.response_cache
+            if cache is not None:
+                # The survey should see the device's current state.
+                cache.invalidate(address, port)
+            record = None
+            if previous is not None:
+                record = self._survey_reuse(previous.devices.get(address), port)
+            if record is None:
+                record = self._survey_device(address, port)
+            record.ping_time = ping_time
+            snapshot.devices[address] = record
+        return snapshot
+
+
+    @staticmethod
+    def _survey_addresses(addresses):
+        if addresses is None:
+            return range(1, 32)
+        for address in addresses:
+            if address < 1 or address > 31:
+                raise ValueError("The addresses to survey must be 1 to 31.")
+        return addresses
+
+
+    def _survey_ping(self, address, port, discovery_timeout):
+        # Pings the address, returning the time taken. Discovery pings are not retried.
+        clock = self.host.serial_port.clock
+        start = clock()
+        transaction = self._send_command(address, port, None, idempotent=False, timeout=discovery_timeout)
+        try:
+            CrowAdmin.validate_ping(transaction)
+        finally:
+            self.host.release_transaction(transaction)
+        return clock() - start
+
+
+    def _survey_reuse(self, record, port):
+        # Returns a copy of the previous record for the device if its open ports are
+        #  unchanged, or None if the device needs to be queried in full.
+        if record is None or record.error is not None:
+            return None
+        try:
+            open_ports = self.get_open_ports(record.address, port)
+        except crow.errors.CrowError:
+            return None
+        if open_ports != record.open_ports:
+            return None
+        return DeviceRecord.from_dict(record.to_dict())
+
+
+    def _survey_device(self, address, port):
+        # Queries a device that responded to a discovery ping.
+        record = DeviceRecord(address)
+        try:
+            record.info = self.get_device_info(address, port)
+            record.open_ports = self.get_open_ports(address, port)
+            for open_port in record.open_ports:
+                record.ports[open_port] = self.get_port_info(open_port, address, port)
+        except crow.errors.CrowError as e:
+            record.error = str(e)
+        return record
 
 
-    def _send_command(self, address, port, command_code, data=None, response_expected=True):
+    def _send_command(self, address, port, command_code, data=None, response_expected=True, idempotent=True, timeout=None, cacheable=False):
         # A helper method for sending CrowAdmin commands.
         # data, if not None, is appended to the command payload after the third byte.
+        # The CrowAdmin commands are idempotent, so the host's retry policy applies to them.
+        # timeout and cacheable are passed to send_command. The get_* commands are read-only,
+        #  so they are cacheable (they use the serial port's response cache, if it has one).
+        address, port, command = self._make_command(address, port, command_code, data, response_expected)
+        transaction = self.host.send_command(address=address, port=port, payload=command, response_expected=response_expected, idempotent=idempotent, timeout=timeout, cacheable=cacheable)
+        transaction.command_code = command_code
+        return transaction
+
+
+    def _make_command(self, address, port, command_code, data=None, response_expected=True):
+        # Validates the arguments for a CrowAdmin command and returns the tuple
+        #  (address, port, command), with defaults applied and the command payload composed.
         
         if address is None:
             address = self.default_address
@@ -96,9 +221,7 @@ class CrowAdmin():
             # ping
             command = None
 
-        transaction = self.host.send_command(address=address, port=port, payload=command, response_expected=response_expected)
-        transaction.command_code = command_code
-        return transaction
+        return address, port, command
 
 
     # The following validate_* and parse_* methods raise CrowAdminError on failure.
@@ -152,25 +275,12 @@ class CrowAdmin():
         if len(rsp) < 9:
             raise CrowAdminError(transaction, "The get_device_info response has less than nine bytes.")
         info = {}
-        info['crow_version'] = rsp[3]
-        info['crow_admin_version'] = rsp[4]
-        info['max_command_size'] = int.from_bytes(rsp[5:7], 'big')
-        info['max_response_size'] = int.from_bytes(rsp[7:9], 'big')
+        info['crow_version'], info['crow_admin_version'], info['max_command_size'], info['max_response_size'] = _DEVICE_INFO_HEADER.unpack_from(rsp, 3)
         if len(rsp) == 9:
             return info
-        details = rsp[9]
-        transaction.arg_index = 10
         try:
-            # unpack_ascii will raise RuntimeError on failure
-            rsp_name = 'get_device_info'
-            if details & 1:
-                crow.utils.unpack_ascii(info, transaction, 3, 'impl_identifier', rsp_name)
-            if details & 2:
-                crow.utils.unpack_ascii(info, transaction, 3, 'impl_description', rsp_name)
-            if details & 4:
-                crow.utils.unpack_ascii(info, transaction, 3, 'device_identifier', rsp_name)
-            if details & 8:
-                crow.utils.unpack_ascii(info, transaction, 3, 'device_description', rsp_name)
+            # decode will raise RuntimeError on failure
+            crow.details.DEVICE_INFO_DETAILS.decode(rsp, 10, rsp[9], info, 'get_device_info')
         except RuntimeError as e:
             raise CrowAdminError(transaction, str(e))
         return info
@@ -205,21 +315,99 @@ class CrowAdmin():
         if len(rsp) < 4:
             raise CrowAdminError(transaction, "The get_port_info response has less than four bytes.")
         details = rsp[3]
-        transaction.arg_index = 4
         info = {}
         info['is_open'] = bool(details & 1)
         try:
-            # unpack_ascii will raise RuntimeError on failure
-            rsp_name = 'get_port_info'
-            if details & 2:
-                crow.utils.unpack_ascii(info, transaction, 3, 'service_identifier', rsp_name)
-            if details & 4:
-                crow.utils.unpack_ascii(info, transaction, 3, 'service_description', rsp_name)
+            # decode will raise RuntimeError on failure
+            crow.details.PORT_INFO_DETAILS.decode(rsp, 4, details, info, 'get_port_info')
         except RuntimeError as e:
             raise CrowAdminError(transaction, str(e))
         return info
 
 
+class BusSnapshot:
+
+    # A BusSnapshot is the result of CrowAdmin.survey: the devices found on a serial port,
+    #  as a dictionary of address -> DeviceRecord. It can be saved as JSON (save, to_dict)
+    #  and loaded again (load, from_dict), and given to survey as previous to refresh it.
+
+    def __init__(self, serial_port_name=None, admin_port=0, timestamp=None):
+        self.serial_port_name = serial_port_name
+        self.admin_port = admin_port
+        # The wall clock time of the survey (seconds since the epoch).
+        self.timestamp = timestamp if timestamp is not None else time.time()
+        self.devices = {}
+
+    def __repr__(self):
+        return "<{0} instance at {1:#x}, serial_port_name={2}, addresses={3}>".format(self.__class__.__name__, id(self), self.serial_port_name, sorted(self.devices))
+
+    def to_dict(self):
+        return {
+            'serial_port_name': self.serial_port_name,
+            'admin_port': self.admin_port,
+            'timestamp': self.timestamp,
+            'devices': [self.devices[address].to_dict() for address in sorted(self.devices)],
+        }
+
+    @staticmethod
+    def from_dict(d):
+        snapshot = BusSnapshot(d.get('serial_port_name'), d.get('admin_port', 0), d.get('timestamp'))
+        for item in d.get('devices', []):
+            record = DeviceRecord.from_dict(item)
+            snapshot.devices[record.address] = record
+        return snapshot
+
+    def save(self, path):
+        """Saves the snapshot to a JSON file."""
+        with open(path, 'w') as f:
+            json.dump(self.to_dict(), f, indent=2, sort_keys=True)
+            f.write('\n')
+
+    @staticmethod
+    def load(path):
+        """Loads a snapshot saved with save."""
+        with open(path) as f:
+            return BusSnapshot.from_dict(json.load(f))
+
+
+class DeviceRecord:
+
+    # What survey learned about the device at an address:
+    #   info - the get_device_info dictionary
+    #   open_ports - the list of open ports
+    #   ports - a dictionary of port -> get_port_info dictionary, for the open ports
+    #   ping_time - the time taken by the discovery ping, in seconds
+    #   error - if not None, a description of the error that prevented the device from being
+    #    queried (the other properties may then be incomplete)
+
+    def __init__(self, address, info=None, open_ports=None, ports=None, ping_time=None, error=None):
+        self.address = address
+        self.info = info if info is not None else {}
+        self.open_ports = open_ports if open_ports is not None else []
+        self.ports = ports if ports is not None else {}
+        self.ping_time = ping_time
+        self.error = error
+
+    def __repr__(self):
+        return "<{0} instance at {1:#x}, address={2}, open_ports={3}, error={4}>".format(self.__class__.__name__, id(self), self.address, self.open_ports, self.error)
+
+    def to_dict(self):
+        return {
+            'address': self.address,
+            'info': dict(self.info),
+            'open_ports': list(self.open_ports),
+            # JSON object keys are strings
+            'ports': {str(port): dict(info) for port, info in self.ports.items()},
+            'ping_time': self.ping_time,
+            'error': self.error,
+        }
+
+    @staticmethod
+    def from_dict(d):
+        ports = {int(port): dict(info) for port, info in d.get('ports', {}).items()}
+        return DeviceRecord(d['address'], dict(d.get('info', {})), list(d.get('open_ports', [])), ports, d.get('ping_time'), d.get('error'))
+
+
 class CrowAdminError(crow.errors.ClientError):
     def __init__(self, transaction, message):
         super().__init__(transaction.address, transaction.port, message)
@@ -0,0 +1,152 @@
+# admin_async.py
+# CrowAdmin Client for asyncio
+# project: https://pypi.org/project/crow-serial/
+# source: https://github.com/chris-siedell/PyCrow
+# homepage: http://siedell.com/projects/Crow/
+
+
+import crow.admin
+import crow.errors
+import crow.host_async
+
+
+class AsyncCrowAdmin(crow.admin.CrowAdmin):
+
+    # AsyncCrowAdmin is the asyncio counterpart of CrowAdmin. It uses an AsyncHost, and
+    #  its command methods (and survey) are coroutines. The arguments, return values, and
+    #  errors are the same as for CrowAdmin.
+
+    def __init__(self, serial_port_name, default_address=1, default_port=0):
+        self.host = crow.host_async.AsyncHost(serial_port_name)
+        self.default_address = default_address
+        self.default_port = default_port
+
+
+    async def ping(self, address=None, port=None):
+        """Returns the time, in seconds, taken to perform a successful ping."""
+        clock = self.host.serial_port.clock
+        start = clock()
+        transaction = await self._send_command(address, port, None)
+        try:
+            AsyncCrowAdmin.validate_ping(transaction)
+        finally:
+            self.host.release_transaction(transaction)
+        return clock() - start
+
+
+    async def echo(self, data=None, address=None, port=None):
+        """Sends an echo command. Returns nothing. Raises an error if the echo fails."""
+        transaction = await self._send_command(address, port, 0, data)
+        try:
+            AsyncCrowAdmin.validate_echo(transaction)
+        finally:
+            self.host.release_transaction(transaction)
+
+
+    async def host_presence(self, data=None, address=None, port=None):
+        """Sends a host presence packet. Returns nothing since there is no response."""
+        transaction = await self._send_command(address, port, 0, data, response_expected=False)
+        self.host.release_transaction(transaction)
+
+
+    async def get_device_info(self, address=None, port=None):
+        """Returns a dictionary with information about the device."""
+        transaction = await self._send_command(address, port, 1, cacheable=True)
+        try:
+            return AsyncCrowAdmin.parse_get_device_info(transaction)
+        finally:
+            self.host.release_transaction(transaction)
+
+
+    async def get_open_ports(self, address=None, port=None):
+        """Returns a list of open ports on the device."""
+        transaction = await self._send_command(address, port, 2, cacheable=True)
+        try:
+            return AsyncCrowAdmin.parse_get_open_ports(transaction)
+        finally:
+            self.host.release_transaction(transaction)
+
+
+    async def get_port_info(self, query_port, address=None, admin_port=None):
+        """Returns a dictionary with information about the given port."""
+        if query_port < 0 or query_port > 255:
+            raise ValueError("query_port must be 0 to 255.")
+        transaction = await self._send_command(address, admin_port, 3, query_port.to_bytes(1, 'big'), cacheable=True)
+        try:
+            return AsyncCrowAdmin.parse_get_port_info(transaction)
+        finally:
+            self.host.release_transaction(transaction)
+
+
+    async def survey(self, addresses=None, port=None, discovery_timeout=0.02, previous=None):
+        """Discovers the devices on the bus. Returns a BusSnapshot."""
+        if port is None:
+            port = self.default_port
+        snapshot = crow.admin.BusSnapshot(self.host.serial_port_name, port)
+        for address in AsyncCrowAdmin._survey_addresses(addresses):
+            try:
+                ping_time = await self._survey_ping(address, port, discovery_timeout)
+            except crow.errors.NoResponseError as e:
+                if e.cause == 'silence':
+                    continue
+                snapshot.devices[address] = crow.admin.DeviceRecord(address, error=str(e))
+                continue
+            except crow.errors.CrowError as e:
+                snapshot.devices[address] = crow.admin.DeviceRecord(address, error=str(e))
+                continue
+            cache = self.host.serial_port.response_cache
+            if cache is not None:
+                # The survey should see the device's current state.
+                cache.invalidate(address, port)
+            record = None
+            if previous is not None:
+                record = await self._survey_reuse(previous.devices.get(address), port)
+            if record is None:
+                record = await self._survey_device(address, port)
+            record.ping_time = ping_time
+            snapshot.devices[address] = record
+        return snapshot
+
+
+    async def _survey_ping(self, address, port, discovery_timeout):
+        clock = self.host.serial_port.clock
+        start = clock()
+        transaction = await self._send_command(address, port, None, idempotent=False, timeout=discovery_timeout)
+        try:
+            AsyncCrowAdmin.validate_ping(transaction)
+        finally:
+            self.host.release_transaction(transaction)
+        return clock() - start
+
+
+    async def _survey_reuse(self, record, port):
+        if record is None or record.error is not None:
+            return None
+        try:
+            open_ports = await self.get_open_ports(record.address, port)
+        except crow.errors.CrowError:
+            return None
+        if open_ports != record.open_ports:
+            return None
+        return crow.admin.DeviceRecord.from_dict(record.to_dict())
+
+
+    async def _survey_device(self, address, port):
+        record = crow.admin.DeviceRecord(address)
+        try:
+            record.info = await self.get_device_info(address, port)
+            record.open_ports = await self.get_open_ports(address, port)
+            for open_port in record.open_ports:
+                record.ports[open_port] = await self.get_port_info(open_port, address, port)
+        except crow.errors.CrowError as e:
+            record.error = str(e)
+        return record
+
+
+    async def _send_command(self, address, port, command_code, data=None, response_expected=True, idempotent=True, timeout=None, cacheable=False):
+        # The coroutine counterpart of CrowAdmin._send_command.
+        address, port, command = self._make_command(address, port, command_code, data, response_expected)
+        transaction = await self.host.send_command(address=address, port=port, payload=command, response_expected=response_expected, idempotent=idempotent, timeout=timeout, cacheable=cacheable)
+        transaction.command_code = command_code
+        return transaction
+
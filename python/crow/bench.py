@@ -0,0 +1,271 @@
+# bench.py
+# Crow End-to-End Benchmarks
+# project: https://pypi.org/project/crow-serial/
+# source: https://github.com/chris-siedell/PyCrow
+# homepage: http://siedell.com/projects/Crow/
+
+
+import math
+import os
+import platform
+import threading
+import time
+import crow
+import crow.admin
+import crow.device
+import crow.errors
+import crow.host
+import crow.simulator
+
+
+# This module measures what the host achieves end-to-end. It sweeps payload sizes, baud
+#  rates, propcr_order, and response_expected through Host.send_command (using an echo
+#  service), and also times the CrowAdmin commands. It is run by the `crow bench` command
+#  (see crow.cli).
+#
+# The targets:
+#   sim  - a device on a VirtualBus (crow.simulator). Latencies are measured on the bus's
+#          virtual clock, so they reflect the modeled wire time and are deterministic. CPU
+#          time includes the simulated device.
+#   pty  - a device (crow.device) served on the master side of a pseudo-terminal, in a
+#          thread of this process. Baud rates have no effect on a pty.
+#   port - a real serial port. The device must have an echo service (e.g. Test_Echo on
+#          port 16) and must use the byte order given by propcr_order.
+#
+# Results are a JSON-serializable dictionary:
+#   {'crow_version', 'python', 'platform', 'target', 'address', 'service_port',
+#    'cases': [{'payload_size', 'baudrate', 'propcr_order', 'response_expected',
+#               'transactions', 'errors', 'elapsed', 'transactions_per_second',
+#               'latency_mean', 'latency_p50', 'latency_p99', 'wire_time',
+#               'bus_utilization', 'cpu_per_transaction'}, ...],
+#    'admin': {<command>: {'transactions', 'errors', 'latency_mean', 'latency_p50', 'latency_p99'}}}
+# Times are in seconds. wire_time is the theoretical time to send the command and response
+#  packets at the baud rate, and bus_utilization is wire_time divided by the mean latency.
+
+
+DEFAULT_PAYLOAD_SIZES = (0, 1, 16, 128, 512, 2047)
+DEFAULT_BAUDRATES = (115200,)
+
+
+def packet_sizes(payload_size):
+    """Returns the sizes of the command and response packets for the given payload size."""
+    remainder = payload_size%128
+    body_size = (payload_size//128)*130 + ((remainder + 2) if (remainder > 0) else 0)
+    return 7 + body_size, 5 + body_size
+
+
+def percentile(sorted_values, fraction):
+    # Nearest-rank percentile of an already sorted list.
+    if len(sorted_values) == 0:
+        return None
+    ind = min(len(sorted_values) - 1, max(0, math.ceil(fraction*len(sorted_values)) - 1))
+    return sorted_values[ind]
+
+
+class PtyStandIn:
+
+    # PtyStandIn serves a crow.device.Device on the master side of a pseudo-terminal, so
+    #  that hosts can use the slave side (name) as if it were a serial port. It requires a
+    #  POSIX system (tty and select are imported here so the module loads elsewhere).
+
+    def __init__(self, device):
+        import tty
+        self.device = device
+        self._master, self._slave = os.openpty()
+        tty.setraw(self._master)
+        tty.setraw(self._slave)
+        self.name = os.ttyname(self._slave)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
+        os.close(self._master)
+        os.close(self._slave)
+
+    def _write(self, data):
+        while len(data) > 0:
+            num = os.write(self._master, data)
+            data = data[num:]
+
+    def _run(self):
+        import select
+        fd = self._master
+        while not self._stop.is_set():
+            readable, _, _ = select.select([fd], [], [], 0.1)
+            if len(readable) > 0:
+                self.device.process(os.read(fd, 4096), self._write)
+
+
+class Benchmark:
+
+    # A Benchmark runs the sweeps against one target. For the sim and pty targets the
+    #  benchmark creates the device (an echo service on service_port, at address), and
+    #  close must be called when done.
+
+    def __init__(self, target='sim', serial_port_name=None, address=1, service_port=16, processing_delay=0.0):
+        if target not in ('sim', 'pty', 'port'):
+            raise ValueError("target must be 'sim', 'pty', or 'port'.")
+        if target == 'pty' and os.name != 'posix':
+            raise ValueError("The pty target requires a POSIX system.")
+        self.target = target
+        self.address = address
+        self.service_port = service_port
+        self.device = None
+        self._bus = None
+        self._stand_in = None
+        if target == 'port':
+            if serial_port_name is None:
+                raise ValueError("A serial port name is required for the port target.")
+        else:
+            if target == 'sim':
+                self.device = crow.simulator.VirtualDevice(address, processing_delay=processing_delay)
+                self._bus = crow.simulator.VirtualBus()
+                self._bus.add_device(self.device)
+                serial_port_name = 'sim://bench-{0:x}'.format(id(self))
+                self._bus.attach(serial_port_name)
+            else:
+                self.device = crow.device.Device(address)
+                self._stand_in = PtyStandIn(self.device)
+                serial_port_name = self._stand_in.name
+            self.device.add_service(service_port, crow.device.EchoService())
+        self.serial_port_name = serial_port_name
+        self.host = crow.host.Host(serial_port_name)
+        self.admin = crow.admin.CrowAdmin(serial_port_name, default_address=address)
+
+    def close(self):
+        if self._bus is not None:
+            self._bus.detach()
+        if self._stand_in is not None:
+            self._stand_in.close()
+
+    def run(self, payload_sizes=DEFAULT_PAYLOAD_SIZES, baudrates=DEFAULT_BAUDRATES, propcr_orders=(False, True),
+            response_expected=(True, False), count=200, warmup=10, progress=None):
+        """Runs all the sweeps. Returns the results dictionary."""
+        results = {
+            'crow_version': crow.__version__,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'target': self.target,
+            'address': self.address,
+            'service_port': self.service_port,
+            'cases': [],
+            'admin': None,
+        }
+        for baudrate in baudrates:
+            for propcr_order in propcr_orders:
+                for rsp_expected in response_expected:
+                    for size in payload_sizes:
+                        case = self.run_case(size, baudrate, propcr_order, rsp_expected, count, warmup)
+                        results['cases'].append(case)
+                        if progress is not None:
+                            progress(case)
+        results['admin'] = self.run_admin(baudrates[0], count, warmup)
+        return results
+
+    def run_case(self, payload_size, baudrate, propcr_order, response_expected, count=200, warmup=10):
+        """Times count echo transactions with the given settings. Returns a dictionary."""
+        host = self.host
+        sp = host.serial_port
+        ser = sp.serial
+        clock = sp.clock
+        address = self.address
+        port = self.service_port
+        sp.set_baudrate(address, baudrate)
+        sp.set_propcr_order(address, propcr_order)
+        if self.device is not None:
+            self.device.propcr_order = propcr_order
+        payload = bytes(i%256 for i in range(payload_size))
+
+        latencies = []
+        errors = 0
+        start = clock()
+        cpu_start = time.process_time()
+        for i in range(warmup + count):
+            if i == warmup:
+                start = clock()
+                cpu_start = time.process_time()
+            t0 = clock()
+            try:
+                t = host.send_command(address, port, payload, response_expected)
+                if not response_expected:
+                    # There is no response to wait for, so the transaction is over when the
+                    #  command has been sent.
+                    ser.flush()
+                host.release_transaction(t)
+            except crow.errors.CrowError:
+                if i >= warmup:
+                    errors += 1
+                continue
+            if i >= warmup:
+                latencies.append(clock() - t0)
+        elapsed = clock() - start
+        cpu = time.process_time() - cpu_start
+
+        cmd_size, rsp_size = packet_sizes(payload_size)
+        if not response_expected:
+            rsp_size = 0
+        wire_time = (cmd_size + rsp_size)*crow.host.Host._seconds_per_byte(ser, baudrate)
+        case = {
+            'payload_size': payload_size,
+            'baudrate': baudrate,
+            'propcr_order': propcr_order,
+            'response_expected': response_expected,
+            'transactions': len(latencies),
+            'errors': errors,
+            'elapsed': elapsed,
+            'transactions_per_second': len(latencies)/elapsed if elapsed > 0 else None,
+            'wire_time': wire_time,
+            'cpu_per_transaction': cpu/count if count > 0 else None,
+        }
+        case.update(Benchmark._latency_stats(latencies))
+        mean = case['latency_mean']
+        case['bus_utilization'] = wire_time/mean if mean else None
+        return case
+
+    def run_admin(self, baudrate, count=200, warmup=10):
+        """Times the CrowAdmin commands. Returns a dictionary keyed by command name."""
+        admin = self.admin
+        sp = admin.host.serial_port
+        sp.set_baudrate(self.address, baudrate)
+        sp.set_propcr_order(self.address, False)
+        if self.device is not None:
+            self.device.propcr_order = False
+        clock = sp.clock
+        commands = {
+            'ping': admin.ping,
+            'echo': lambda: admin.echo(b'bench'),
+            'get_device_info': admin.get_device_info,
+            'get_open_ports': admin.get_open_ports,
+            'get_port_info': lambda: admin.get_port_info(self.service_port),
+        }
+        results = {}
+        for name, command in commands.items():
+            latencies = []
+            errors = 0
+            for i in range(warmup + count):
+                t0 = clock()
+                try:
+                    command()
+                except crow.errors.CrowError:
+                    if i >= warmup:
+                        errors += 1
+                    continue
+                if i >= warmup:
+                    latencies.append(clock() - t0)
+            result = {'transactions': len(latencies), 'errors': errors}
+            result.update(Benchmark._latency_stats(latencies))
+            results[name] = result
+        return results
+
+    @staticmethod
+    def _latency_stats(latencies):
+        latencies = sorted(latencies)
+        return {
+            'latency_mean': sum(latencies)/len(latencies) if len(latencies) > 0 else None,
+            'latency_p50': percentile(latencies, 0.50),
+            'latency_p99': percentile(latencies, 0.99),
+        }
+
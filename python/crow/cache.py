@@ -0,0 +1,253 @@
+# cache.py
+# Crow Response Cache
+# project: https://pypi.org/project/crow-serial/
+# source: https://github.com/chris-siedell/PyCrow
+# homepage: http://siedell.com/projects/Crow/
+
+
+import asyncio
+import collections
+import threading
+import crow.errors
+
+
+class ResponseCache:
+
+    # A ResponseCache lets hosts share the responses to read-only commands. It is opt-in:
+    #  it is used only when assigned to a HostSerialPort (its response_cache property), and
+    #  only for commands sent with cacheable=True (see Host.send_command).
+    # Responses are keyed by (address, port, payload) and kept for a time to live (TTL),
+    #  which may be set per port (and per address). A TTL of zero means responses are not
+    #  kept, but concurrent identical commands are still merged. When there are more than
+    #  max_entries responses the least recently used ones are evicted.
+    # Single-flight: if an identical command is already in progress (sent by a host in
+    #  another thread, or by another coroutine), the host waits for its outcome instead of
+    #  sending the command again. If that command fails, the waiting hosts get the same
+    #  exception.
+    # When a device sends an error response (a RemoteError) the responses cached for that
+    #  address and port are discarded, since the device's state may have changed, and the
+    #  invalidation hooks are called. invalidate may also be called directly, e.g. after a
+    #  command that changes what the cached commands would return.
+
+    def __init__(self, max_entries=256, default_ttl=1.0):
+        if max_entries < 1:
+            raise ValueError("max_entries must be at least 1.")
+        if default_ttl < 0:
+            raise ValueError("default_ttl must not be negative.")
+        self.max_entries = max_entries
+        self.default_ttl = default_ttl
+        # Functions called as hook(address, port, error) when responses are invalidated
+        #  because of an error response.
+        self.invalidation_hooks = []
+        self._ttls = {}
+        self._lock = threading.Lock()
+        # (address, port, payload) -> (response, expiry time), in LRU order
+        self._entries = collections.OrderedDict()
+        # (address, port, payload) -> _Flight, for commands in progress
+        self._flights = {}
+        self._num_hits = 0
+        self._num_misses = 0
+        self._num_merged = 0
+        self._num_evictions = 0
+        self._num_invalidations = 0
+
+    def __repr__(self):
+        return "<{0} instance at {1:#x}, max_entries={2}, default_ttl={3}, entries={4}>".format(self.__class__.__name__, id(self), self.max_entries, self.default_ttl, len(self._entries))
+
+    def set_ttl(self, port, ttl, address=None):
+        """Sets the time to live, in seconds, for responses from the port (on all addresses, or on the given address)."""
+        # Passing None for ttl reverts to the default.
+        if ttl is not None and ttl < 0:
+            raise ValueError("ttl must not be negative.")
+        if ttl is None:
+            self._ttls.pop((address, port), None)
+        else:
+            self._ttls[(address, port)] = ttl
+
+    def get_ttl(self, address, port):
+        ttl = self._ttls.get((address, port))
+        if ttl is None:
+            ttl = self._ttls.get((None, port), self.default_ttl)
+        return ttl
+
+    def invalidate(self, address=None, port=None, payload=None):
+        """Discards the cached responses matching the given address, port, and payload (None matches all)."""
+        if payload is not None:
+            payload = bytes(payload)
+        with self._lock:
+            keys = [k for k in self._entries if (address is None or k[0] == address) and (port is None or k[1] == port) and (payload is None or k[2] == payload)]
+            for k in keys:
+                del self._entries[k]
+            self._num_invalidations += len(keys)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """Returns a dictionary of cache statistics."""
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'hits': self._num_hits,
+                'misses': self._num_misses,
+                'merged': self._num_merged,
+                'evictions': self._num_evictions,
+                'invalidations': self._num_invalidations,
+            }
+
+    def fetch(self, address, port, payload, now, send):
+        """Returns (transaction, response) for a cacheable command."""
+        # send is called to perform the command if there is no usable cached response and no
+        #  identical command in progress (or that command was abandoned). It returns a
+        #  Transaction, which is returned as (transaction, None). Otherwise (None, response)
+        #  is returned, where response is the shared response payload (a bytes object). now
+        #  is the current time (the serial port's clock).
+        key = (address, port, bytes(payload) if payload is not None else b'')
+        while True:
+            action, value = self._begin(key, now)
+            if action is _HIT:
+                return None, value
+            if action is _SEND:
+                break
+            value.event.wait()
+            if not value.abandoned:
+                return None, value.result()
+        try:
+            t = send()
+        except BaseException as e:
+            self._end(key, value, None, now, e)
+            raise
+        self._end(key, value, t.response, now)
+        return t, None
+
+    async def fetch_async(self, address, port, payload, now, send):
+        # The coroutine counterpart of fetch. send is a coroutine function.
+        key = (address, port, bytes(payload) if payload is not None else b'')
+        while True:
+            action, value = self._begin(key, now)
+            if action is _HIT:
+                return None, value
+            if action is _SEND:
+                break
+            waiter = self._add_waiter(value, asyncio.get_running_loop())
+            if waiter is not None:
+                # The future is shared by the loop's waiters, so it is shielded from the
+                #  cancellation of any one of them.
+                await asyncio.shield(waiter)
+            if not value.abandoned:
+                return None, value.result()
+        try:
+            t = await send()
+        except BaseException as e:
+            self._end(key, value, None, now, e)
+            raise
+        self._end(key, value, t.response, now)
+        return t, None
+
+    def _begin(self, key, now):
+        # Returns (_HIT, response), (_WAIT, flight), or (_SEND, flight).
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[1] > now:
+                    self._entries.move_to_end(key)
+                    self._num_hits += 1
+                    return _HIT, entry[0]
+                del self._entries[key]
+            flight = self._flights.get(key)
+            if flight is not None:
+                self._num_merged += 1
+                return _WAIT, flight
+            self._num_misses += 1
+            flight = _Flight()
+            self._flights[key] = flight
+            return _SEND, flight
+
+    def _add_waiter(self, flight, loop):
+        # Returns a future of loop that is resolved when flight ends, or None if it has ended.
+        #  The command may be performed by a host in another thread, so _end resolves the
+        #  future with call_soon_threadsafe.
+        with self._lock:
+            if flight.event.is_set():
+                return None
+            waiter = flight.waiters.get(loop)
+            if waiter is None:
+                waiter = flight.waiters[loop] = loop.create_future()
+            return waiter
+
+    def _end(self, key, flight, response, now, error=None):
+        # Records the outcome of a command sent by fetch and wakes the waiting hosts.
+        address, port, _ = key
+        if response is not None:
+            response = bytes(response)
+        with self._lock:
+            self._flights.pop(key, None)
+            if error is None:
+                ttl = self.get_ttl(address, port)
+                if ttl > 0:
+                    self._entries[key] = (response, now + ttl)
+                    self._entries.move_to_end(key)
+                    while len(self._entries) > self.max_entries:
+                        self._entries.popitem(last=False)
+                        self._num_evictions += 1
+        flight.response = response
+        if isinstance(error, Exception):
+            flight.error = error
+        elif error is not None:
+            # The sender was interrupted (e.g. KeyboardInterrupt, or a cancelled coroutine),
+            #  which says nothing about the command, so the waiting hosts try again.
+            flight.abandoned = True
+        with self._lock:
+            flight.event.set()
+            waiters = flight.waiters
+            flight.waiters = None
+        for loop, waiter in waiters.items():
+            try:
+                loop.call_soon_threadsafe(_set_future_result, waiter)
+            except RuntimeError:
+                # The loop has been closed, so its waiters are gone.
+                pass
+        if isinstance(error, crow.errors.RemoteError):
+            self.invalidate(address, port)
+            for hook in list(self.invalidation_hooks):
+                hook(address, port, error)
+
+
+# _begin actions
+_HIT = 'hit'
+_WAIT = 'wait'
+_SEND = 'send'
+
+
+class _Flight:
+
+    # A command in progress, and its outcome once it is known. Threads wait on event, and
+    #  coroutines on a future of their event loop (loop -> future in waiters).
+
+    __slots__ = ('event', 'waiters', 'response', 'error', 'abandoned')
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.waiters = {}
+        self.response = None
+        self.error = None
+        self.abandoned = False
+
+    def result(self):
+        if self.error is not None:
+            # Each waiter raises its own copy, since raising sets the exception's traceback
+            #  and hosts set attributes (e.g. attempts) on the exceptions they see. The Crow
+            #  errors' constructors take arguments that are not kept in args, so the copy is
+            #  made without calling the constructor.
+            error = self.error
+            error_copy = error.__class__.__new__(error.__class__, *error.args)
+            error_copy.args = error.args
+            error_copy.__dict__.update(error.__dict__)
+            raise error_copy from error
+        return self.response
+
+
+def _set_future_result(future):
+    if not future.done():
+        future.set_result(None)
@@ -0,0 +1,352 @@
+# capture.py
+# Crow Line Captures
+# project: https://pypi.org/project/crow-serial/
+# source: https://github.com/chris-siedell/PyCrow
+# homepage: http://siedell.com/projects/Crow/
+
+
+import concurrent.futures
+import mmap
+import multiprocessing
+import os
+import struct
+import threading
+import time
+import crow.parser
+
+
+# A capture is a record of the raw bytes on a line, in both directions, with timestamps. It
+#  is written by hosts (see HostSerialPort.start_capture) and analyzed offline.
+#
+# Example:
+#   host.serial_port.start_capture('line.crowcap')
+#   ...
+#   host.serial_port.stop_capture()
+#   with CaptureReader('line.crowcap') as reader:
+#       for timestamp, direction, result in reader.replay(): ...
+#   stats = analyze('line.crowcap')
+#
+# File format (integers and floats are little-endian):
+#   header: magic 'CROWCAP' version(1) wall_time(8, double) clock_time(8, double)
+#    wall_time is the time.time() value when the file was created, and clock_time is the
+#    capture clock's value at that moment, so record timestamps can be converted to dates.
+#   records: timestamp(8, double) direction(1) length(4) data
+#    direction is TX (written by the host), RX (read by the host), or SYNC.
+# The file is append-only, so an interrupted capture is still readable (up to the last
+#  complete record).
+#
+# SYNC records mark packet-resync points: a SYNC record is written before a TX record (the
+#  host writes whole command packets, and resets its response parser for each one) once
+#  sync_interval bytes have been written since the last. Its data is a fixed marker, so a
+#  reader can find the record boundary nearest any file offset with a search instead of
+#  walking every record from the start. This is how large captures are split into chunks for
+#  parallel decoding (see analyze and map_chunks).
+
+
+TX = 0
+RX = 1
+SYNC = 2
+
+MAGIC = b'CROWCAP'
+VERSION = 1
+
+_HEADER = struct.Struct('<7sBdd')
+_RECORD = struct.Struct('<dBI')
+_SYNC_MARKER = b'\xc5\x7a\x0e\x93CRWSYNC\x5a\xe1\x36\xb8'
+
+# The (real) paths of the files open in CaptureWriters.
+_open_paths = set()
+_open_paths_lock = threading.Lock()
+
+
+class CaptureWriter:
+
+    # Appends records to a capture file. It is thread-safe, so the hosts of a serial port may
+    #  record from several threads. The records do not say which line they came from, so a
+    #  capture holds the traffic of one line: a writer must not be shared by serial ports,
+    #  and a file that is being written can not be opened by a second writer in the process.
+    #   clock - the clock that the timestamps given to record come from (used only for the
+    #    header's reference time)
+    #   sync_interval - the approximate number of bytes between SYNC records
+    #   buffer_size - the size of the file buffer (records are written when it fills, or on
+    #    flush or close)
+
+    def __init__(self, path, clock=time.perf_counter, sync_interval=1 << 20, buffer_size=1 << 16):
+        if sync_interval < 1:
+            raise ValueError("sync_interval must be at least 1.")
+        self.path = path
+        self.sync_interval = sync_interval
+        self._lock = threading.Lock()
+        self._real_path = os.path.realpath(path)
+        with _open_paths_lock:
+            if self._real_path in _open_paths:
+                raise ValueError("The capture file is already being written.")
+            _open_paths.add(self._real_path)
+        try:
+            self._file = open(path, 'ab', buffering=buffer_size)
+        except BaseException:
+            with _open_paths_lock:
+                _open_paths.discard(self._real_path)
+            raise
+        if self._file.tell() == 0:
+            self._file.write(_HEADER.pack(MAGIC, VERSION, time.time(), clock()))
+        self._since_sync = 0
+        self.num_records = 0
+
+    def __repr__(self):
+        return "<{0} instance at {1:#x}, path='{2}', records={3}>".format(self.__class__.__name__, id(self), self.path, self.num_records)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __del__(self):
+        if hasattr(self, '_file'):
+            self.close()
+
+    def record(self, direction, data, timestamp):
+        """Appends a record of data (a bytes-like object) sent in direction (TX or RX) at timestamp."""
+        size = len(data)
+        with self._lock:
+            f = self._file
+            if direction == TX and self._since_sync >= self.sync_interval:
+                f.write(_RECORD.pack(timestamp, SYNC, len(_SYNC_MARKER)))
+                f.write(_SYNC_MARKER)
+                self._since_sync = 0
+            f.write(_RECORD.pack(timestamp, direction, size))
+            f.write(data)
+            self._since_sync += _RECORD.size + size
+            self.num_records += 1
+
+    def flush(self):
+        with self._lock:
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            if not self._file.closed:
+                self._file.close()
+                with _open_paths_lock:
+                    _open_paths.discard(self._real_path)
+
+
+class CaptureReader:
+
+    # Reads a capture file through a memory map. Records are returned as (timestamp,
+    #  direction, data) tuples, where data is a memoryview of the map, so nothing is copied.
+    #  The views must not be used after the reader is closed.
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'rb')
+        size = os.fstat(self._file.fileno()).st_size
+        if size < _HEADER.size:
+            self._file.close()
+            raise ValueError("The file is too small to be a capture.")
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        self._view = memoryview(self._map)
+        magic, version, self.wall_time, self.clock_time = _HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC:
+            self.close()
+            raise ValueError("The file is not a capture.")
+        if version != VERSION:
+            self.close()
+            raise ValueError("Unsupported capture version: {0}.".format(version))
+        self.size = size
+
+    def __repr__(self):
+        return "<{0} instance at {1:#x}, path='{2}', size={3}>".format(self.__class__.__name__, id(self), self.path, self.size)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        if self._map is not None:
+            self._view.release()
+            self._map.close()
+            self._file.close()
+            self._map = None
+
+    def wall_time_of(self, timestamp):
+        """Converts a record timestamp to a time.time() value."""
+        return self.wall_time + (timestamp - self.clock_time)
+
+    def records(self, start=None, end=None, include_sync=False):
+        """Yields (timestamp, direction, data) for the records from file offset start (a record boundary) up to offset end."""
+        # A record that starts before end is included even if it extends past it. An
+        #  incomplete record at the end of the file is ignored.
+        view = self._view
+        unpack_from = _RECORD.unpack_from
+        header_size = _RECORD.size
+        ind = _HEADER.size if start is None else start
+        size = self.size
+        if end is None or end > size:
+            end = size
+        while ind < end and ind + header_size <= size:
+            timestamp, direction, length = unpack_from(view, ind)
+            data_start = ind + header_size
+            ind = data_start + length
+            if ind > size:
+                break
+            if direction != SYNC or include_sync:
+                yield timestamp, direction, view[data_start:ind]
+
+    def replay(self, start=None, end=None):
+        """Yields (timestamp, direction, result) for the packets in the capture, where result is a crow.parser.ParserResult."""
+        # TX data is parsed for command packets and RX data for response packets. As in the
+        #  host, the response parser is reset when a command is sent. The payload of a
+        #  record's last packet is a view of the parser's buffer (earlier ones are copies),
+        #  so it is only valid until the results of the next record are yielded.
+        cmd_parser = crow.parser.CommandParser(payload_views=True)
+        rsp_parser = crow.parser.Parser(payload_views=True)
+        for timestamp, direction, data in self.records(start, end):
+            if direction == TX:
+                rsp_parser.reset()
+                for result in cmd_parser.parse_data(data):
+                    yield timestamp, TX, result
+            else:
+                for result in rsp_parser.parse_data(data):
+                    yield timestamp, RX, result
+
+    def split(self, num_chunks):
+        """Returns a list of (start, end) file offsets dividing the capture into up to num_chunks chunks at resync points."""
+        if num_chunks < 1:
+            raise ValueError("num_chunks must be at least 1.")
+        boundaries = [_HEADER.size]
+        target_size = (self.size - _HEADER.size)//num_chunks
+        for i in range(1, num_chunks):
+            ind = self.find_sync(max(boundaries[-1] + 1, _HEADER.size + i*target_size))
+            if ind is None:
+                break
+            if ind > boundaries[-1]:
+                boundaries.append(ind)
+        boundaries.append(self.size)
+        return [(boundaries[i], boundaries[i+1]) for i in range(len(boundaries) - 1)]
+
+    def find_sync(self, offset):
+        """Returns the file offset of the first SYNC record starting at or after offset, or None."""
+        header_size = _RECORD.size
+        marker_size = len(_SYNC_MARKER)
+        ind = offset + header_size
+        while True:
+            ind = self._map.find(_SYNC_MARKER, ind)
+            if ind < 0:
+                return None
+            # The marker could appear in captured data, so the record header is checked too.
+            record_start = ind - header_size
+            _, direction, length = _RECORD.unpack_from(self._map, record_start)
+            if direction == SYNC and length == marker_size:
+                return record_start
+            ind += 1
+
+
+class CaptureStats:
+
+    # Totals for (part of) a capture, as computed by analyze. Stats for chunks are combined
+    #  with merge.
+
+    def __init__(self):
+        self.num_commands = 0
+        self.num_responses = 0
+        self.num_error_responses = 0
+        self.num_corrupt = 0
+        self.num_extra_bytes = 0
+        self.num_cmd_payload_bytes = 0
+        self.num_rsp_payload_bytes = 0
+        # (address, port) -> number of commands
+        self.commands_by_port = {}
+        self.first_time = None
+        self.last_time = None
+
+    def __repr__(self):
+        return "<{0} instance at {1:#x}, commands={2}, responses={3}, error_responses={4}, corrupt={5}, extra_bytes={6}>".format(self.__class__.__name__, id(self), self.num_commands, self.num_responses, self.num_error_responses, self.num_corrupt, self.num_extra_bytes)
+
+    def to_dict(self):
+        info = dict(vars(self))
+        info['commands_by_port'] = {"{0}:{1}".format(*key): count for key, count in sorted(self.commands_by_port.items())}
+        return info
+
+    def add(self, timestamp, direction, result):
+        """Counts a result from CaptureReader.replay."""
+        if self.first_time is None:
+            self.first_time = timestamp
+        self.last_time = timestamp
+        rtype = result.type
+        if rtype == crow.parser.ResultType.COMMAND:
+            self.num_commands += 1
+            self.num_cmd_payload_bytes += len(result.payload)
+            key = (result.address, result.port)
+            self.commands_by_port[key] = self.commands_by_port.get(key, 0) + 1
+        elif rtype == crow.parser.ResultType.RESPONSE:
+            self.num_responses += 1
+            self.num_rsp_payload_bytes += len(result.payload)
+            if result.is_error:
+                self.num_error_responses += 1
+        elif rtype == crow.parser.ResultType.ERROR:
+            self.num_corrupt += 1
+        elif rtype == crow.parser.ResultType.EXTRA:
+            self.num_extra_bytes += len(result.data)
+
+    def merge(self, other):
+        """Adds the totals of other (the stats for a later part of the capture)."""
+        self.num_commands += other.num_commands
+        self.num_responses += other.num_responses
+        self.num_error_responses += other.num_error_responses
+        self.num_corrupt += other.num_corrupt
+        self.num_extra_bytes += other.num_extra_bytes
+        self.num_cmd_payload_bytes += other.num_cmd_payload_bytes
+        self.num_rsp_payload_bytes += other.num_rsp_payload_bytes
+        for key, count in other.commands_by_port.items():
+            self.commands_by_port[key] = self.commands_by_port.get(key, 0) + count
+        if self.first_time is None:
+            self.first_time = other.first_time
+        if other.last_time is not None:
+            self.last_time = other.last_time
+        return self
+
+
+def map_chunks(path, func, num_workers=None, num_chunks=None, mp_context=None):
+    """Calls func(reader, start, end) for each chunk of the capture in a process pool. Returns the results in file order."""
+    # func must be picklable (a module level function), as must its results. Chunks are
+    #  split at resync points (see CaptureReader.split), so func may replay them
+    #  independently. By default there are four chunks per worker, to even out the load.
+    if num_workers is None:
+        num_workers = os.cpu_count() or 1
+    if num_chunks is None:
+        num_chunks = 4*num_workers
+    with CaptureReader(path) as reader:
+        chunks = reader.split(num_chunks)
+    if num_workers == 1 or len(chunks) == 1:
+        return [_map_chunk(path, func, start, end) for start, end in chunks]
+    if mp_context is None:
+        mp_context = multiprocessing.get_context()
+    with concurrent.futures.ProcessPoolExecutor(num_workers, mp_context=mp_context) as executor:
+        futures = [executor.submit(_map_chunk, path, func, start, end) for start, end in chunks]
+        return [future.result() for future in futures]
+
+
+def analyze(path, num_workers=None, mp_context=None):
+    """Returns the CaptureStats for a capture, decoding its chunks in parallel."""
+    stats = CaptureStats()
+    for chunk_stats in map_chunks(path, _analyze_chunk, num_workers, mp_context=mp_context):
+        stats.merge(chunk_stats)
+    return stats
+
+
+def _map_chunk(path, func, start, end):
+    # Runs in a worker process. Each worker maps the file itself.
+    with CaptureReader(path) as reader:
+        return func(reader, start, end)
+
+
+def _analyze_chunk(reader, start, end):
+    stats = CaptureStats()
+    add = stats.add
+    for timestamp, direction, result in reader.replay(start, end):
+        add(timestamp, direction, result)
+    return stats
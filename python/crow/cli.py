@@ -0,0 +1,168 @@
+# cli.py
+# Crow Command Line Interface
+# project: https://pypi.org/project/crow-serial/
+# source: https://github.com/chris-siedell/PyCrow
+# homepage: http://siedell.com/projects/Crow/
+
+
+import argparse
+import json
+import os
+import sys
+import crow
+
+
+# The `crow` console script (declared in setup.py). Subcommands:
+#   crow bench - runs the end-to-end benchmarks (see crow.bench)
+#   crow microbench - runs the microbenchmarks (see crow.microbench)
+#   crow capture - analyzes a capture file (see crow.capture)
+
+
+def _int_list(text):
+    return [int(s) for s in text.split(',') if s != '']
+
+
+def _bool_list(text):
+    values = []
+    for s in text.split(','):
+        s = s.strip().lower()
+        if s in ('on', 'true', 'yes', '1'):
+            values.append(True)
+        elif s in ('off', 'false', 'no', '0'):
+            values.append(False)
+        else:
+            raise argparse.ArgumentTypeError("expected a comma separated list of on/off values")
+    return values
+
+
+def _add_bench_parser(subparsers):
+    import crow.bench
+    p = subparsers.add_parser('bench', help='measure host throughput and latency',
+                              description='Sweeps payload sizes, baud rates, propcr_order, and response_expected through Host.send_command and CrowAdmin, and reports the results as JSON.')
+    target = p.add_mutually_exclusive_group()
+    target.add_argument('--sim', action='store_const', dest='target', const='sim', help='use a simulated device on a virtual bus (the default)')
+    if os.name == 'posix':
+        target.add_argument('--pty', action='store_const', dest='target', const='pty', help='use a device served on a local pseudo-terminal')
+    target.add_argument('--port', metavar='NAME', help='use a real serial port (the device needs an echo service)')
+    p.add_argument('--address', type=int, default=1, help='device address (default: 1)')
+    p.add_argument('--service-port', type=int, default=16, help='port of the echo service (default: 16)')
+    p.add_argument('--sizes', type=_int_list, default=list(crow.bench.DEFAULT_PAYLOAD_SIZES), help='comma separated payload sizes')
+    p.add_argument('--baudrates', type=_int_list, default=list(crow.bench.DEFAULT_BAUDRATES), help='comma separated baud rates')
+    p.add_argument('--propcr-order', type=_bool_list, default=None, help='comma separated on/off values (default: off,on for --sim and --pty, off for --port)')
+    p.add_argument('--response-expected', type=_bool_list, default=[True, False], help='comma separated on/off values (default: on,off)')
+    p.add_argument('--count', type=int, default=200, help='transactions per case (default: 200)')
+    p.add_argument('--warmup', type=int, default=10, help='untimed transactions before each case (default: 10)')
+    p.add_argument('--processing-delay', type=float, default=0.0, help='device processing delay in seconds for --sim (default: 0)')
+    p.add_argument('--output', '-o', metavar='FILE', help='write the JSON results to FILE instead of stdout')
+    p.set_defaults(func=_bench)
+
+
+def _bench(args):
+    import crow.bench
+    if args.port is not None:
+        target = 'port'
+    else:
+        target = args.target or 'sim'
+    propcr_orders = args.propcr_order
+    if propcr_orders is None:
+        propcr_orders = [False] if target == 'port' else [False, True]
+
+    def progress(case):
+        print("{payload_size:5d} bytes  {baudrate:7d} baud  propcr={propcr_order!s:5}  response={response_expected!s:5}  "
+              "{transactions_per_second:9.1f} tps  p50={p50:8.3f} ms  p99={p99:8.3f} ms  util={util}".format(
+              p50=(case['latency_p50'] or 0)*1000, p99=(case['latency_p99'] or 0)*1000,
+              util='{0:.2f}'.format(case['bus_utilization']) if case['bus_utilization'] is not None else '-',
+              **dict(case, transactions_per_second=case['transactions_per_second'] or 0.0)), file=sys.stderr)
+
+    bench = crow.bench.Benchmark(target, args.port, args.address, args.service_port, args.processing_delay)
+    try:
+        results = bench.run(args.sizes, args.baudrates, propcr_orders, args.response_expected, args.count, args.warmup, progress)
+    finally:
+        bench.close()
+
+    text = json.dumps(results, indent=2)
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+    return 0
+
+
+def _add_microbench_parser(subparsers):
+    p = subparsers.add_parser('microbench', help='time the encoder, parser, and decoders',
+                              description='Times the pure-CPU hot paths, optionally comparing the results to a saved baseline.')
+    p.add_argument('names', nargs='*', help='only run benchmarks whose names contain one of these strings')
+    p.add_argument('--compare', metavar='FILE', help='compare to the baseline in FILE, exiting with status 1 on regressions')
+    p.add_argument('--threshold', type=float, default=0.25, help='fractional slowdown that counts as a regression (default: 0.25)')
+    p.add_argument('--save', metavar='FILE', help='save the results to FILE (e.g. as a new baseline)')
+    p.add_argument('--repeat', type=int, default=7, help='timing runs per benchmark, the best is kept (default: 7)')
+    p.set_defaults(func=_microbench)
+
+
+def _microbench(args):
+    import crow.microbench
+    baseline = None
+    if args.compare is not None:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+    def progress(name, seconds):
+        print("{0:32s} {1:12.3f} us".format(name, seconds*1e6), file=sys.stderr)
+
+    results = crow.microbench.run(args.names or None, args.repeat, progress=progress)
+
+    if args.save is not None:
+        with open(args.save, 'w') as f:
+            f.write(json.dumps(results, indent=2, sort_keys=True) + '\n')
+
+    if baseline is None:
+        if args.save is None:
+            print(json.dumps(results, indent=2, sort_keys=True))
+        return 0
+
+    if baseline.get('python') != results['python'] or baseline.get('numpy') != results['numpy']:
+        print("warning: the baseline was made with python {0} (numpy: {1})".format(baseline.get('python'), baseline.get('numpy')))
+    regressions = 0
+    for name, base, current, ratio, is_regression in crow.microbench.compare(results, baseline, args.threshold):
+        print("{0:32s} {1:12.3f} us {2:12.3f} us {3:7.2f}x{4}".format(name, base*1e6, current*1e6, ratio, '  REGRESSION' if is_regression else ''))
+        if is_regression:
+            regressions += 1
+    if regressions > 0:
+        print("{0} regression(s) beyond {1:.0%}".format(regressions, args.threshold))
+        return 1
+    return 0
+
+
+def _add_capture_parser(subparsers):
+    p = subparsers.add_parser('capture', help='analyze a capture file',
+                              description='Decodes a capture file (see HostSerialPort.start_capture) in parallel and reports packet totals as JSON.')
+    p.add_argument('file', help='the capture file')
+    p.add_argument('--workers', type=int, default=None, help='number of worker processes (default: the number of CPUs)')
+    p.set_defaults(func=_capture)
+
+
+def _capture(args):
+    import crow.capture
+    stats = crow.capture.analyze(args.file, args.workers)
+    print(json.dumps(stats.to_dict(), indent=2))
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='crow', description='Tools for the Crow serial protocol.')
+    parser.add_argument('--version', action='version', version='%(prog)s ' + crow.__version__)
+    subparsers = parser.add_subparsers(dest='command')
+    _add_bench_parser(subparsers)
+    _add_microbench_parser(subparsers)
+    _add_capture_parser(subparsers)
+    args = parser.parse_args(argv)
+    if args.command is None:
+        parser.print_help()
+        return 2
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
+
@@ -0,0 +1,159 @@
+# details.py
+# Crow Details Formats
+# project: https://pypi.org/project/crow-serial/
+# source: https://github.com/chris-siedell/PyCrow
+# homepage: http://siedell.com/projects/Crow/
+
+
+import struct
+
+
+# The Crow error response format and the CrowAdmin responses use the same method for packing
+#  optional values: a details byte, where each bit says whether a value is included, followed
+#  by the packed arguments of the included values (in bit order), followed by any string
+#  data. Integers are packed in big-endian order. Strings are ascii, and are packed as a
+#  two byte offset (from the beginning of the payload) and a one or two byte length, which
+#  may include a terminating NUL.
+#
+# A DetailsFormat describes one use of this method, and is compiled into decoders as needed:
+#  the first time a details value is seen a struct layout for its arguments is built, so
+#  that decoding takes one struct unpack plus a slice per string.
+
+
+ASCII = 'ascii'
+INT = 'int'
+
+# struct codes for the argument bytes (strings have a two byte offset, then the length)
+_ARG_CODES = {(INT, 1): 'B', (INT, 2): 'H', (INT, 4): 'I', (ASCII, 3): 'HB', (ASCII, 4): 'HH'}
+
+
+class DetailsFormat:
+
+    # fields is a list of (name, kind, num_arg_bytes) tuples, one per details bit starting
+    #  at first_bit. kind is INT (num_arg_bytes 1, 2, or 4) or ASCII (num_arg_bytes 3 or 4).
+
+    def __init__(self, fields, first_bit=0):
+        for name, kind, num_arg_bytes in fields:
+            if (kind, num_arg_bytes) not in _ARG_CODES:
+                raise ValueError("Unsupported field: {0} ({1}, {2} bytes).".format(name, kind, num_arg_bytes))
+        self.fields = tuple(fields)
+        self.names = frozenset(name for name, kind, num_arg_bytes in fields)
+        self.first_bit = first_bit
+        self._layouts = {}
+
+    def decode(self, payload, start, details, info, rsp_name):
+        """Decodes the arguments at payload[start:] selected by details into the dictionary info."""
+        # Raises RuntimeError if the payload is too short for the arguments or a string lies
+        #  outside the payload. rsp_name is used in the error messages.
+        layout = self._layouts.get(details)
+        if layout is None:
+            layout = self._compile(details)
+        packer, included = layout
+        size = len(payload)
+        if size - start < packer.size:
+            raise RuntimeError(self._truncation_error(payload, start, included, rsp_name))
+        args = packer.unpack_from(payload, start)
+        i = 0
+        for name, kind in included:
+            if kind == INT:
+                info[name] = args[i]
+                i += 1
+            else:
+                offset = args[i]
+                end = offset + args[i+1]
+                i += 2
+                if end > size:
+                    raise RuntimeError(name + " exceeds the bounds of the " + rsp_name + " response.")
+                info[name] = str(payload[offset:end], 'ascii', 'replace')
+        return info
+
+    def pack(self, payload, values, initial_details=0):
+        """Appends the details byte and the packed values (a dictionary) to payload (a bytearray). Returns payload."""
+        # Values that are missing or None are omitted.
+        details = initial_details
+        included = []
+        for i, (name, kind, num_arg_bytes) in enumerate(self.fields):
+            value = values.get(name)
+            if value is not None:
+                details |= 1 << (self.first_bit + i)
+                if kind == ASCII:
+                    value = value.encode('ascii', errors='replace')
+                included.append((kind, value))
+        packer, _ = self._layouts.get(details) or self._compile(details)
+        # The string data follows the arguments, and the offsets are from the beginning of
+        #  the payload.
+        offset = len(payload) + 1 + packer.size
+        args = []
+        strings = []
+        for kind, value in included:
+            if kind == ASCII:
+                args.append(offset)
+                args.append(len(value))
+                strings.append(value)
+                offset += len(value)
+            else:
+                args.append(value)
+        payload.append(details)
+        payload += packer.pack(*args)
+        for data in strings:
+            payload += data
+        return payload
+
+    def _compile(self, details):
+        # Builds the struct layout and the list of (name, kind) for a details value.
+        codes = ['>']
+        included = []
+        for i, (name, kind, num_arg_bytes) in enumerate(self.fields):
+            if details & (1 << (self.first_bit + i)):
+                codes.append(_ARG_CODES[(kind, num_arg_bytes)])
+                included.append((name, kind))
+        layout = (struct.Struct(''.join(codes)), tuple(included))
+        self._layouts[details] = layout
+        return layout
+
+    def _truncation_error(self, payload, start, included, rsp_name):
+        # Returns the message for a payload too short for its arguments. The arguments are
+        #  checked in order, so a string found out of bounds before the missing argument is
+        #  reported instead.
+        sizes = {name: num_arg_bytes for name, kind, num_arg_bytes in self.fields}
+        size = len(payload)
+        ind = start
+        for name, kind in included:
+            num_arg_bytes = sizes[name]
+            if size - ind < num_arg_bytes:
+                return "The " + rsp_name + " response does not have enough bytes remaining for " + name + "."
+            if kind == ASCII:
+                offset = int.from_bytes(payload[ind:ind+2], 'big')
+                length = int.from_bytes(payload[ind+2:ind+num_arg_bytes], 'big')
+                if offset + length > size:
+                    return name + " exceeds the bounds of the " + rsp_name + " response."
+            ind += num_arg_bytes
+        # The arguments themselves fit (or there are none), so the payload is too short in
+        #  some other way.
+        return "The " + rsp_name + " response is too short."
+
+
+# The details of an error response (see crow.host.Host._raise_error).
+ERROR_DETAILS = DetailsFormat([
+    ('message', ASCII, 4),
+    ('crow_version', INT, 1),
+    ('max_command_size', INT, 2),
+    ('max_response_size', INT, 2),
+    ('address', INT, 1),
+    ('port', INT, 1),
+    ('service_identifier', ASCII, 3),
+])
+
+# The details of the CrowAdmin get_device_info response.
+DEVICE_INFO_DETAILS = DetailsFormat([
+    ('impl_identifier', ASCII, 3),
+    ('impl_description', ASCII, 3),
+    ('device_identifier', ASCII, 3),
+    ('device_description', ASCII, 3),
+])
+
+# The details of the CrowAdmin get_port_info response. Bit 0 says whether the port is open.
+PORT_INFO_DETAILS = DetailsFormat([
+    ('service_identifier', ASCII, 3),
+    ('service_description', ASCII, 3),
+], first_bit=1)
@@ -0,0 +1,337 @@
+# device.py
+# Crow Device Implementation
+# project: https://pypi.org/project/crow-serial/
+# source: https://github.com/chris-siedell/PyCrow
+# homepage: http://siedell.com/projects/Crow/
+
+
+import threading
+import crow.details
+import crow.parser
+import crow.transaction
+import crow.transfer
+import crow.transport
+import crow.utils
+
+
+# This module is a device implementation for Crow devices that can run Python (e.g.
+#  Linux single board computers on the bus).
+#
+# Example:
+#   device = SerialDevice('/dev/ttyS0', address=5, baudrate=115200)
+#   device.add_service(16, EchoService())
+#   device.serve_forever()
+#
+# Device is the transport independent part: data received from the line is given to
+#  Device.process, which decodes commands, dispatches them by port to the registered
+#  services, and writes the responses. SerialDevice runs a Device on a serial port.
+#  The simulator (crow.simulator) runs Devices on a virtual bus.
+#
+# Turnaround latency matters to the host, so the command path avoids allocations:
+#  payloads are given to services as views of the parser's buffer (except when several
+#  commands arrive in one chunk, where all but the last are copies), responses are encoded
+#  into a preallocated buffer, and PropCR ordered payloads are reordered into a
+#  preallocated buffer.
+
+
+class Device:
+
+    # Settings:
+    #   address - the device's address, 1 to 31
+    #   propcr_order - if True the device expects command payloads in PropCR byte order
+    #   max_command_size, max_response_size - the device's payload capacities
+    #   impl_identifier, impl_description, device_identifier, device_description - strings
+    #    reported by the admin service (None to omit)
+    # An AdminService is registered on port 0.
+
+    CROW_VERSION = 2
+
+    def __init__(self, address, propcr_order=False, max_command_size=2047, max_response_size=2047,
+                 impl_identifier='PyCrow', impl_description=None, device_identifier=None, device_description=None):
+        if address < 1 or address > 31:
+            raise ValueError("The address must be 1 to 31.")
+        if max_command_size < 0 or max_command_size > 2047:
+            raise ValueError("max_command_size must be 0 to 2047.")
+        if max_response_size < 0 or max_response_size > 2047:
+            raise ValueError("max_response_size must be 0 to 2047.")
+        self.address = address
+        self.propcr_order = propcr_order
+        self.max_command_size = max_command_size
+        self.max_response_size = max_response_size
+        self.impl_identifier = impl_identifier
+        self.impl_description = impl_description
+        self.device_identifier = device_identifier
+        self.device_description = device_description
+        self.services = {}
+        self.add_service(0, AdminService())
+        # statistics
+        self.num_commands = 0
+        self.num_responses = 0
+        # internal stuff
+        self._parser = crow.parser.CommandParser(payload_views=True)
+        self._rsp_buff = bytearray(2084)
+        self._rsp_view = memoryview(self._rsp_buff)
+        self._propcr_buff = bytearray(2047)
+        self._propcr_view = memoryview(self._propcr_buff)
+
+    def add_service(self, port, service):
+        """Opens a port, registering service to handle its commands."""
+        if port < 0 or port > 255:
+            raise ValueError("The port must be 0 to 255.")
+        self.services[port] = service
+
+    def remove_service(self, port):
+        """Closes a port."""
+        self.services.pop(port, None)
+
+    def reset(self):
+        """Discards any partially received command packet."""
+        self._parser.reset()
+
+    def process(self, data, write):
+        """Processes data received from the line, calling write with each response packet."""
+        # The response packet given to write is a view of a buffer that is reused, so it must
+        #  be consumed (or copied) before write returns. Each command decoded from data has
+        #  its own payload (see CommandParser's payload_views), so the services may be called
+        #  for several commands in one call.
+        address = self.address
+        for result in self._parser.parse_data(data):
+            if result.type == crow.parser.ResultType.EXTRA:
+                continue
+            if result.address != address and result.address != 0:
+                continue
+            self.num_commands += 1
+            response = self.handle(result)
+            if response is None or not result.response_expected or result.address == 0:
+                # Broadcast commands never get responses.
+                continue
+            payload, is_error = response
+            size = crow.transaction.encode_response(self._rsp_buff, result.token, payload, is_error)
+            write(self._rsp_view[0:size])
+            self.num_responses += 1
+
+    def handle(self, command):
+        # Performs a command (a ParserResult from CommandParser), returning a tuple
+        #  (payload, is_error), or None if there is no response.
+        if command.type == crow.parser.ResultType.ERROR:
+            return encode_error(7, address=self.address, port=command.port), True
+        payload = command.payload
+        if len(payload) > self.max_command_size:
+            return encode_error(6, max_command_size=self.max_command_size, address=self.address, port=command.port), True
+        if self.propcr_order:
+            payload = crow.utils.reverse_propcr_order(payload, self._propcr_view)
+        service = self.services.get(command.port)
+        if service is None:
+            return encode_error(8, address=self.address, port=command.port), True
+        try:
+            response = service.handle(self, command.port, payload, command.response_expected)
+        except ErrorResponse as e:
+            return e.payload, True
+        except Exception as e:
+            # A bug in the service should not take down the device.
+            return encode_error(3, message=str(e)[:200], address=self.address, port=command.port), True
+        if response is None:
+            response = b''
+        if len(response) > self.max_response_size:
+            return encode_error(3, message="The response exceeds the device's capacity.", address=self.address, port=command.port), True
+        return response, False
+
+
+class SerialDevice(Device):
+
+    # SerialDevice runs a Device on a serial port (or another transport, see crow.transport).
+    #  serve_forever processes commands until stop is called (from another thread or a
+    #  service). The other arguments are the same as for Device.
+
+    def __init__(self, serial_port_name, address, baudrate=115200, poll_interval=0.1, **kwargs):
+        super().__init__(address, **kwargs)
+        self.serial = crow.transport.open_transport(serial_port_name)
+        self.serial.baudrate = baudrate
+        self.poll_interval = poll_interval
+        self._stop = threading.Event()
+
+    def serve_forever(self):
+        """Processes commands until stop is called."""
+        ser = self.serial
+        parser = self._parser
+        write = ser.write
+        ser.timeout = self.poll_interval
+        self._stop.clear()
+        while not self._stop.is_set():
+            # Asking for the number of bytes needed to complete the packet lets read return
+            #  as soon as the packet is in.
+            data = ser.read(max(parser.min_bytes_expected, ser.in_waiting))
+            if len(data) > 0:
+                self.process(data, write)
+
+    def stop(self):
+        """Makes serve_forever return (within poll_interval seconds)."""
+        self._stop.set()
+
+    def close(self):
+        self.stop()
+        self.serial.close()
+
+
+class Service:
+
+    # Base class for services. Subclasses implement handle, which is called with the
+    #  device, the port, the command payload (in standard byte order), and whether a
+    #  response is expected. It returns the response payload (None is treated as empty),
+    #  or raises ErrorResponse to send an error response.
+    # The payload may be a memoryview of a buffer that is reused for later commands, so it
+    #  must be copied if it needs to be kept. The returned payload is encoded before the
+    #  next command is processed, so a service may return a view of its own buffer.
+
+    identifier = None
+    description = None
+
+    def handle(self, device, port, payload, response_expected):
+        raise ErrorResponse(70)
+
+
+class EchoService(Service):
+
+    # Responds with the command payload (the Test_Echo service, default port 16).
+
+    identifier = 'Test_Echo'
+    description = 'echoes command payload as response payload'
+
+    def handle(self, device, port, payload, response_expected):
+        return payload
+
+
+class ErrorEchoService(Service):
+
+    # Responds with the command payload as an error response (the Test_ErrorEcho service,
+    #  default port 17). This can be used to test how hosts decode error responses.
+
+    identifier = 'Test_ErrorEcho'
+    description = 'same as echo, but with error flag set'
+
+    def handle(self, device, port, payload, response_expected):
+        raise ErrorResponse(payload=payload)
+
+
+class TransferService(Service):
+
+    # Serves the transfer sub-protocol used by Host.upload and Host.download (see
+    #  crow.transfer). The streams are kept in memory, in the streams dictionary (stream
+    #  number -> bytearray), where they may be filled before downloads or read after uploads.
+    #  max_stream_size limits the size of a stream (a write beyond it gets a low resources
+    #  error).
+
+    identifier = 'Transfer'
+    description = 'segmented stream transfers'
+
+    def __init__(self, max_stream_size=1 << 24):
+        self.max_stream_size = max_stream_size
+        self.streams = {}
+
+    def handle(self, device, port, payload, response_expected):
+        if len(payload) < 4 or payload[0] != 0x43 or payload[1] != 0x54:
+            raise ErrorResponse(65)
+        code = payload[2]
+        stream = self.streams.get(payload[3])
+        size = len(stream) if stream is not None else 0
+        if code == crow.transfer.STATUS:
+            return crow.transfer.SIZE_RESPONSE.pack(crow.transfer.SIGNATURE, code, size)
+        elif code == crow.transfer.WRITE:
+            if len(payload) < crow.transfer.WRITE_COMMAND.size:
+                raise ErrorResponse(73)
+            offset = crow.transfer.WRITE_COMMAND.unpack_from(payload)[3]
+            if offset > size:
+                raise ErrorResponse(67, message="The offset is beyond the end of the stream.")
+            data = payload[crow.transfer.WRITE_COMMAND.size:]
+            if offset + len(data) > self.max_stream_size:
+                raise ErrorResponse(66)
+            if stream is None:
+                stream = self.streams[payload[3]] = bytearray()
+            del stream[offset:]
+            stream += data
+            return crow.transfer.SIZE_RESPONSE.pack(crow.transfer.SIGNATURE, code, len(stream))
+        elif code == crow.transfer.READ:
+            if len(payload) < crow.transfer.READ_COMMAND.size:
+                raise ErrorResponse(73)
+            _, _, _, offset, length = crow.transfer.READ_COMMAND.unpack_from(payload)
+            if offset > size:
+                raise ErrorResponse(67, message="The offset is beyond the end of the stream.")
+            length = min(length, size - offset, device.max_response_size - crow.transfer.READ_RESPONSE.size)
+            flags = crow.transfer.END_FLAG if offset + length == size else 0
+            rsp = bytearray(crow.transfer.READ_RESPONSE.pack(crow.transfer.SIGNATURE, code, flags))
+            if length > 0:
+                rsp += memoryview(stream)[offset:offset+length]
+            return rsp
+        else:
+            raise ErrorResponse(70)
+
+
+class AdminService(Service):
+
+    # Responds to the CrowAdmin commands: ping, echo/host_presence, get_device_info,
+    #  get_open_ports, and get_port_info.
+
+    identifier = 'CrowAdmin'
+    description = None
+    VERSION = 1
+
+    def handle(self, device, port, payload, response_expected):
+        if len(payload) == 0:
+            # ping
+            return b''
+        if len(payload) < 3 or payload[0] != 0x43 or payload[1] != 0x41:
+            raise ErrorResponse(65)
+        code = payload[2]
+        if code == 0:
+            # echo (or host_presence when no response is expected)
+            return payload
+        elif code == 1:
+            # get_device_info
+            rsp = bytearray(b'\x43\x41\x01')
+            rsp.append(device.CROW_VERSION)
+            rsp.append(AdminService.VERSION)
+            rsp += device.max_command_size.to_bytes(2, 'big')
+            rsp += device.max_response_size.to_bytes(2, 'big')
+            values = {'impl_identifier': device.impl_identifier, 'impl_description': device.impl_description,
+                      'device_identifier': device.device_identifier, 'device_description': device.device_description}
+            return crow.details.DEVICE_INFO_DETAILS.pack(rsp, values)
+        elif code == 2:
+            # get_open_ports
+            return b'\x43\x41\x02\x00' + bytes(sorted(device.services.keys()))
+        elif code == 3:
+            # get_port_info
+            if len(payload) < 4:
+                raise ErrorResponse(73)
+            service = device.services.get(payload[3])
+            if service is None:
+                return b'\x43\x41\x03\x00'
+            rsp = bytearray(b'\x43\x41\x03')
+            values = {'service_identifier': service.identifier, 'service_description': service.description}
+            return crow.details.PORT_INFO_DETAILS.pack(rsp, values, initial_details=1)
+        else:
+            raise ErrorResponse(70)
+
+
+class ErrorResponse(Exception):
+
+    # Raised by a service to send an error response. The payload is encoded from number and
+    #  the details (keyword arguments recognized by encode_error), unless payload is given.
+
+    def __init__(self, number=0, payload=None, **details):
+        super().__init__(number)
+        if payload is None:
+            payload = encode_error(number, **details)
+        self.payload = payload
+
+
+def encode_error(number, **details):
+    # Returns an error response payload in the format decoded by Host._raise_error. The
+    #  details are the keyword arguments named in crow.details.ERROR_DETAILS (message,
+    #  crow_version, max_command_size, max_response_size, address, port, service_identifier).
+    for name in details:
+        if name not in crow.details.ERROR_DETAILS.names:
+            raise TypeError("encode_error got an unexpected keyword argument '{0}'.".format(name))
+    rsp = bytearray([number])
+    if all(v is None for v in details.values()):
+        return rsp
+    return crow.details.ERROR_DETAILS.pack(rsp, details)
@@ -213,12 +213,28 @@ class ClientError(LocalError):
         return "Client error. " + super().extra_str()
 
 # NoResponseError is raised by the host from send_command when it fails to
-# receive a parseable, expected response.
+# receive a parseable, expected response. cause is one of:
+#   'silence' - no data was received
+#   'corrupt' - the response was recognized, but could not be parsed
+#   'stale_token' - a response with the wrong token was received
+#   'incomplete' - data was received, but not a complete response packet
 class NoResponseError(HostError):
-    def __init__(self, address, port, num_bytes, message=None):
+    def __init__(self, address, port, num_bytes, message=None, cause=None):
         self.num_bytes = num_bytes
+        self.cause = cause
         super().__init__(address, port, message)
     def __str__(self):
         return "No response received before the transaction timed out. Received " + str(self.num_bytes) + " bytes. " + super().extra_str()
 
 
+
+# TransferError is raised by the host from upload and download when a segment fails (and
+#  is not retried). offset is the stream offset up to which the transfer was completed, so
+#  the transfer may be resumed from there. error is the exception that stopped the transfer.
+class TransferError(HostError):
+    def __init__(self, address, port, offset, message=None, error=None):
+        self.offset = offset
+        self.error = error
+        super().__init__(address, port, message)
+    def __str__(self):
+        return "The transfer failed at offset " + str(self.offset) + ". " + super().extra_str()
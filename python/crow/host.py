@@ -7,11 +7,14 @@
 # homepage: http://siedell.com/projects/Crow/
 
 
-import time
 import serial
 import crow.utils
+import crow.capture
+import crow.details
 import crow.parser
 import crow.transaction
+import crow.template
+import crow.transfer
 import crow.errors
 import crow.host_serial
 
@@ -34,11 +37,20 @@ class Host:
         if hasattr(self, '_serial_port'):
             Host._release_serial_port(self._serial_port)
 
+    # Hosts are intended to be lightweight since there may be thousands of them per process.
+    #  The parser, token counter, and transaction pool belong to the HostSerialPort.
+    __slots__ = ('_serial_port', 'custom_service_error_callback', 'retry_policy')
+
     def __init__(self, serial_port_name):
         self._serial_port = Host._retain_serial_port_by_name(serial_port_name)
-        self._next_token = 0
-        self._parser = crow.parser.Parser()
+        # custom_service_error_callback, if not None, is called as
+        #  callback(address, port, number, details, context) when an error response with a
+        #  number 128-255 is received, before the ServiceError is raised. It is called after
+        #  the line has been released, so it may send commands on the same serial port.
         self.custom_service_error_callback = None
+        # retry_policy is an optional crow.retry.RetryPolicy. If it is None the serial
+        #  port's retry_policy is used (which is None by default, meaning no retries).
+        self.retry_policy = None
 
     @property
     def serial_port_name(self):
@@ -56,97 +68,586 @@ class Host:
     def serial_port(self):
         return self._serial_port
 
-    def send_command(self, address=1, port=32, payload=None, response_expected=True, context=None):
+    def send_command(self, address=1, port=32, payload=None, response_expected=True, context=None, idempotent=False, timeout=None, cacheable=False):
         # context is an optional argument. It will be passed to the custom service error
         #  callback if an error response with numbers 128-255 is received.
 
+        # timeout, if given, is the time (in seconds) to wait for the response, in place of
+        #  the serial port's transaction timeout for the address (adaptive or not). It is
+        #  useful for probing addresses that may be empty (see CrowAdmin.survey). Timeouts of
+        #  commands sent with an explicit timeout are not counted by adaptive timeouts.
+
+        # cacheable declares that the command only reads from the device, so its response may
+        #  be shared through the serial port's response_cache, if it has one (see crow.cache).
+        #  A response served from the cache (or from an identical command sent concurrently
+        #  by another host) is returned in a transaction whose cached property is True.
+
+        # idempotent declares that performing the command more than once has the same effect
+        #  as performing it once. Only idempotent commands are retried by the retry policy
+        #  (see crow.retry). The number of attempts made is recorded in the transaction's
+        #  attempts property, or in the attempts property of the exception raised.
+
         # Returns a Transaction object if successful, or raises an exception.
         # The transaction object's response property will be None when response_expected==False,
         #  or a bytes-like object otherwise.
 
-        ser = self._serial_port.serial
+        # Transaction objects are pooled by the HostSerialPort. A transaction that is returned
+        #  may be given back to the pool with release_transaction once it is no longer needed.
+        #  Note that the returned transaction's cmd_packet_buff is shared by the serial port.
+
+        # The serial port's scheduler grants the line to one transaction at a time, so hosts
+        #  in different threads may safely share a serial port.
+
+        if cacheable and response_expected and self._serial_port.response_cache is not None:
+            return self._send_cached(address, port, payload, context, idempotent, timeout)
+        return self._send(address, port, payload, None, response_expected, context, idempotent, timeout)
+
+    def send_template(self, template, values=None, context=None, idempotent=False, timeout=None):
+        # Sends the command prepared as template (a crow.template.CommandTemplate), with the
+        #  given field values (a dictionary, see CommandTemplate). The other arguments and the
+        #  return value are the same as for send_command.
+        # Encoding a template only patches the token, the header check bytes, and the fields,
+        #  so this is the cheapest way to send the same command repeatedly.
+        return self._send(template.address, template.port, template, values, template.response_expected, context, idempotent, timeout)
+
+    def _send_cached(self, address, port, payload, context, idempotent, timeout):
+        # Performs send_command for a cacheable command.
+        sp = self._serial_port
+        send = lambda: self._send(address, port, payload, None, True, context, idempotent, timeout)
+        t, response = sp.response_cache.fetch(address, port, payload, sp.clock(), send)
+        if t is None:
+            t = self._cached_transaction(address, port, payload, response)
+        return t
+
+    def _cached_transaction(self, address, port, payload, response):
+        # Returns a transaction for a response that was not received by this host. The
+        #  transaction comes from the pool, so every field that the send path sets is reset
+        #  (no command was sent, so there is no token, packet, or start time).
+        t = self._serial_port.acquire_transaction()
+        t.address = address
+        t.port = port
+        t.command = payload
+        t.response_expected = True
+        t.token = 0
+        t.propcr_order = False
+        t.response = response
+        t.cmd_packet_size = 0
+        t.start_time = 0.0
+        t.timeout = None
+        t.template = None
+        t.template_values = None
+        t.attempts = 0
+        t.cached = True
+        return t
+
+    def _send(self, address, port, payload, values, response_expected, context, idempotent, timeout):
+        # Performs send_command or send_template (payload is then the template), including retries.
+        policy = self._get_retry_policy(idempotent, response_expected)
+        attempts = 1
+        while True:
+            try:
+                t = self._send_once(address, port, payload, values, response_expected, context, timeout)
+            except crow.errors.CrowError as e:
+                e.attempts = attempts
+                self._call_error_callback(e)
+                if policy is None or not policy.should_retry(e, attempts):
+                    raise
+                # The line is not held while waiting, so other hosts may use it.
+                self._note_retry(address, port)
+                self._serial_port.sleep(policy.delay(attempts))
+                attempts += 1
+                continue
+            t.attempts = attempts
+            return t
 
-        baudrate = self._serial_port.get_baudrate(address)
-        transaction_timeout = self._serial_port.get_transaction_timeout(address)
-        propcr_order = self._serial_port.get_propcr_order(address)
+    def _send_once(self, address, port, payload, values, response_expected, context, timeout):
+        # Performs one attempt of send_command or send_template.
+        sp = self._serial_port
+        with sp.scheduler.slot(self, address):
+            t = sp.acquire_transaction()
+            try:
+                if isinstance(payload, crow.template.CommandTemplate):
+                    self._encode_template(t, payload, values)
+                else:
+                    self._encode(t, address, port, payload, response_expected)
+                t.timeout = timeout
+                self._transmit(t)
+                if response_expected:
+                    self._receive_response(t, context)
+                return t
+            except BaseException:
+                sp.release_transaction(t)
+                raise
+
+    def send_batch(self, commands, context=None):
+        # Sends a sequence of commands, one after another, and returns a list with one item
+        #  per command: the Transaction if the command succeeded, or the exception that
+        #  send_command would have raised. The batch does not stop at a failed command.
+        # commands is an iterable of (address, port, payload) or
+        #  (address, port, payload, response_expected) tuples. context is used as in send_command.
+        # To keep the line busy, each command packet is encoded while the response to the
+        #  previous command is on its way, so it can be written as soon as that response has
+        #  been received. The line is still acquired separately for each command, so other
+        #  hosts get their turns. If another host used the line in between, the command
+        #  packet is encoded again before it is written.
+
+        sp = self._serial_port
+        commands = list(commands)
+        num_commands = len(commands)
+        results = []
+        next_t = None
+
+        for i in range(num_commands):
+
+            with sp.scheduler.slot(self, Host._batch_command_address(commands[i])):
+
+                if next_t is None:
+                    next_t = self._encode_batch_command(commands[i])
+                t = next_t
+                next_t = None
+
+                if isinstance(t, crow.transaction.Transaction):
+                    try:
+                        self._transmit(t)
+                    except Exception as e:
+                        sp.release_transaction(t)
+                        t = e
+
+                # Encode the next command while the device works on the current one.
+                if i + 1 < num_commands:
+                    next_t = self._encode_batch_command(commands[i+1])
+
+                if isinstance(t, crow.transaction.Transaction) and t.response_expected:
+                    try:
+                        self._receive_response(t, context)
+                    except Exception as e:
+                        sp.release_transaction(t)
+                        t = e
+
+            if isinstance(t, crow.errors.ServiceError):
+                try:
+                    self._call_error_callback(t)
+                except Exception as e:
+                    t = e
+
+            results.append(t)
+
+        return results
+
+    def upload(self, address, port, data, stream=0, offset=0, resume=False, segment_size=None, timeout=None):
+        # Writes data (a bytes-like object, e.g. an mmap of a file) to a stream of the device's
+        #  transfer service on port (see crow.transfer and crow.device.TransferService),
+        #  starting at offset in data and in the stream. The stream is truncated at offset, so
+        #  an upload from offset 0 replaces the stream's contents.
+        # If resume is True the upload continues from the stream's current size instead
+        #  (e.g. after a TransferError, whose offset property tells how far the upload got).
+        # segment_size is the number of data bytes per command. By default segments are as
+        #  large as the device's max_command_size allows (found with the CrowAdmin
+        #  get_device_info command, which is cached if the serial port has a response_cache).
+        # Returns a crow.transfer.TransferResult. Raises TransferError if a segment fails and
+        #  is not retried.
+        data = memoryview(data).cast('B')
+        if resume:
+            offset = self.get_stream_size(address, port, stream, timeout)
+        if offset < 0 or offset > len(data):
+            raise ValueError("offset must be within data.")
+        if segment_size is None:
+            segment_size = self._get_device_limits(address, timeout)[0] - crow.transfer.WRITE_COMMAND.size
+        if segment_size < 1:
+            raise ValueError("The segment size must be at least 1.")
+        end = len(data)
+
+        def make(offset, buff):
+            return crow.transfer.pack_write(buff, stream, offset, data[offset:min(offset + segment_size, end)])
+
+        def predict(offset):
+            next_offset = offset + segment_size
+            return next_offset if next_offset < end else None
+
+        def on_response(offset, response):
+            expected = min(offset + segment_size, end)
+            size = crow.transfer.parse_size_response(response, crow.transfer.WRITE)
+            if size != expected:
+                raise RuntimeError("The device reported a stream size of {0} bytes instead of {1}.".format(size, expected))
+            return size if size < end else None
+
+        buff_size = crow.transfer.WRITE_COMMAND.size + segment_size
+        start_offset = offset
+        num_segments, num_retries, offset, elapsed = self._transfer(address, port, offset, make, predict, on_response, buff_size, timeout)
+        return crow.transfer.TransferResult(end - start_offset, end, num_segments, num_retries, elapsed)
+
+    def download(self, address, port, stream=0, offset=0, size=None, sink=None, segment_size=None, timeout=None):
+        # Reads a stream of the device's transfer service on port (see upload), starting at
+        #  offset and continuing to the end of the stream, or until size bytes are read.
+        # If sink (an object with a write method, e.g. a file) is given the data is written
+        #  to it as it arrives. Otherwise it is returned in the result's data property. An
+        #  interrupted download may be resumed by calling download again with offset advanced
+        #  by the number of bytes received (the offset property of the TransferError).
+        # segment_size is the number of data bytes requested per command. By default it is
+        #  the most that fits in the device's max_response_size.
+        # Returns a crow.transfer.TransferResult. Raises TransferError if a segment fails and
+        #  is not retried.
+        if offset < 0:
+            raise ValueError("offset must not be negative.")
+        if segment_size is None:
+            segment_size = self._get_device_limits(address, timeout)[1] - crow.transfer.READ_RESPONSE.size
+        if segment_size < 1 or segment_size > 0xffff:
+            raise ValueError("The segment size must be 1 to 65535.")
+        end = offset + size if size is not None else None
+        collected = None
+        if sink is None:
+            collected = bytearray()
+            write = collected.extend
+        else:
+            write = sink.write
+        position = [offset]
+
+        def make(offset, buff):
+            length = segment_size if end is None else min(segment_size, end - offset)
+            return crow.transfer.pack_read(buff, stream, offset, length)
+
+        def predict(offset):
+            next_offset = offset + segment_size
+            return next_offset if end is None or next_offset < end else None
+
+        def on_response(offset, response):
+            at_end, chunk = crow.transfer.parse_read_response(response)
+            if len(chunk) > 0:
+                write(chunk)
+            offset += len(chunk)
+            position[0] = offset
+            if at_end or offset == end:
+                return None
+            if len(chunk) == 0:
+                raise RuntimeError("The device returned no data before the end of the stream.")
+            return offset
+
+        if end == offset:
+            return crow.transfer.TransferResult(0, offset, 0, 0, 0.0, b'' if sink is None else None)
+        num_segments, num_retries, _, elapsed = self._transfer(address, port, offset, make, predict, on_response, crow.transfer.READ_COMMAND.size, timeout)
+        return crow.transfer.TransferResult(position[0] - offset, position[0], num_segments, num_retries, elapsed, bytes(collected) if sink is None else None)
+
+    def get_stream_size(self, address, port, stream=0, timeout=None):
+        """Returns the size of a stream of the device's transfer service on port."""
+        t = self.send_command(address, port, crow.transfer.pack_status(stream), idempotent=True, timeout=timeout)
+        try:
+            return crow.transfer.parse_size_response(t.response, crow.transfer.STATUS)
+        finally:
+            self.release_transaction(t)
+
+    def _get_device_limits(self, address, timeout):
+        # Returns the device's (max_command_size, max_response_size).
+        t = self.send_command(address, 0, b'\x43\x41\x01', idempotent=True, timeout=timeout, cacheable=True)
+        try:
+            return crow.transfer.parse_device_limits(t.response)
+        finally:
+            self.release_transaction(t)
+
+    def _transfer(self, address, port, offset, make, predict, on_response, buff_size, timeout):
+        # Performs the segments of upload or download, starting with the segment at offset.
+        #   make(offset, buff) - encodes the command payload for the segment at offset into
+        #    buff (a bytearray of buff_size bytes), returning a view of it
+        #   predict(offset) - returns the offset of the segment that will follow the one at
+        #    offset if it succeeds, or None if it is the last one
+        #   on_response(offset, response) - handles the response to the segment at offset,
+        #    returning the offset of the next segment, or None if the transfer is done (it
+        #    raises RuntimeError if the response is malformed or unexpected)
+        # As in send_batch, the next segment is encoded while the device works on the current
+        #  one, so there is no gap on the host side between a response and the next command.
+        #  If the prediction turns out wrong (or a segment is retried) the segment is
+        #  encoded again. Segments are idempotent, so the retry policy applies to them.
+        # Returns (num_segments, num_retries, offset, elapsed).
+        sp = self._serial_port
+        policy = self._get_retry_policy(True, True)
+        # Two payload buffers: one for the segment in progress and one for the next.
+        buffs = (bytearray(buff_size), bytearray(buff_size))
+        current = 0
+        next_t = None
+        next_offset = None
+        num_segments = 0
+        num_retries = 0
+        attempts = 1
+        error = None
+        start = sp.clock()
+        try:
+            while offset is not None:
+                with sp.scheduler.slot(self, address):
+                    if next_t is not None and next_offset == offset:
+                        t = next_t
+                        current = 1 - current
+                    else:
+                        if next_t is not None:
+                            sp.release_transaction(next_t)
+                        t = self._encode_segment(address, port, make(offset, buffs[current]), timeout)
+                    next_t = None
+                    try:
+                        self._transmit(t)
+                        next_offset = predict(offset)
+                        if next_offset is not None:
+                            next_t = self._encode_segment(address, port, make(next_offset, buffs[1 - current]), timeout)
+                        self._receive_response(t, None)
+                        new_offset = on_response(offset, t.response)
+                    except crow.errors.CrowError as e:
+                        e.attempts = attempts
+                        error = e
+                        if policy is None or not policy.should_retry(e, attempts):
+                            raise crow.errors.TransferError(address, port, offset, "A segment failed (" + e.__class__.__name__ + ").", e) from e
+                    except RuntimeError as e:
+                        # A malformed or unexpected segment response (from on_response).
+                        raise crow.errors.TransferError(address, port, offset, str(e), e) from e
+                    else:
+                        num_segments += 1
+                        attempts = 1
+                        offset = new_offset
+                        continue
+                    finally:
+                        sp.release_transaction(t)
+                self._call_error_callback(error)
+                # The line is not held while waiting, so other hosts may use it.
+                self._note_retry(address, port)
+                num_retries += 1
+                sp.sleep(policy.delay(attempts))
+                attempts += 1
+        except crow.errors.TransferError:
+            self._call_error_callback(error)
+            raise
+        finally:
+            if next_t is not None:
+                sp.release_transaction(next_t)
+        return num_segments, num_retries, offset, sp.clock() - start
+
+    def _encode_segment(self, address, port, payload, timeout):
+        # Returns a transaction with a transfer segment command encoded.
+        sp = self._serial_port
+        t = sp.acquire_transaction()
+        try:
+            self._encode(t, address, port, payload, True)
+        except BaseException:
+            sp.release_transaction(t)
+            raise
+        t.timeout = timeout
+        return t
+
+    def _get_retry_policy(self, idempotent, response_expected):
+        # Returns the retry policy that applies to a command, or None if it must not be retried.
+        if not idempotent or not response_expected:
+            return None
+        if self.retry_policy is not None:
+            return self.retry_policy
+        return self._serial_port.retry_policy
+
+    def _call_error_callback(self, error):
+        # Calls the custom service error callback for an error raised by _raise_error. This is
+        #  done after the line has been released, since the scheduler's slot is not reentrant
+        #  and the callback may send commands on the same serial port.
+        pending = getattr(error, '_pending_callback', None)
+        if pending is not None:
+            del error._pending_callback
+            callback, args = pending
+            callback(*args)
+
+    def _note_retry(self, address, port):
+        metrics = self._serial_port.metrics
+        if metrics.enabled:
+            metrics.record_retry(address, port)
+
+    def release_transaction(self, transaction):
+        """Returns a transaction obtained from send_command to the serial port's pool for reuse."""
+        # The transaction must not be used after it is released.
+        self._serial_port.release_transaction(transaction)
 
+    @staticmethod
+    def _batch_command_address(command):
+        # Returns the address of a send_batch item, for scheduling purposes only.
+        try:
+            return command[0]
+        except (TypeError, IndexError):
+            return None
+
+    def _encode_batch_command(self, command):
+        # Returns a Transaction with the encoded command (a send_batch item), or the
+        #  exception raised while trying to encode it.
+        sp = self._serial_port
+        t = sp.acquire_transaction()
+        try:
+            self._encode(t, *command)
+        except Exception as e:
+            sp.release_transaction(t)
+            return e
+        return t
+
+    def _encode(self, t, address=1, port=32, payload=None, response_expected=True):
+        # Encodes a new command into the transaction using the serial port's settings for the address.
+        sp = self._serial_port
+        t.new_command(address, port, payload, response_expected, sp.next_token(), sp.get_propcr_order(address))
+        sp.cmd_packet_owner = t
+
+    def _encode_template(self, t, template, values):
+        # Encodes a CommandTemplate into the transaction.
+        sp = self._serial_port
+        template.encode(t, sp.next_token(), values, sp.get_propcr_order(template.address))
+        sp.cmd_packet_owner = t
+
+    def _transmit(self, t):
+        # Writes the transaction's command packet to the serial port.
+        sp = self._serial_port
+        ser = sp.serial
+        if sp.cmd_packet_owner is not t:
+            # Another transaction has used the shared buffer since this one was encoded.
+            if t.template is not None:
+                t.template.encode(t, t.token, t.template_values, t.propcr_order)
+            else:
+                t.new_command(t.address, t.port, t.command, t.response_expected, t.token, t.propcr_order)
+            sp.cmd_packet_owner = t
         ser.reset_input_buffer()
-        ser.baudrate = baudrate
-
-        token = (self._next_token%256 + 256)%256
-        self._next_token = (self._next_token + 1)%256
-
-        t = crow.transaction.Transaction()
-        t.new_command(address, port, payload, response_expected, token, propcr_order)
-
-        ser.write(t.cmd_packet_buff[0:t.cmd_packet_size])
-
-        if not response_expected:
-            return t
-
-        self._parser.reset()
+        sp.apply_baudrate(t.address)
+        self._command_sent(t)
+        ser.write(t.cmd_packet)
+        if sp.capture is not None:
+            sp.capture.record(crow.capture.TX, t.cmd_packet, t.start_time)
+
+    def _command_sent(self, t):
+        # Called when the transaction's command packet is written. Starts the transaction's
+        #  clock and updates the metrics.
+        sp = self._serial_port
+        t.start_time = sp.clock()
+        metrics = sp.metrics
+        if metrics.enabled:
+            metrics.record_command(t.address, t.port, t.cmd_packet_size)
+
+    def _receive_response(self, t, context):
+        # Waits for the response to the transaction's command. On success the response
+        #  payload is assigned to t.response, otherwise an exception is raised.
+
+        address = t.address
+        token = t.token
+        sp = self._serial_port
+        ser = sp.serial
+        parser = sp.parser
+        baudrate = sp.get_baudrate(address)
+
+        parser.reset()
 
         # The time limit is
         #  <time start receiving> + <transaction timeout> + <time to transmit rec'd data at baudrate, up to 2084 bytes>.
-        bits_per_byte = 10.0
-        if ser.stopbits == serial.STOPBITS_ONE_POINT_FIVE:
-            bits_per_byte += 0.5
-        elif ser.stopbits == serial.STOPBITS_TWO:
-            bits_per_byte += 1.0
-        seconds_per_byte = bits_per_byte / baudrate
-        now = time.perf_counter()
+        seconds_per_byte = Host._seconds_per_byte(ser, baudrate)
+        transaction_timeout = self._get_response_timeout(t, seconds_per_byte)
+        now = sp.clock()
         time_limit = now + transaction_timeout
         max_time_limit = time_limit + seconds_per_byte*2084
 
         byte_count = 0
         results = []
+        capture = sp.capture
+        # The extraneous and leftover bytes are only used by the metrics.
+        ignore = not sp.metrics.enabled
         
-        while self._parser.min_bytes_expected > 0 and now < time_limit:
+        while parser.min_bytes_expected > 0 and now < time_limit:
             
             ser.timeout = time_limit - now 
-            data = ser.read(self._parser.min_bytes_expected)
+            data = ser.read(parser.min_bytes_expected)
             byte_count += len(data)
-            results += self._parser.parse_data(data, token)
+            results += parser.parse_data(data, token, ignore_extra=ignore, ignore_leftover=ignore)
             
             time_limit = min(time_limit + seconds_per_byte*len(data), max_time_limit)
-            now = time.perf_counter()
+            now = sp.clock()
+            if capture is not None and len(data) > 0:
+                capture.record(crow.capture.RX, data, now)
+
+        self._record_response_time(t, byte_count, parser.min_bytes_expected == 0, seconds_per_byte)
+        self._process_results(t, results, byte_count, parser.min_bytes_expected == 0, context)
+
+    def _get_response_timeout(self, t, seconds_per_byte):
+        # Returns the time to wait for the response to the transaction's command.
+        cmd_wire_time = seconds_per_byte*t.cmd_packet_size
+        if t.timeout is not None:
+            return t.timeout + cmd_wire_time
+        return self._serial_port.get_response_timeout(t.address, t.port, cmd_wire_time)
+
+    def _record_response_time(self, t, byte_count, response_received, seconds_per_byte):
+        # Updates the serial port's response time estimates (used for adaptive timeouts) at
+        #  the end of waiting for a response.
+        sp = self._serial_port
+        if response_received:
+            # The time spent transmitting the packets is not part of the response time.
+            elapsed = sp.clock() - t.start_time
+            wire_time = seconds_per_byte*(t.cmd_packet_size + byte_count)
+            sp.record_response_time(t.address, t.port, max(0.0, elapsed - wire_time))
+        elif byte_count == 0 and t.timeout is None:
+            sp.record_response_timeout(t.address, t.port)
 
-        # The parser returns a list of a results, where each item is an dictionary
-        #  with a 'type' property. See the comments to Parser.parse_data for details.
+    @staticmethod
+    def _seconds_per_byte(ser, baudrate):
+        # Returns the time taken to transmit one byte at the given baudrate.
+        bits_per_byte = 10.0
+        if ser.stopbits == serial.STOPBITS_ONE_POINT_FIVE:
+            bits_per_byte += 0.5
+        elif ser.stopbits == serial.STOPBITS_TWO:
+            bits_per_byte += 1.0
+        return bits_per_byte / baudrate
+
+    def _process_results(self, t, results, byte_count, response_received, context):
+        # Examines the parser results collected while waiting for the response to the
+        #  transaction's command. response_received should be True if the parser signalled
+        #  that the response with the expected token was received. On success the response
+        #  payload is assigned to t.response, otherwise an exception is raised.
+        # The outcome is recorded in the serial port's metrics.
+        sp = self._serial_port
+        metrics = sp.metrics
+        if not metrics.enabled:
+            self._check_results(t, results, byte_count, response_received, context)
+            return
+        try:
+            self._check_results(t, results, byte_count, response_received, context)
+        except crow.errors.CrowError as e:
+            metrics.record_response(t.address, t.port, t.token, sp.clock() - t.start_time, byte_count, results, e)
+            raise
+        metrics.record_response(t.address, t.port, t.token, sp.clock() - t.start_time, byte_count, results)
+
+    def _check_results(self, t, results, byte_count, response_received, context):
+        # The body of _process_results.
+
+        address = t.address
+        port = t.port
+        token = t.token
+
+        # The parser returns a list of a results, where each item is a ParserResult
+        #  with a type property. See the comments to Parser.parse_data for details.
+        RESPONSE = crow.parser.ResultType.RESPONSE
         
-        if self._parser.min_bytes_expected == 0:
+        if response_received:
             # The parser sets min_bytes_expected==0 to signify that an expected
             #  response (identified by token) was received.
             # Currently we are ignoring other items in results besides the expected
             #  response (i.e. other responses, extraneous bytes, leftovers, etc.).
             # todo: consider adding warnings for unexpected parser results
             for item in results:
-                if item['type'] == 'response':
-                    if item['token'] == token:
+                if item.type == RESPONSE:
+                    if item.token == token:
                         # The expected response was parseable, and is described by item.
-                        t.response = item['payload']
-                        if item['is_error']:
+                        t.response = item.payload
+                        if item.is_error:
                             # error response
                             self._raise_error(t, context)
                         else:
                             # normal response
-                            return t
-                elif item['type'] == 'error':
-                    if item['token'] == token:
+                            return
+                elif item.type == crow.parser.ResultType.ERROR:
+                    if item.token == token:
                         # The expected response was recognized, but could not be
                         #  parsed. item describes the error.
-                        raise crow.errors.NoResponseError(address, port, byte_count, item['message'])
+                        raise crow.errors.NoResponseError(address, port, byte_count, item.message, 'corrupt')
             raise RuntimeError("Programming error. Expected to find a response with the correct token in parser results, but none was found.")
         else:
             # Failed to receive a response with the expected token.
             if byte_count == 0:
                 # No data received at all.
-                raise crow.errors.NoResponseError(address, port, byte_count)
+                raise crow.errors.NoResponseError(address, port, byte_count, cause='silence')
             for item in results:
-                if item['type'] == 'response':
-                    if item['token'] != token:
+                if item.type == RESPONSE:
+                    if item.token != token:
                         # A parseable response with incorrect token was received.
-                        raise crow.errors.NoResponseError(address, port, byte_count, "An invalid response was received (incorrect token). It may be a stale response, or the responding device may have malfunctioned.")
+                        raise crow.errors.NoResponseError(address, port, byte_count, "An invalid response was received (incorrect token). It may be a stale response, or the responding device may have malfunctioned.", 'stale_token')
                     else:
                         raise RuntimeError("Programming error. Should not have a response with the correct token in the parser results at this point.")
             # To get to this point, some data must have been received, but the parser was unable
@@ -154,7 +655,7 @@ class Host:
             #  corrupt or not.
             # todo: consider adding a message to the error based on the final parser state
             #  and the parser results
-            raise crow.errors.NoResponseError(address, port, byte_count)
+            raise crow.errors.NoResponseError(address, port, byte_count, cause='incomplete')
 
 
     def _raise_error(self, transaction, context):
@@ -177,26 +678,11 @@ class Host:
         # info will hold any additional details included in the error.
         info = {}
     
-        # Optional byte E1 is a bitfield that specifies what additional details are included.
+        # Optional byte E1 is a bitfield that specifies what additional details are included
+        #  (see crow.details).
         if len(response) >= 2:
-            E1 = response[1]
-            transaction.arg_index = 2
             try:
-                # The unpack_* functions will raise RuntimeError on parsing errors.
-                if E1 & 1:
-                    crow.utils.unpack_ascii(info, transaction, 4, 'message', rsp_name)
-                if E1 & 2:
-                    crow.utils.unpack_int(info, transaction, 1, 'crow_version', rsp_name)
-                if E1 & 4:
-                    crow.utils.unpack_int(info, transaction, 2, 'max_command_size', rsp_name)
-                if E1 & 8:
-                    crow.utils.unpack_int(info, transaction, 2, 'max_response_size', rsp_name)
-                if E1 & 16:
-                    crow.utils.unpack_int(info, transaction, 1, 'address', rsp_name)
-                if E1 & 32:
-                    crow.utils.unpack_int(info, transaction, 1, 'port', rsp_name)
-                if E1 & 64:
-                    crow.utils.unpack_ascii(info, transaction, 3, 'service_identifier', rsp_name)
+                crow.details.ERROR_DETAILS.decode(response, 2, response[1], info, rsp_name)
             except RuntimeError as e:
                 # If the RemoteError response can not be parsed it gets superceded by a HostError.
                 raise crow.errors.HostError(address, port, str(e))
@@ -250,9 +736,11 @@ class Host:
         elif number >= 75 and number < 128:
             raise crow.errors.UnknownServiceError(address, port, number, info)
         elif number >= 128 and number < 256:
+            error = crow.errors.ServiceError(address, port, number, info)
             if self.custom_service_error_callback is not None:
-                self.custom_service_error_callback(address, port, number, info, context)
-            raise crow.errors.ServiceError(address, port, number, info)
+                # The callback is called by _call_error_callback, once the line is released.
+                error._pending_callback = (self.custom_service_error_callback, (address, port, number, info, context))
+            raise error
       
         raise RuntimeError("Programming error. A remote error (number " + str(number) + ") was not handled.")
     
@@ -302,6 +790,14 @@ class Host:
                 return
         raise RuntimeError("The serial port is not in use by any host.")
 
+    @staticmethod
+    def set_adaptive_timeout(serial_port_name, address, adaptive_timeout):
+        for sp in Host._serial_ports:
+            if sp.name == serial_port_name:
+                sp.set_adaptive_timeout(address, adaptive_timeout)
+                return
+        raise RuntimeError("The serial port is not in use by any host.")
+
     @staticmethod
     def set_propcr_order(serial_port_name, address, propcr_order):
         for sp in Host._serial_ports:
@@ -0,0 +1,183 @@
+# host_async.py
+# Crow Host Implementation for asyncio
+# project: https://pypi.org/project/crow-serial/
+# source: https://github.com/chris-siedell/PyCrow
+# homepage: http://siedell.com/projects/Crow/
+
+
+import asyncio
+import os
+import crow.capture
+import crow.errors
+import crow.host
+import crow.template
+
+
+class AsyncHost(crow.host.Host):
+
+    # AsyncHost is a Host whose send_command is a coroutine. Instead of blocking the
+    #  calling thread while waiting for a response it waits on the serial port's file
+    #  descriptor using the running event loop, so one loop can drive many serial ports.
+    # AsyncHost uses the same HostSerialPort objects as Host, so the per-address settings
+    #  (baudrate, transaction_timeout, propcr_order) and the timeout semantics are the same.
+    # The file descriptor is read and written directly, so AsyncHost requires a POSIX
+    #  system (where serial.Serial has a fileno method). The serial port must be open.
+    # The line is acquired from the serial port's scheduler without blocking the event
+    #  loop, so AsyncHost and Host instances (in other threads) may share a serial port.
+
+    __slots__ = ()
+
+    async def send_command(self, address=1, port=32, payload=None, response_expected=True, context=None, idempotent=False, timeout=None, cacheable=False):
+        # The arguments and the return value are the same as for Host.send_command.
+        if cacheable and response_expected and self._serial_port.response_cache is not None:
+            sp = self._serial_port
+            send = lambda: self._send_async(address, port, payload, None, True, context, idempotent, timeout)
+            t, response = await sp.response_cache.fetch_async(address, port, payload, sp.clock(), send)
+            if t is None:
+                t = self._cached_transaction(address, port, payload, response)
+            return t
+        return await self._send_async(address, port, payload, None, response_expected, context, idempotent, timeout)
+
+    async def send_template(self, template, values=None, context=None, idempotent=False, timeout=None):
+        # The arguments and the return value are the same as for Host.send_template.
+        return await self._send_async(template.address, template.port, template, values, template.response_expected, context, idempotent, timeout)
+
+    async def _send_async(self, address, port, payload, values, response_expected, context, idempotent, timeout):
+        # The coroutine counterpart of Host._send.
+        policy = self._get_retry_policy(idempotent, response_expected)
+        attempts = 1
+        while True:
+            try:
+                t = await self._send_once_async(address, port, payload, values, response_expected, context, timeout)
+            except crow.errors.CrowError as e:
+                e.attempts = attempts
+                self._call_error_callback(e)
+                if policy is None or not policy.should_retry(e, attempts):
+                    raise
+                self._note_retry(address, port)
+                await asyncio.sleep(policy.delay(attempts))
+                attempts += 1
+                continue
+            t.attempts = attempts
+            return t
+
+    async def _send_once_async(self, address, port, payload, values, response_expected, context, timeout):
+        # Performs one attempt of send_command or send_template.
+        sp = self._serial_port
+        await sp.scheduler.acquire_async(self, address)
+        try:
+            t = sp.acquire_transaction()
+            try:
+                if isinstance(payload, crow.template.CommandTemplate):
+                    self._encode_template(t, payload, values)
+                else:
+                    self._encode(t, address, port, payload, response_expected)
+                t.timeout = timeout
+                await self._transmit_async(t)
+                if response_expected:
+                    await self._receive_response_async(t, context)
+                return t
+            except BaseException:
+                sp.release_transaction(t)
+                raise
+        finally:
+            sp.scheduler.release()
+
+    async def _transmit_async(self, t):
+        # Writes the transaction's command packet without blocking the event loop.
+        sp = self._serial_port
+        ser = sp.serial
+        ser.reset_input_buffer()
+        sp.apply_baudrate(t.address)
+        fd = ser.fileno()
+        self._command_sent(t)
+        data = t.cmd_packet
+        if sp.capture is not None:
+            sp.capture.record(crow.capture.TX, data, t.start_time)
+        while len(data) > 0:
+            try:
+                num = os.write(fd, data)
+                data = data[num:]
+            except BlockingIOError:
+                await AsyncHost._wait_for_fd(fd, True, None)
+
+    async def _receive_response_async(self, t, context):
+        # The coroutine counterpart of Host._receive_response.
+
+        address = t.address
+        token = t.token
+        sp = self._serial_port
+        ser = sp.serial
+        parser = sp.parser
+        baudrate = sp.get_baudrate(address)
+        fd = ser.fileno()
+
+        parser.reset()
+
+        # The time limit is determined the same way as for Host._receive_response.
+        seconds_per_byte = crow.host.Host._seconds_per_byte(ser, baudrate)
+        transaction_timeout = self._get_response_timeout(t, seconds_per_byte)
+        now = sp.clock()
+        time_limit = now + transaction_timeout
+        max_time_limit = time_limit + seconds_per_byte*2084
+
+        byte_count = 0
+        results = []
+        capture = sp.capture
+        ignore = not sp.metrics.enabled
+
+        while parser.min_bytes_expected > 0 and now < time_limit:
+
+            data = await AsyncHost._read(fd, parser.min_bytes_expected, time_limit - now)
+            byte_count += len(data)
+            results += parser.parse_data(data, token, ignore_extra=ignore, ignore_leftover=ignore)
+
+            time_limit = min(time_limit + seconds_per_byte*len(data), max_time_limit)
+            now = sp.clock()
+            if capture is not None and len(data) > 0:
+                capture.record(crow.capture.RX, data, now)
+
+        self._record_response_time(t, byte_count, parser.min_bytes_expected == 0, seconds_per_byte)
+        self._process_results(t, results, byte_count, parser.min_bytes_expected == 0, context)
+
+    @staticmethod
+    async def _read(fd, max_bytes, timeout):
+        # Returns up to max_bytes from fd, waiting up to timeout seconds for data to arrive.
+        #  Returns an empty bytes object if there was no data.
+        try:
+            data = os.read(fd, max_bytes)
+            if len(data) > 0:
+                return data
+        except BlockingIOError:
+            pass
+        if not await AsyncHost._wait_for_fd(fd, False, timeout):
+            return b''
+        try:
+            return os.read(fd, max_bytes)
+        except BlockingIOError:
+            return b''
+
+    @staticmethod
+    async def _wait_for_fd(fd, for_write, timeout):
+        # Waits until fd is readable (or writable if for_write is True). Returns False if
+        #  timeout (in seconds, or None for no limit) expires first.
+        loop = asyncio.get_running_loop()
+        ready = loop.create_future()
+        def callback():
+            if not ready.done():
+                ready.set_result(True)
+        if for_write:
+            loop.add_writer(fd, callback)
+        else:
+            loop.add_reader(fd, callback)
+        try:
+            await asyncio.wait_for(ready, timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            if for_write:
+                loop.remove_writer(fd)
+            else:
+                loop.remove_reader(fd)
+
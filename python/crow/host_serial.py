@@ -5,7 +5,25 @@
 # source: https://github.com/chris-siedell/PyCrow
 
 
+import time
 import serial
+import crow.capture
+import crow.metrics
+import crow.parser
+import crow.scheduler
+import crow.transaction
+import crow.transport
+
+
+# Serial factories allow objects other than serial.Serial instances to be used for
+#  specific serial port names. These functions are kept for compatibility -- see
+#  crow.transport for the general mechanism.
+
+def register_serial_factory(serial_port_name, factory):
+    crow.transport.register_factory(serial_port_name, factory)
+
+def unregister_serial_factory(serial_port_name):
+    crow.transport.unregister_factory(serial_port_name)
 
 
 class HostSerialPort():
@@ -23,17 +41,66 @@ class HostSerialPort():
     #  the change to be applied to all addresses.
     ALL = -1
 
+    # The maximum number of idle Transaction objects kept for reuse by the port.
+    MAX_POOLED_TRANSACTIONS = 8
+
+    # Adaptive timeouts follow the TCP retransmission timer (RFC 6298): per address and port
+    #  the host keeps a smoothed response time (srtt) and its mean deviation (rttvar), and
+    #  waits srtt + ADAPTIVE_K*rttvar for a response, bounded below by min_adaptive_timeout
+    #  and above by the address's transaction_timeout. Each timeout doubles the wait for the
+    #  next transaction (up to the upper bound) until a response arrives. Adaptive timeouts
+    #  are off by default, and are turned on with set_adaptive_timeout.
+    ADAPTIVE_ALPHA = 0.125
+    ADAPTIVE_BETA = 0.25
+    ADAPTIVE_K = 4
+
     def __init__(self, serial_port_name, baudrate=115200, transaction_timeout=0.25, propcr_order=False, _magic_word=None):
         if _magic_word != "abracadabra":
             raise RuntimeError("Cannot create HostSerialPort instance. HostSerialPort instances are created internally by the Host class.")
         self.retain_count = None
-        self._serial = serial.Serial(serial_port_name)
+        # The transport is a serial.Serial instance for ordinary serial port names (see
+        #  crow.transport for the alternatives).
+        self._serial = crow.transport.open_transport(serial_port_name)
+        # The clock used to time transactions, and the sleep function used to wait between
+        #  retries. A serial object may provide its own (e.g. a simulated serial port running
+        #  on a virtual clock).
+        self.clock = getattr(self._serial, 'clock', time.perf_counter)
+        self.sleep = getattr(self._serial, 'sleep', time.sleep)
         self._settings = []
         for i in range(0, 32):
             self._settings.append(HostSerialSettings());
         self.default_baudrate = baudrate
         self.default_transaction_timeout = transaction_timeout
         self.default_propcr_order = propcr_order
+        self.default_adaptive_timeout = False
+        # The lower bound for adaptive timeouts, in seconds. It should allow for the
+        #  scheduling jitter of the host and the serial port driver.
+        self.min_adaptive_timeout = 0.005
+        self._response_times = {}
+        # The scheduler grants the line to one transaction at a time. The parser, the token
+        #  counter, and the command packet buffer are shared by all hosts using the serial
+        #  port, and must only be used by the holder of the line. The scheduler is given the
+        #  per-address baudrates so that it can group waiting transactions by baudrate.
+        self.scheduler = crow.scheduler.TransactionScheduler(self.get_baudrate)
+        self.num_baudrate_changes = 0
+        self.parser = crow.parser.Parser()
+        self._next_token = 0
+        self._cmd_packet_buff = bytearray(2086)
+        self._transaction_pool = []
+        # cmd_packet_owner is the transaction whose command packet is currently encoded in
+        #  the shared buffer. Host.send_batch encodes the next command before the line is
+        #  granted for it, so it uses this to detect that the packet must be encoded again.
+        self.cmd_packet_owner = None
+        # The retry policy for hosts that do not have their own (see crow.retry).
+        self.retry_policy = None
+        # An optional crow.cache.ResponseCache for cacheable commands (None means no caching).
+        self.response_cache = None
+        # An optional crow.capture.CaptureWriter that records the bytes written and read by
+        #  hosts (see start_capture). A capture holds one line's traffic, so the writer must
+        #  not be shared with another serial port.
+        self.capture = None
+        # Transaction metrics, broken down by address and port (see crow.metrics).
+        self.metrics = crow.metrics.MetricsRegistry({'serial_port': serial_port_name})
 
     def __repr__(self):
         return "<{0} instance at {1:#x}, name='{2}', retain_count={3}>".format(self.__class__.__name__, id(self), self._serial.port, self.retain_count)
@@ -47,6 +114,50 @@ class HostSerialPort():
     def name(self):
         return self._serial.port
 
+    def next_token(self):
+        """Returns the token to use for the next command sent on the serial port."""
+        token = self._next_token
+        self._next_token = (token + 1)%256
+        return token
+
+    def acquire_transaction(self):
+        """Returns an idle Transaction object from the pool, or a new one if the pool is empty."""
+        # The command packets of pooled transactions are encoded into the port's shared
+        #  buffer, so a transaction's cmd_packet_buff is only valid until the next command
+        #  is encoded.
+        try:
+            transaction = self._transaction_pool.pop()
+        except IndexError:
+            return crow.transaction.Transaction(self._cmd_packet_buff)
+        transaction.in_pool = False
+        return transaction
+
+    def release_transaction(self, transaction):
+        """Returns a transaction obtained from acquire_transaction to the pool."""
+        if transaction.cmd_packet_buff is not self._cmd_packet_buff:
+            # not one of this port's transactions
+            return
+        if transaction.in_pool:
+            # already released
+            return
+        if self.cmd_packet_owner is transaction:
+            self.cmd_packet_owner = None
+        transaction.command = None
+        transaction.response = None
+        if len(self._transaction_pool) < HostSerialPort.MAX_POOLED_TRANSACTIONS:
+            transaction.in_pool = True
+            self._transaction_pool.append(transaction)
+
+    def apply_baudrate(self, address):
+        """Sets the serial port's baudrate to the address's baudrate, if it is not already set."""
+        # pyserial reconfigures the port whenever the baudrate is assigned, even to the same
+        #  value, so it is only assigned when it changes.
+        baudrate = self.get_baudrate(address)
+        ser = self._serial
+        if ser.baudrate != baudrate:
+            ser.baudrate = baudrate
+            self.num_baudrate_changes += 1
+
     def get_baudrate(self, address):
         if address < 0 or address > 31:
             raise ValueError("The address must be 0 to 31.")
@@ -65,6 +176,15 @@ class HostSerialPort():
         else:
             return self.default_transaction_timeout
 
+    def get_adaptive_timeout(self, address):
+        if address < 0 or address > 31:
+            raise ValueError("The address must be 0 to 31.")
+        value = self._settings[address].adaptive_timeout
+        if value is not None:
+            return value
+        else:
+            return self.default_adaptive_timeout
+
     def get_propcr_order(self, address):
         if address < 0 or address > 31:
             raise ValueError("The address must be 0 to 31.")
@@ -92,6 +212,15 @@ class HostSerialPort():
         else:
             raise ValueError("The address must be 0 to 31, or HostSerialPort.ALL.")
 
+    def set_adaptive_timeout(self, address, adaptive_timeout):
+        if address == HostSerialPort.ALL:
+            for s in self._settings:
+                s.adaptive_timeout = adaptive_timeout
+        elif address >= 0 and address <= 31:
+            self._settings[address].adaptive_timeout = adaptive_timeout
+        else:
+            raise ValueError("The address must be 0 to 31, or HostSerialPort.ALL.")
+
     def set_propcr_order(self, address, propcr_order):
         if address == HostSerialPort.ALL:
             for s in self._settings:
@@ -102,6 +231,85 @@ class HostSerialPort():
             raise ValueError("The address must be 0 to 31, or HostSerialPort.ALL.")
 
 
+    def get_response_timeout(self, address, port, cmd_wire_time=0.0):
+        """Returns the time to wait for a response to a command, not counting the time to receive it."""
+        # cmd_wire_time is the time to transmit the command packet. The fixed timeout does
+        #  not include it, but adaptive timeouts are based on device response times, so the
+        #  command's own transmission time must be added.
+        transaction_timeout = self.get_transaction_timeout(address)
+        if not self.get_adaptive_timeout(address):
+            return transaction_timeout
+        rt = self._response_times.get((address, port))
+        if rt is None:
+            # no measurements yet
+            return transaction_timeout
+        timeout = max(rt.rto, self.min_adaptive_timeout)*rt.backoff + cmd_wire_time
+        return min(timeout, transaction_timeout)
+
+    def record_response_time(self, address, port, response_time):
+        """Updates the response time estimates for the address and port with a new measurement."""
+        # response_time is the time from sending a command to receiving its response, less
+        #  the time taken to transmit the packets.
+        key = (address, port)
+        rt = self._response_times.get(key)
+        if rt is None:
+            rt = ResponseTimeEstimate()
+            rt.srtt = response_time
+            rt.rttvar = response_time/2
+            self._response_times[key] = rt
+        else:
+            rt.rttvar += HostSerialPort.ADAPTIVE_BETA*(abs(rt.srtt - response_time) - rt.rttvar)
+            rt.srtt += HostSerialPort.ADAPTIVE_ALPHA*(response_time - rt.srtt)
+        rt.rto = rt.srtt + HostSerialPort.ADAPTIVE_K*rt.rttvar
+        rt.backoff = 1
+        rt.samples += 1
+
+    def record_response_timeout(self, address, port):
+        """Notes that a command to the address and port got no response, backing off the adaptive timeout."""
+        rt = self._response_times.get((address, port))
+        if rt is not None and max(rt.rto, self.min_adaptive_timeout)*rt.backoff < self.get_transaction_timeout(address):
+            rt.backoff *= 2
+
+    def get_response_time_estimate(self, address, port):
+        """Returns the ResponseTimeEstimate for the address and port, or None if there have been no measurements."""
+        return self._response_times.get((address, port))
+
+    def reset_response_time_estimates(self):
+        self._response_times = {}
+
+    def start_capture(self, path, **kwargs):
+        """Starts recording the line's traffic to a capture file (see crow.capture). Returns the CaptureWriter."""
+        # The keyword arguments are passed to CaptureWriter. An existing file is appended to.
+        self.stop_capture()
+        self.capture = crow.capture.CaptureWriter(path, clock=self.clock, **kwargs)
+        return self.capture
+
+    def stop_capture(self):
+        """Stops recording, closing the capture file."""
+        capture = self.capture
+        self.capture = None
+        if capture is not None:
+            capture.close()
+
+
+class ResponseTimeEstimate:
+
+    # Response time statistics for an address and port, in seconds. rto is the adaptive
+    #  timeout before backoff, and backoff is the current multiplier.
+
+    __slots__ = ('srtt', 'rttvar', 'rto', 'backoff', 'samples')
+
+    def __init__(self):
+        self.srtt = 0.0
+        self.rttvar = 0.0
+        self.rto = 0.0
+        self.backoff = 1
+        self.samples = 0
+
+    def __repr__(self):
+        return "<{0} instance at {1:#x}, srtt={2}, rttvar={3}, rto={4}, backoff={5}>".format(self.__class__.__name__, id(self), self.srtt, self.rttvar, self.rto, self.backoff)
+
+
 class HostSerialSettings():
 
     # SerialSettings stores settings used by Crow hosts and clients.
@@ -111,9 +319,10 @@ class HostSerialSettings():
         self.baudrate = None
         self.transaction_timeout = None
         self.propcr_order = None
+        self.adaptive_timeout = None
 
     def __repr__(self):
-        return "<{0} instance at {1:#x}, baudrate={2}, transaction_timeout={3}, propcr_order={4}>".format(self.__class__.__name__, id(self), self.baudrate, self.transaction_timeout, self.propcr_order)
+        return "<{0} instance at {1:#x}, baudrate={2}, transaction_timeout={3}, propcr_order={4}, adaptive_timeout={5}>".format(self.__class__.__name__, id(self), self.baudrate, self.transaction_timeout, self.propcr_order, self.adaptive_timeout)
 
 
 
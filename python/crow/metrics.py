@@ -0,0 +1,224 @@
+# metrics.py
+# Crow Host Metrics
+# project: https://pypi.org/project/crow-serial/
+# source: https://github.com/chris-siedell/PyCrow
+# homepage: http://siedell.com/projects/Crow/
+
+
+import bisect
+import json
+import threading
+import crow.errors
+import crow.parser
+
+
+class MetricsRegistry:
+
+    # Each HostSerialPort has a MetricsRegistry (its metrics property), which the hosts using
+    #  the port update as transactions are performed. The metrics are broken down by address
+    #  and port:
+    #   commands - command packets sent
+    #   responses - normal (non-error) responses received
+    #   bytes_out, bytes_in - bytes written and read
+    #   latency - a histogram of the times from sending a command to the end of its
+    #    transaction, for transactions that expected a response
+    #   no_response - NoResponseError counts by cause (see crow.errors.NoResponseError)
+    #   remote_errors - RemoteError counts by class name
+    #   bad_checksum - response packets that could not be parsed
+    #   extra_bytes - bytes discarded by the parser as not part of a response
+    #   stale_responses - responses received with a token other than the expected one
+    #   retries - commands sent again by a retry policy (see crow.retry)
+    # Recording is done by the holder of the line, so it needs no locking and costs a few
+    #  attribute increments per transaction. The exceptions are retries, which are recorded
+    #  after the line is released (so other hosts may use it during the retry delay), and
+    #  the creation of the entry for a new address and port: these take a lock. Setting
+    #  enabled to False turns recording off.
+    # snapshot returns the metrics as a dictionary, and to_json and to_prometheus export them.
+
+    # Upper bounds of the latency histogram buckets, in seconds.
+    LATENCY_BUCKETS = (0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0, 2.0, 5.0)
+
+    def __init__(self, labels=None, latency_buckets=None):
+        # labels is a dictionary of extra labels for the exported metrics (e.g. the serial port name).
+        self.enabled = True
+        self.labels = dict(labels) if labels is not None else {}
+        self.latency_buckets = tuple(latency_buckets) if latency_buckets is not None else MetricsRegistry.LATENCY_BUCKETS
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def reset(self):
+        with self._lock:
+            self._stats = {}
+
+    def record_command(self, address, port, num_bytes):
+        """Records a command packet sent to the address and port."""
+        stats = self._get(address, port)
+        stats.commands += 1
+        stats.bytes_out += num_bytes
+
+    def record_retry(self, address, port):
+        """Records that a command to the address and port will be sent again."""
+        stats = self._get(address, port)
+        with self._lock:
+            stats.retries += 1
+
+    def record_response(self, address, port, token, latency, num_bytes, results, error=None):
+        """Records the end of a transaction that expected a response."""
+        # results are the parser results collected while waiting for the response, and error
+        #  is the exception raised for the transaction (None on success).
+        stats = self._get(address, port)
+        stats.bytes_in += num_bytes
+        stats.latency_count += 1
+        stats.latency_sum += latency
+        stats.latency_buckets[bisect.bisect_left(self.latency_buckets, latency)] += 1
+        for item in results:
+            item_type = item.type
+            if item_type == crow.parser.ResultType.RESPONSE:
+                if item.token != token:
+                    stats.stale_responses += 1
+            elif item_type == crow.parser.ResultType.EXTRA or item_type == crow.parser.ResultType.LEFTOVER:
+                stats.extra_bytes += item.num_bytes
+            elif item_type == crow.parser.ResultType.ERROR:
+                stats.bad_checksum += 1
+        if error is None:
+            stats.responses += 1
+        elif isinstance(error, crow.errors.NoResponseError):
+            cause = error.cause or 'unknown'
+            stats.no_response[cause] = stats.no_response.get(cause, 0) + 1
+        elif isinstance(error, crow.errors.RemoteError):
+            name = error.__class__.__name__
+            stats.remote_errors[name] = stats.remote_errors.get(name, 0) + 1
+
+    def snapshot(self):
+        """Returns the metrics as a dictionary."""
+        # Hosts in other threads may be recording, so the entries and their containers are
+        #  copied under the lock (which keeps new entries from being added meanwhile).
+        with self._lock:
+            items = [(key, stats, list(stats.latency_buckets), dict(stats.no_response), dict(stats.remote_errors)) for key, stats in self._stats.items()]
+        items.sort(key=lambda item: item[0])
+        entries = []
+        for (address, port), stats, latency_buckets, no_response, remote_errors in items:
+            cumulative = 0
+            buckets = []
+            for bound, count in zip(self.latency_buckets + (float('inf'),), latency_buckets):
+                cumulative += count
+                buckets.append([bound, cumulative])
+            entries.append({
+                'address': address,
+                'port': port,
+                'commands': stats.commands,
+                'responses': stats.responses,
+                'bytes_out': stats.bytes_out,
+                'bytes_in': stats.bytes_in,
+                'latency': {'count': stats.latency_count, 'sum': stats.latency_sum, 'buckets': buckets},
+                'no_response': no_response,
+                'remote_errors': remote_errors,
+                'bad_checksum': stats.bad_checksum,
+                'extra_bytes': stats.extra_bytes,
+                'stale_responses': stats.stale_responses,
+                'retries': stats.retries,
+            })
+        return {'labels': dict(self.labels), 'metrics': entries}
+
+    def to_json(self, **kwargs):
+        """Returns the snapshot as a JSON string. kwargs are passed to json.dumps."""
+        snapshot = self.snapshot()
+        for entry in snapshot['metrics']:
+            # JSON has no infinity
+            entry['latency']['buckets'][-1][0] = '+Inf'
+        return json.dumps(snapshot, **kwargs)
+
+    def to_prometheus(self, prefix='crow'):
+        """Returns the snapshot in the Prometheus text exposition format."""
+        snapshot = self.snapshot()
+        lines = []
+
+        def family(name, kind, description):
+            lines.append('# HELP {0}_{1} {2}'.format(prefix, name, description))
+            lines.append('# TYPE {0}_{1} {2}'.format(prefix, name, kind))
+
+        def sample(name, entry, value, **extra):
+            labels = dict(self.labels)
+            labels['address'] = entry['address']
+            labels['port'] = entry['port']
+            labels.update(extra)
+            label_str = ','.join('{0}="{1}"'.format(k, _escape(v)) for k, v in labels.items())
+            lines.append('{0}_{1}{{{2}}} {3}'.format(prefix, name, label_str, _format_value(value)))
+
+        counters = (
+            ('commands_total', 'commands', 'Command packets sent.'),
+            ('responses_total', 'responses', 'Normal responses received.'),
+            ('bytes_out_total', 'bytes_out', 'Bytes written to the serial port.'),
+            ('bytes_in_total', 'bytes_in', 'Bytes read from the serial port while waiting for responses.'),
+            ('bad_checksum_packets_total', 'bad_checksum', 'Response packets that could not be parsed.'),
+            ('extra_bytes_total', 'extra_bytes', 'Bytes discarded by the parser.'),
+            ('stale_responses_total', 'stale_responses', 'Responses received with an unexpected token.'),
+            ('retries_total', 'retries', 'Commands sent again by a retry policy.'),
+        )
+        for name, key, description in counters:
+            family(name, 'counter', description)
+            for entry in snapshot['metrics']:
+                sample(name, entry, entry[key])
+
+        family('no_response_total', 'counter', 'Transactions that failed with NoResponseError, by cause.')
+        for entry in snapshot['metrics']:
+            for cause, count in sorted(entry['no_response'].items()):
+                sample('no_response_total', entry, count, cause=cause)
+
+        family('remote_errors_total', 'counter', 'Error responses received, by error class.')
+        for entry in snapshot['metrics']:
+            for error, count in sorted(entry['remote_errors'].items()):
+                sample('remote_errors_total', entry, count, error=error)
+
+        family('latency_seconds', 'histogram', 'Time from sending a command to the end of its transaction.')
+        for entry in snapshot['metrics']:
+            latency = entry['latency']
+            for bound, count in latency['buckets']:
+                sample('latency_seconds_bucket', entry, count, le=_format_value(bound))
+            sample('latency_seconds_sum', entry, latency['sum'])
+            sample('latency_seconds_count', entry, latency['count'])
+
+        return '\n'.join(lines) + '\n'
+
+    def _get(self, address, port):
+        key = (address, port)
+        stats = self._stats.get(key)
+        if stats is None:
+            with self._lock:
+                stats = self._stats.setdefault(key, _Stats(len(self.latency_buckets) + 1))
+        return stats
+
+
+class _Stats:
+
+    # The metrics for one address and port. latency_buckets are per-bucket (not cumulative)
+    #  counts, with a final bucket for latencies above the largest bound.
+
+    __slots__ = ('commands', 'responses', 'bytes_out', 'bytes_in', 'latency_count', 'latency_sum', 'latency_buckets',
+                 'no_response', 'remote_errors', 'bad_checksum', 'extra_bytes', 'stale_responses', 'retries')
+
+    def __init__(self, num_buckets):
+        self.commands = 0
+        self.responses = 0
+        self.bytes_out = 0
+        self.bytes_in = 0
+        self.latency_count = 0
+        self.latency_sum = 0.0
+        self.latency_buckets = [0]*num_buckets
+        self.no_response = {}
+        self.remote_errors = {}
+        self.bad_checksum = 0
+        self.extra_bytes = 0
+        self.stale_responses = 0
+        self.retries = 0
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(value) if isinstance(value, float) else str(value)
+
@@ -0,0 +1,187 @@
+# microbench.py
+# Crow Microbenchmarks
+# project: https://pypi.org/project/crow-serial/
+# source: https://github.com/chris-siedell/PyCrow
+# homepage: http://siedell.com/projects/Crow/
+
+
+import array
+import platform
+import random
+import timeit
+import crow
+import crow.admin
+import crow.device
+import crow.errors
+import crow.host
+import crow.parser
+import crow.template
+import crow.transaction
+import crow.utils
+
+
+# Microbenchmarks for the pure-CPU hot paths: checksums, command encoding (including
+#  command templates), response parsing, error response decoding, and the CrowAdmin
+#  decoders. No serial port is used.
+#  They are run by the `crow microbench` command (see crow.cli).
+#
+# The result of a run is a dictionary:
+#   {'crow_version', 'python', 'platform', 'numpy', 'benchmarks': {name: seconds per call}}
+# A run saved as a baseline can be compared against later runs. The repository keeps a
+#  baseline in testing/microbench_baseline.json. Absolute numbers depend on the machine, so
+#  a baseline should be regenerated when comparing on a different machine.
+
+
+def _payload(size):
+    return bytes((i*7 + 3)%256 for i in range(size))
+
+
+def _response_packet(payload, token=0, is_error=False):
+    buff = bytearray(2084)
+    size = crow.transaction.encode_response(buff, token, payload, is_error)
+    return bytes(buff[0:size])
+
+
+def _command_packet(payload, address=1, port=16, token=0):
+    t = crow.transaction.Transaction()
+    t.new_command(address, port, payload, True, token)
+    return bytes(t.cmd_packet)
+
+
+def _parse(parser, chunks, token):
+    parser.reset()
+    for chunk in chunks:
+        parser.parse_data(chunk, token)
+
+
+def _noisy_stream(packet, noise_size, seed=1):
+    # Random noise followed by the packet. The seed is fixed so that the work is the same
+    #  from run to run.
+    rng = random.Random(seed)
+    noise = bytes(rng.randrange(256) for i in range(noise_size))
+    return noise + packet
+
+
+def _admin_transaction(command_code, response):
+    t = crow.transaction.Transaction()
+    t.address = 1
+    t.port = 0
+    t.command_code = command_code
+    t.response = response
+    return t
+
+
+def _raise_error(host, t):
+    try:
+        host._raise_error(t, None)
+    except crow.errors.CrowError:
+        pass
+
+
+def make_benchmarks():
+    """Returns a dictionary of benchmark name -> zero argument callable."""
+
+    benchmarks = {}
+
+    # checksums
+    data = _payload(2047)
+    benchmarks['fletcher16[2047]'] = lambda: crow.utils.fletcher16(data)
+    benchmarks['fletcher16_checkbytes[2047]'] = lambda: crow.utils.fletcher16_checkbytes(data)
+    benchmarks['fletcher16_chunks[2047]'] = lambda: crow.utils.fletcher16_chunks(data)
+
+    # command encoding
+    t = crow.transaction.Transaction()
+    for size in (0, 128, 2047):
+        payload = _payload(size)
+        benchmarks['new_command[{0}]'.format(size)] = lambda p=payload: t.new_command(1, 16, p, True, 0, False)
+    payload = _payload(2047)
+    benchmarks['new_command_propcr[2047]'] = lambda: t.new_command(1, 16, payload, True, 0, True)
+    words = array.array('H', _payload(2046))
+    benchmarks['new_command_array[2046]'] = lambda: t.new_command(1, 16, words, True, 0, False)
+    template = crow.template.CommandTemplate(1, 16, _payload(2047), fields={'value': (1000, 4)})
+    benchmarks['template_encode[2047]'] = lambda: template.encode(t, 0)
+    benchmarks['template_encode_field[2047]'] = lambda: template.encode(t, 0, {'value': 123456789})
+
+    # response parsing
+    parser = crow.parser.Parser()
+    for size in (0, 2047):
+        chunks = [_response_packet(_payload(size), token=5)]
+        benchmarks['parse_data_clean[{0}]'.format(size)] = lambda c=chunks: _parse(parser, c, 5)
+    noisy = [_noisy_stream(_response_packet(_payload(2047), token=5), 256)]
+    benchmarks['parse_data_noisy[2047]'] = lambda: _parse(parser, noisy, 5)
+    garbage = [_noisy_stream(_response_packet(_payload(2047), token=5), 4096)]
+    benchmarks['parse_data_garbage[2047]'] = lambda: _parse(parser, garbage, 5)
+    packet = _response_packet(_payload(2047), token=5)
+    fragments = [packet[i:i+64] for i in range(0, len(packet), 64)]
+    benchmarks['parse_data_fragmented[2047]'] = lambda: _parse(parser, fragments, 5)
+
+    # command parsing (device side)
+    cmd_parser = crow.parser.CommandParser(payload_views=True)
+    cmd_packet = _command_packet(_payload(2047))
+    benchmarks['command_parse_data[2047]'] = lambda: cmd_parser.parse_data(cmd_packet, True)
+    noisy_cmd_packet = _noisy_stream(cmd_packet, 4096)
+    benchmarks['command_parse_garbage[2047]'] = lambda: cmd_parser.parse_data(noisy_cmd_packet, True)
+
+    # error response decoding
+    host = object.__new__(crow.host.Host)
+    host.custom_service_error_callback = None
+    error_rsp = crow.device.encode_error(8, message='The port is not open.', crow_version=2, max_command_size=2047,
+                                         max_response_size=2047, address=1, port=16, service_identifier='Test_Echo')
+    error_t = _admin_transaction(None, error_rsp)
+    error_t.port = 16
+    benchmarks['raise_error[all details]'] = lambda: _raise_error(host, error_t)
+
+    # CrowAdmin decoders
+    device = crow.device.Device(1, device_identifier='bench', device_description='microbenchmark device')
+    for port in (16, 17, 32, 33, 34, 100, 200):
+        device.add_service(port, crow.device.EchoService())
+    admin = crow.device.AdminService()
+    info_t = _admin_transaction(1, bytes(admin.handle(device, 0, b'\x43\x41\x01', True)))
+    ports_t = _admin_transaction(2, bytes(admin.handle(device, 0, b'\x43\x41\x02', True)))
+    port_info_t = _admin_transaction(3, bytes(admin.handle(device, 0, b'\x43\x41\x03\x10', True)))
+    benchmarks['parse_get_device_info'] = lambda: crow.admin.CrowAdmin.parse_get_device_info(info_t)
+    benchmarks['parse_get_open_ports'] = lambda: crow.admin.CrowAdmin.parse_get_open_ports(ports_t)
+    benchmarks['parse_get_port_info'] = lambda: crow.admin.CrowAdmin.parse_get_port_info(port_info_t)
+
+    return benchmarks
+
+
+def run(names=None, repeat=7, min_time=0.1, progress=None):
+    """Runs the benchmarks (all, or those whose names contain one of names). Returns the results dictionary."""
+    results = {
+        'crow_version': crow.__version__,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'numpy': crow.utils.numpy is not None,
+        'benchmarks': {},
+    }
+    for name, func in make_benchmarks().items():
+        if names is not None and not any(n in name for n in names):
+            continue
+        timer = timeit.Timer(func)
+        # Find a number of calls that takes at least min_time, then take the best of repeat runs.
+        number = 1
+        while True:
+            elapsed = timer.timeit(number)
+            if elapsed >= min_time:
+                break
+            number *= 2 if elapsed == 0 else max(2, min(10, int(min_time/elapsed) + 1))
+        best = min([elapsed] + timer.repeat(repeat - 1, number))
+        results['benchmarks'][name] = best/number
+        if progress is not None:
+            progress(name, best/number)
+    return results
+
+
+def compare(results, baseline, threshold=0.25):
+    """Compares results to a baseline. Returns a list of (name, baseline, current, ratio, is_regression) tuples."""
+    # A benchmark regresses if it takes more than (1 + threshold) times the baseline.
+    comparison = []
+    for name, current in results['benchmarks'].items():
+        base = baseline['benchmarks'].get(name)
+        if base is None or base <= 0:
+            continue
+        ratio = current/base
+        comparison.append((name, base, current, ratio, ratio > 1 + threshold))
+    return comparison
+
@@ -5,14 +5,80 @@
 # source: https://github.com/chris-siedell/PyCrow
 
 
+import enum
+import re
+import crow.utils
+
+
+class ResultType(enum.IntEnum):
+
+    # The type codes of the results returned by Parser.parse_data and CommandParser.parse_data.
+    ERROR = 0
+    EXTRA = 1
+    RESPONSE = 2
+    LEFTOVER = 3
+    COMMAND = 4
+
+
+class ParserResult:
+
+    # A ParserResult describes a sequence of data given to the parser. See the comments
+    #  to Parser.parse_data and CommandParser.parse_data for the meaning of each property
+    #  for each type.
+    # For compatibility with code written for the older dictionary results a
+    #  ParserResult may also be subscripted (e.g. result['payload']), in which case
+    #  result['type'] gives the type name in lowercase (e.g. 'response').
+
+    __slots__ = ('type', 'token', 'is_error', 'payload', 'data', 'message', 'address', 'port', 'response_expected', 'num_bytes')
+
+    def __init__(self, type, token=None, is_error=False, payload=None, data=None, message=None, address=None, port=None, response_expected=None, num_bytes=None):
+        self.type = type
+        self.token = token
+        self.is_error = is_error
+        self.payload = payload
+        self.data = data
+        self.message = message
+        self.address = address
+        self.port = port
+        self.response_expected = response_expected
+        # For extra and leftover results, the number of bytes the result describes (data may
+        #  hold fewer, see Parser's max_extra_size).
+        self.num_bytes = num_bytes if num_bytes is not None or data is None else len(data)
+
+    def __repr__(self):
+        return "<{0} instance at {1:#x}, type={2}, token={3}>".format(self.__class__.__name__, id(self), self.type.name, self.token)
+
+    def __getitem__(self, key):
+        if key == 'type':
+            return self.type.name.lower()
+        if key not in ParserResult.__slots__:
+            raise KeyError(key)
+        return getattr(self, key)
+
+
 class Parser:
 
-    # As of April 2018 this parser just looks for response packets.
-    # todo list:
-    #   - add support for command packets
-    #   - add ignore_extra and ignore_leftover options to parse_data
+    # This parser looks for response packets. See CommandParser for command packets.
+
+    def __init__(self, payload_views=False, max_extra_size=None):
+
+        # If payload_views is True the payload of a response result is a memoryview into
+        #  the parser's payload buffer instead of a new bytearray. This avoids a copy per
+        #  response. Only the last packet in the data given to parse_data can be left in the
+        #  buffer (the payloads of earlier packets in the same call are copied when the next
+        #  packet starts), so a view is valid until parse_data is called again.
+        self.payload_views = payload_views
 
-    def __init__(self):
+        # max_extra_size, if not None, bounds the data kept for an extra result: only the
+        #  first max_extra_size bytes of a run of extraneous bytes are kept (the result's
+        #  num_bytes property still gives the length of the run). This limits the memory
+        #  used when a noisy line produces a lot of garbage.
+        self.max_extra_size = max_extra_size
+
+        # Running totals of the extraneous and leftover bytes seen by the parser, including
+        #  bytes not reported because of the ignore_extra and ignore_leftover options.
+        self.num_extra_bytes = 0
+        self.num_leftover_bytes = 0
 
         # Minimum number of bytes still expected by parser to complete the transaction.
         #  This will always be non-zero unless a specific token is passed to parse_data.
@@ -23,6 +89,7 @@ class Parser:
         self._is_error = False
         self._token = 0
         self._pay_buff = bytearray(2047)
+        self._pay_view = memoryview(self._pay_buff)
         self._pay_size = 0
         self._header = bytearray(5)
         self._pay_ind = 0
@@ -30,12 +97,15 @@ class Parser:
         self._pay_rem = 0
         self._upper_F16 = 0
         self._lower_F16 = 0
+        self._extra_data = None
+        self._extra_size = 0
+        self._view_result = None
 
     def reset(self):
         self._state = 0
         self.min_bytes_expected = 5
 
-    def parse_data(self, data, token=None, reset=False):
+    def parse_data(self, data, token=None, reset=False, ignore_extra=False, ignore_leftover=False):
 
         # This method parses a data stream in search of Crow response packets. The
         #  data stream is provided using the data argument (a bytes-like object),
@@ -54,24 +124,32 @@ class Parser:
         #  min_bytes_expected to 0, and if there are any bytes in data after the
         #  response they will be returned as 'leftover' bytes. 
 
+        # If ignore_extra is True extraneous bytes are skipped without producing extra
+        #  results, and if ignore_leftover is True leftover bytes are discarded without
+        #  producing a leftover result. In both cases the bytes are still counted (see the
+        #  num_extra_bytes and num_leftover_bytes properties). This saves the copies when
+        #  the caller has no use for the bytes.
+
         # This method returns a list of parser results. A result describes a sequence of
         #  data given to the parser, potentially over several parse_data calls. Each
-        #  result is a dictionary with a type property. The result types:
-        #  type: 'error' - a response packet was received, but it could not be parsed
-        #        'extra' - extraneous data, not recognized as part of a response packet
-        #        'response' - a parsable response
-        #        'leftover' - data following an expected (specific token) response
+        #  result is a ParserResult object with a type property (a ResultType). The result types:
+        #  type: ResultType.ERROR - a response packet was received, but it could not be parsed
+        #        ResultType.EXTRA - extraneous data, not recognized as part of a response packet
+        #        ResultType.RESPONSE - a parsable response
+        #        ResultType.LEFTOVER - data following an expected (specific token) response
         # error properties:
         #  token (int)
         #  message (string)
         # extra properties:
-        #  data (bytes)
+        #  data (bytearray)
+        #  num_bytes (int)
         # leftover properties:
         #  data (bytes)
+        #  num_bytes (int)
         # response properties:
         #  is_error (bool)
         #  token (int)
-        #  payload (bytes)
+        #  payload (bytearray, or memoryview if payload_views is True)
 
         # states (action to be performed on next byte):
         #  0 - buffer RH0
@@ -79,38 +157,85 @@ class Parser:
         #  2 - buffer RH2
         #  3 - buffer RH3
         #  4 - buffer RH4 and evaluate RH0-RH4
-        #  5 - process response payload byte
+        #  5 - process response payload bytes (a run of up to the rest of the chunk)
         #  6 - process response payload F16 upper sum
         #  7 - process response payload F16 lower sum
-        #  8 - process response body byte after failed payload F16
+        #  8 - process response body bytes after failed payload F16
+
+        # Only the header bytes and the payload F16 sums are processed one byte at a time.
+        #  Payload bytes (state 5) and the rest of a corrupt body (state 8) are consumed as
+        #  slices of data, as many bytes as are available up to the end of the chunk or body.
+
+        # Resynchronization: only bytes with valid RH0 reserved bits can begin a response
+        #  packet. In state 0 the parser searches ahead in bulk for such bytes, and checks the
+        #  header at each one in place, so extraneous bytes are skipped as slices rather than
+        #  one at a time. When a header that was buffered a byte at a time (because it
+        #  straddled calls) turns out invalid, the window is shifted to the next candidate
+        #  byte within it.
 
         if reset:
             self.reset()
 
         result = []
-
-        extra_data = bytearray()
+        self._view_result = None
 
         data_ind = 0
         data_size = len(data)
+        view = memoryview(data)
 
-        while data_ind < data_size:
+        # State 8 is also checked when there is no data left since a failed F16 may have been
+        #  the last byte of the packet.
+        while data_ind < data_size or self._state == 8:
 
-            byte = data[data_ind]
-            data_ind += 1
-
-            if self._state == 5:
-                # process payload byte
-                self.min_bytes_expected -= 1
-                self._lower_F16 += byte
-                self._upper_F16 += self._lower_F16
-                self._pay_buff[self._pay_ind] = byte
-                self._pay_ind += 1
-                self._chk_rem -= 1
+            if self._state == 0:
+                # skip to the next possible start of a response packet
+                ind = Parser._find_header(data, data_ind, data_size)
+                if ind > data_ind:
+                    self._collect_extra(view[data_ind:ind], ignore_extra)
+                    data_ind = ind
+                    if data_ind == data_size:
+                        break
+            elif self._state == 5:
+                # process payload bytes
+                num = min(self._chk_rem, data_size - data_ind)
+                next_data_ind = data_ind + num
+                chunk = view[data_ind:next_data_ind]
+                self._pay_buff[self._pay_ind:self._pay_ind+num] = chunk
+                # Continue the chunk's sums, which may include bytes from previous calls.
+                upper, lower = crow.utils.fletcher16_sums(chunk)
+                self._upper_F16 += num*self._lower_F16 + upper
+                self._lower_F16 += lower
+                self._pay_ind += num
+                self._chk_rem -= num
+                self.min_bytes_expected -= num
+                data_ind = next_data_ind
                 if self._chk_rem == 0:
                     # all chunk payload bytes received
                     self._state = 6
-            elif self._state == 6:
+                continue
+            elif self._state == 8:
+                # process body bytes after failed payload F16
+                num = min(self.min_bytes_expected, data_size - data_ind)
+                self.min_bytes_expected -= num
+                data_ind += num
+                if self.min_bytes_expected > 0:
+                    # the rest of the body will arrive in a later call
+                    break
+                else:
+                    # all bytes of the corrupt packet received
+                    result.append(ParserResult(ResultType.ERROR, self._token, message='The response packet has bad checksums.'))
+                    self.min_bytes_expected = 5
+                    self._state = 0
+                    if token is not None and token == self._token:
+                        self._finish(result, data, data_ind, data_size, ignore_extra, ignore_leftover)
+                        self.min_bytes_expected = 0
+                        return result
+                continue
+
+            byte = data[data_ind]
+            data_ind += 1
+
+            if self._state == 6:
                 # process payload F16 upper sum
                 self.min_bytes_expected -= 1
                 if self._upper_F16%0xff == byte%0xff:
@@ -126,12 +251,15 @@ class Parser:
                     # lower F16 correct
                     if self._pay_rem == 0:
                         # packet done -- all bytes received
-                        result.append({'type':'response', 'is_error':self._is_error, 'token':self._token, 'payload':self._pay_buff[0:self._pay_size]})
+                        if self.payload_views:
+                            self._view_result = ParserResult(ResultType.RESPONSE, self._token, self._is_error, self._pay_view[0:self._pay_size])
+                            result.append(self._view_result)
+                        else:
+                            result.append(ParserResult(ResultType.RESPONSE, self._token, self._is_error, self._pay_buff[0:self._pay_size]))
                         self.min_bytes_expected = 5
                         self._state = 0
                         if token is not None and token == self._token:
-                            if data_ind < data_size:
-                                result.append({'type':'leftover', 'data':data[data_ind:data_size]})
+                            self._finish(result, data, data_ind, data_size, ignore_extra, ignore_leftover)
                             self.min_bytes_expected = 0
                             return result
                     else:
@@ -169,9 +297,8 @@ class Parser:
                 if response_header_is_valid(self._header):
                     # valid header
                     # first off, dispose of any collected extraneous bytes 
-                    if len(extra_data) > 0:
-                        result.append({'type':'extra', 'data':extra_data})
-                        extra_data = bytearray()
+                    if self._extra_size > 0:
+                        self._flush_extra(result, ignore_extra)
                     # extract packet parameters
                     self._is_error = bool(self._header[0] & 0x80)
                     self._header[0] = (self._header[0] & 0x38) >> 3
@@ -187,58 +314,279 @@ class Parser:
                         self._upper_F16 = self._lower_F16 = 0
                         self._pay_ind = 0
                         self._state = 5
+                        if self._view_result is not None:
+                            # An earlier packet in this call is still in the buffer.
+                            self._view_result.payload = bytearray(self._view_result.payload)
+                            self._view_result = None
                     else:
                         # packet is good, but empty (no payload)
-                        result.append({'type':'response', 'is_error':self._is_error, 'token':self._token, 'payload':bytearray()})
+                        if self.payload_views:
+                            payload = self._pay_view[0:0]
+                        else:
+                            payload = bytearray()
+                        result.append(ParserResult(ResultType.RESPONSE, self._token, self._is_error, payload))
                         self.min_bytes_expected = 5
                         self._state = 0
                         if token is not None and token == self._token:
-                            if data_ind < data_size:
-                                result.append({'type':'leftover', 'data':data[data_ind:data_size]})
+                            self._finish(result, data, data_ind, data_size, ignore_extra, ignore_leftover)
                             self.min_bytes_expected = 0
                             return result
                 else:
                     # invalid header
-                    # stay at state 4 but shift header bytes down and collect extraneous data
-                    self.min_bytes_expected = 1
-                    extra_data.append(self._header.pop(0))
-                    self._header.append(0)
-            elif self._state == 8:
-                # process body byte after failed payload F16
-                self.min_bytes_expected -= 1
-                if self.min_bytes_expected == 0:
-                    result.append({'type':'error', 'token':self._token, 'message':'The response packet has bad checksums.'})
-                    self.min_bytes_expected = 5
-                    self._state == 0
-                    if token is not None and token == self._token:
-                        if data_ind < data_size:
-                            result.append({'type':'leftover', 'data':data[data_ind:data_size]})
-                        self.min_bytes_expected = 0
-                        return result
+                    # shift the header bytes down to the next byte that could be RH0 (back to
+                    #  state 0 if there is none), collecting the bytes before it as extraneous
+                    header = self._header
+                    shift = 1
+                    while shift < 5 and header[shift] & 0x47 != 0x02:
+                        shift += 1
+                    self._collect_extra(header[0:shift], ignore_extra)
+                    header[0:5-shift] = header[shift:5]
+                    self._state = 5 - shift
+                    self.min_bytes_expected = shift
             else:
                 raise RuntimeError("Programming error. Invalid state in Parser.")
 
-        if len(extra_data) > 0:
-            result.append({'type':'extra', 'data':extra_data})
+        if self._extra_size > 0:
+            self._flush_extra(result, ignore_extra)
 
         return result
 
+    @staticmethod
+    def _find_header(data, start, end):
+        # Returns the index of the first response header in data[start:end], or of the first
+        #  possible RH0 byte too close to the end for its header to be checked, or end.
+        search = _RH0_CANDIDATE.search
+        ind = start
+        while True:
+            match = search(data, ind, end)
+            if match is None:
+                return end
+            ind = match.start()
+            if end - ind < 5 or response_header_is_valid(data, ind):
+                return ind
+            ind += 1
 
-def response_header_is_valid(header):
-    # Given a bytes-like object of len >= 5 (not checked) this function returns a bool.
-    if header[0] & 0x47 != 0x02:
+    def _collect_extra(self, run, ignore_extra):
+        # Adds a run of extraneous bytes to the pending extra result.
+        size = len(run)
+        self._extra_size += size
+        if ignore_extra:
+            return
+        if self._extra_data is None:
+            self._extra_data = bytearray()
+        if self.max_extra_size is None:
+            self._extra_data += run
+        else:
+            room = self.max_extra_size - len(self._extra_data)
+            if room > 0:
+                self._extra_data += run[0:room]
+
+    def _flush_extra(self, result, ignore_extra):
+        # Ends the pending extra result.
+        self.num_extra_bytes += self._extra_size
+        if not ignore_extra:
+            result.append(ParserResult(ResultType.EXTRA, data=self._extra_data, num_bytes=self._extra_size))
+        self._extra_data = None
+        self._extra_size = 0
+
+    def _finish(self, result, data, data_ind, data_size, ignore_extra, ignore_leftover):
+        # Called when the expected response has been received, to report the leftover bytes.
+        #  Extraneous bytes collected before the response have been reported already.
+        num = data_size - data_ind
+        if num > 0:
+            self.num_leftover_bytes += num
+            if not ignore_leftover:
+                result.append(ParserResult(ResultType.LEFTOVER, data=data[data_ind:data_size], num_bytes=num))
+
+
+class CommandParser:
+
+    # CommandParser looks for Crow command packets in a data stream. It is the device
+    #  side counterpart of Parser, used by the device implementation (crow.device).
+    # Incoming data is collected in an internal buffer until a complete packet (header
+    #  and body) is available, and then the packet is checked and decoded as a whole.
+
+    def __init__(self, payload_views=False):
+
+        # payload_views has the same meaning as for Parser (the payloads of all but the
+        #  last command in the data given to parse_data are copies).
+        self.payload_views = payload_views
+
+        # Minimum number of bytes still expected by the parser to complete a command packet.
+        self.min_bytes_expected = 7
+
+        # internal stuff
+        self._buff = bytearray()
+        self._pay_buff = bytearray(2047)
+        self._pay_view = memoryview(self._pay_buff)
+
+    def reset(self):
+        self._buff.clear()
+        self.min_bytes_expected = 7
+
+    def parse_data(self, data, reset=False):
+
+        # This method parses a data stream in search of Crow command packets. As with
+        #  Parser.parse_data the stream may be provided over several calls.
+
+        # This method returns a list of ParserResult objects. The result types:
+        #  type: ResultType.COMMAND - a parsable command
+        #        ResultType.ERROR - a command packet with a valid header, but a bad payload checksum
+        #        ResultType.EXTRA - extraneous data, not recognized as part of a command packet
+        # command properties:
+        #  address (int)
+        #  port (int)
+        #  response_expected (bool)
+        #  token (int)
+        #  payload (bytearray, or memoryview if payload_views is True)
+        # error properties:
+        #  address, port, response_expected, token (as for command)
+        #  message (string)
+        # extra properties:
+        #  data (bytes)
+
+        if reset:
+            self.reset()
+
+        result = []
+
+        buff = self._buff
+        buff += data
+        view = memoryview(buff)
+
+        buff_size = len(buff)
+        ind = 0
+        extra_ind = 0
+        view_result = None
+        self.min_bytes_expected = 7
+
+        try:
+            while buff_size - ind >= 7:
+
+                if not command_header_is_valid(view, ind):
+                    # not the start of a packet, so skip to the next byte that could be CH0
+                    match = _CH0_CANDIDATE.search(buff, ind + 1, buff_size - 6)
+                    ind = match.start() if match is not None else buff_size - 6
+                    continue
+
+                pay_size = ((buff[ind] & 0x38) << 5) | buff[ind+1]
+                remainder = pay_size%128
+                body_size = (pay_size//128)*130 + ((remainder + 2) if (remainder > 0) else 0)
+                packet_size = 7 + body_size
+
+                if buff_size - ind < packet_size:
+                    # the body has not been completely received
+                    self.min_bytes_expected = packet_size - (buff_size - ind)
+                    break
+
+                if extra_ind < ind:
+                    result.append(ParserResult(ResultType.EXTRA, data=bytes(view[extra_ind:ind])))
+
+                address = buff[ind+2] & 0x1f
+                response_expected = bool(buff[ind+2] & 0x80)
+                port = buff[ind+3]
+                token = buff[ind+4]
+
+                if view_result is not None:
+                    # The previous command's payload is still in the buffer.
+                    view_result.payload = bytearray(view_result.payload)
+                    view_result = None
+
+                # Copy the payload out of the body, verifying the chunk check bytes.
+                body_ok = True
+                body_ind = ind + 7
+                pay_ind = 0
+                while pay_ind < pay_size:
+                    chk_size = min(pay_size - pay_ind, 128)
+                    if crow.utils.fletcher16_sums(view[body_ind:body_ind+chk_size+2]) != (0, 0):
+                        body_ok = False
+                        break
+                    self._pay_buff[pay_ind:pay_ind+chk_size] = view[body_ind:body_ind+chk_size]
+                    pay_ind += chk_size
+                    body_ind += chk_size + 2
+
+                if body_ok:
+                    if self.payload_views:
+                        view_result = ParserResult(ResultType.COMMAND, token, payload=self._pay_view[0:pay_size], address=address, port=port, response_expected=response_expected)
+                        result.append(view_result)
+                    else:
+                        result.append(ParserResult(ResultType.COMMAND, token, payload=self._pay_buff[0:pay_size], address=address, port=port, response_expected=response_expected))
+                else:
+                    result.append(ParserResult(ResultType.ERROR, token, message='The command packet has bad checksums.', address=address, port=port, response_expected=response_expected))
+
+                ind += packet_size
+                extra_ind = ind
+
+            else:
+                self.min_bytes_expected = 7 - (buff_size - ind)
+
+            # Bytes before ind can no longer be the start of a packet.
+            if extra_ind < ind:
+                result.append(ParserResult(ResultType.EXTRA, data=bytes(view[extra_ind:ind])))
+
+        finally:
+            view.release()
+
+        del buff[0:ind]
+
+        return result
+
+
+def command_header_is_valid(header, offset=0):
+    # Given a bytes-like object with at least offset+7 bytes (not checked) this function returns a bool.
+    h0 = header[offset]
+    if h0 & 0xc7 != 0x01:
+        # bad reserved bits in CH0
+        return False
+    h2 = header[offset+2]
+    if h2 & 0x60 != 0:
+        # bad reserved bits in CH2
+        return False
+    upper = lower = h0
+    lower += header[offset+1]
+    upper += lower
+    lower += h2
+    upper += lower
+    lower += header[offset+3]
+    upper += lower
+    lower += header[offset+4]
+    upper += lower
+    lower += header[offset+5]
+    upper += lower
+    lower += header[offset+6]
+    upper += lower
+    if upper%0xff != 0 or lower%0xff != 0:
+        # bad F16 check bytes
+        return False
+    return True
+
+
+def response_header_is_valid(header, offset=0):
+    # Given a bytes-like object with at least offset+5 bytes (not checked) this function returns a bool.
+    h0 = header[offset]
+    if h0 & 0x47 != 0x02:
         # bad reserved bits in RH0
         return False
-    upper = lower = header[0]
-    lower += header[1]
+    upper = lower = h0
+    lower += header[offset+1]
     upper += lower
-    lower += header[2]
+    lower += header[offset+2]
     upper += lower
-    if upper%0xff != header[3]%0xff:
+    if upper%0xff != header[offset+3]%0xff:
         # bad upper F16 checksum
         return False
-    if lower%0xff != header[4]%0xff:
+    if lower%0xff != header[offset+4]%0xff:
         # bad lower F16 checksum
         return False
     return True
 
+
+def _byte_class(predicate):
+    # Returns a compiled pattern matching any byte for which predicate is True.
+    return re.compile(b'[' + b''.join(re.escape(bytes([b])) for b in range(256) if predicate(b)) + b']')
+
+
+# Bytes that could begin a response packet (RH0) or a command packet (CH0), by their reserved bits.
+_RH0_CANDIDATE = _byte_class(lambda b: b & 0x47 == 0x02)
+_CH0_CANDIDATE = _byte_class(lambda b: b & 0xc7 == 0x01)
+
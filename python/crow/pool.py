@@ -0,0 +1,348 @@
+# pool.py
+# Crow Host Pool
+# project: https://pypi.org/project/crow-serial/
+# source: https://github.com/chris-siedell/PyCrow
+# homepage: http://siedell.com/projects/Crow/
+
+
+import concurrent.futures
+import itertools
+import multiprocessing
+import os
+import queue
+import threading
+
+
+# A HostPool drives many serial ports from worker processes, so that encoding and parsing
+#  for different lines run on different cores. Each serial port belongs to one worker, which
+#  keeps a Host (and so the port's HostSerialPort, with its per-address settings) for it
+#  and performs its commands in a thread of its own. Calls are routed by serial port name
+#  and return concurrent.futures.Future objects.
+#
+# Example:
+#   with HostPool(['/dev/ttyUSB0', '/dev/ttyUSB1', '/dev/ttyUSB2']) as pool:
+#       pool.call_serial_port('/dev/ttyUSB1', 'set_baudrate', 5, 9600).result()
+#       result = pool.send_command('/dev/ttyUSB0', 3, 16, b'hello').result()
+#       futures = pool.fan_out([('/dev/ttyUSB0', 3), ('/dev/ttyUSB2', 7)], 16, b'status')
+#       for item in HostPool.gather(futures): ...
+#
+# Worker processes are started with the given multiprocessing context (by default the
+#  platform's default). With the fork start method serial port factories registered before
+#  the pool is created (e.g. crow.simulator buses) are inherited by the workers. Otherwise
+#  initializer (called with initargs in each worker) can set them up.
+
+
+class PoolResult:
+
+    # The outcome of a successful send_command performed by a HostPool worker. The
+    #  properties are those of the Transaction returned by Host.send_command.
+
+    __slots__ = ('serial_port_name', 'address', 'port', 'response', 'attempts', 'cached')
+
+    def __init__(self, serial_port_name, address, port, response, attempts=1, cached=False):
+        self.serial_port_name = serial_port_name
+        self.address = address
+        self.port = port
+        self.response = response
+        self.attempts = attempts
+        self.cached = cached
+
+    def __getstate__(self):
+        return tuple(getattr(self, name) for name in PoolResult.__slots__)
+
+    def __setstate__(self, state):
+        for name, value in zip(PoolResult.__slots__, state):
+            setattr(self, name, value)
+
+    def __repr__(self):
+        return "<{0} instance at {1:#x}, serial_port_name='{2}', address={3}, port={4}, response size={5}>".format(self.__class__.__name__, id(self), self.serial_port_name, self.address, self.port, None if self.response is None else len(self.response))
+
+
+class HostPool:
+
+    # serial_port_names - the serial ports to drive
+    #   num_workers - the number of worker processes (by default, one per port up to the
+    #    number of CPUs); the ports are divided among them round-robin
+    #   groups - alternatively, a list of lists of serial port names, one per worker, for
+    #    keeping ports together (e.g. ports that share a USB hub)
+    #   mp_context - an optional multiprocessing context
+    #   initializer, initargs - an optional function called in each worker before it starts
+
+    def __init__(self, serial_port_names=(), num_workers=None, groups=None, mp_context=None, initializer=None, initargs=()):
+        if groups is None:
+            names = list(serial_port_names)
+            if len(names) == 0:
+                raise ValueError("At least one serial port is required.")
+            if num_workers is None:
+                num_workers = min(len(names), os.cpu_count() or 1)
+            if num_workers < 1:
+                raise ValueError("num_workers must be at least 1.")
+            num_workers = min(num_workers, len(names))
+            groups = [names[i::num_workers] for i in range(num_workers)]
+        else:
+            groups = [list(group) for group in groups if len(group) > 0]
+            if len(groups) == 0:
+                raise ValueError("At least one serial port is required.")
+        self._route = {}
+        for i, group in enumerate(groups):
+            for name in group:
+                if name in self._route:
+                    raise ValueError("The serial port '{0}' is in more than one group.".format(name))
+                self._route[name] = i
+        if mp_context is None:
+            mp_context = multiprocessing.get_context()
+        self._lock = threading.Lock()
+        self._ids = itertools.count()
+        self._closed = False
+        self._workers = []
+        for group in groups:
+            parent_conn, child_conn = mp_context.Pipe()
+            process = mp_context.Process(target=_worker_main, args=(child_conn, initializer, initargs), daemon=True)
+            process.start()
+            child_conn.close()
+            worker = _WorkerHandle(process, parent_conn, group)
+            worker.reader = threading.Thread(target=self._read_results, args=(worker,), daemon=True)
+            worker.reader.start()
+            self._workers.append(worker)
+
+    def __repr__(self):
+        return "<{0} instance at {1:#x}, workers={2}, serial ports={3}>".format(self.__class__.__name__, id(self), len(self._workers), len(self._route))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @property
+    def serial_port_names(self):
+        return list(self._route)
+
+    def send_command(self, serial_port_name, address=1, port=32, payload=None, response_expected=True, idempotent=False, timeout=None, cacheable=False):
+        """Sends a command on the serial port (see Host.send_command). Returns a Future for a PoolResult."""
+        if payload is not None:
+            payload = bytes(payload)
+        return self._submit(serial_port_name, 'send', (address, port, payload, response_expected, idempotent, timeout, cacheable))
+
+    def fan_out(self, targets, port=32, payload=None, response_expected=True, idempotent=False, timeout=None, cacheable=False):
+        """Sends the same command to many (serial_port_name, address) targets. Returns a list of Futures, in target order."""
+        # Commands for different serial ports are performed in parallel. Commands for the
+        #  same serial port are performed one after another, in order.
+        if payload is not None:
+            payload = bytes(payload)
+        return [self.send_command(name, address, port, payload, response_expected, idempotent, timeout, cacheable) for name, address in targets]
+
+    def call_serial_port(self, serial_port_name, method_name, *args):
+        """Calls a method of the serial port's HostSerialPort in its worker (e.g. 'set_baudrate'). Returns a Future for the method's return value."""
+        # This is how per-address settings are made, since each worker has its own
+        #  HostSerialPort. The arguments must be picklable. A return value that can not be
+        #  pickled (an object that lives in the worker) is returned as None.
+        if method_name.startswith('_'):
+            raise ValueError("Only public methods may be called.")
+        return self._submit(serial_port_name, 'call', (method_name, args))
+
+    @staticmethod
+    def gather(futures, timeout=None):
+        """Waits for the futures. Returns a list with the result of each, or the exception it raised."""
+        # As with Host.send_batch, a failed command does not stop the others.
+        results = []
+        for future in futures:
+            try:
+                results.append(future.result(timeout))
+            except concurrent.futures.TimeoutError:
+                raise
+            except Exception as e:
+                results.append(e)
+        return results
+
+    def close(self):
+        """Stops the workers. Commands that have not been performed fail with RuntimeError."""
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            for worker in self._workers:
+                try:
+                    worker.conn.send(None)
+                except (OSError, ValueError):
+                    pass
+        for worker in self._workers:
+            worker.process.join(5.0)
+            if worker.process.is_alive():
+                worker.process.terminate()
+                worker.process.join()
+            worker.reader.join(5.0)
+            worker.conn.close()
+            self._fail_pending(worker, RuntimeError("The HostPool was closed."))
+
+    def _submit(self, serial_port_name, kind, args):
+        index = self._route.get(serial_port_name)
+        if index is None:
+            raise ValueError("The serial port '{0}' is not in the pool.".format(serial_port_name))
+        worker = self._workers[index]
+        future = concurrent.futures.Future()
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("The HostPool is closed.")
+            if worker.failed is not None:
+                raise RuntimeError("The worker for '{0}' has failed: {1}".format(serial_port_name, worker.failed))
+            request_id = next(self._ids)
+            worker.pending[request_id] = future
+            worker.conn.send((request_id, serial_port_name, kind, args))
+        return future
+
+    def _read_results(self, worker):
+        # Runs in a thread per worker, resolving futures as results arrive.
+        while True:
+            try:
+                request_id, ok, value = worker.conn.recv()
+            except (EOFError, OSError):
+                break
+            with self._lock:
+                future = worker.pending.pop(request_id, None)
+            if future is None:
+                continue
+            if ok:
+                future.set_result(value)
+            else:
+                future.set_exception(_unpack_exception(value))
+        with self._lock:
+            closed = self._closed
+            if not closed:
+                worker.failed = "the worker process exited (exit code {0})".format(worker.process.exitcode)
+        if not closed:
+            self._fail_pending(worker, RuntimeError("The HostPool worker process exited unexpectedly."))
+
+    def _fail_pending(self, worker, error):
+        with self._lock:
+            pending = worker.pending
+            worker.pending = {}
+        for future in pending.values():
+            future.set_exception(error)
+
+
+class _WorkerHandle:
+
+    # The parent's record of a worker process.
+
+    def __init__(self, process, conn, serial_port_names):
+        self.process = process
+        self.conn = conn
+        self.serial_port_names = serial_port_names
+        self.reader = None
+        # request id -> Future, for requests that have not been answered
+        self.pending = {}
+        # a description of the failure, if the worker has failed
+        self.failed = None
+
+
+def _worker_main(conn, initializer, initargs):
+    # The worker process. Requests are handed to a thread per serial port, and the results
+    #  are sent back as (request id, ok, value) tuples.
+    if initializer is not None:
+        initializer(*initargs)
+    send_lock = threading.Lock()
+    lines = {}
+
+    def reply(request_id, ok, value):
+        with send_lock:
+            conn.send((request_id, ok, value))
+
+    while True:
+        try:
+            request = conn.recv()
+        except (EOFError, OSError):
+            break
+        if request is None:
+            break
+        serial_port_name = request[1]
+        line = lines.get(serial_port_name)
+        if line is None:
+            line = _WorkerLine(serial_port_name, reply)
+            lines[serial_port_name] = line
+        line.requests.put(request)
+
+    for line in lines.values():
+        line.requests.put(None)
+    for line in lines.values():
+        line.thread.join()
+    conn.close()
+
+
+class _WorkerLine:
+
+    # A serial port in a worker process, with the thread that performs its requests.
+
+    def __init__(self, serial_port_name, reply):
+        self.serial_port_name = serial_port_name
+        self.reply = reply
+        self.requests = queue.Queue()
+        self.host = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            request = self.requests.get()
+            if request is None:
+                break
+            request_id, serial_port_name, kind, args = request
+            try:
+                value = self._perform(kind, args)
+            except Exception as e:
+                self.reply(request_id, False, _pack_exception(e))
+                continue
+            try:
+                self.reply(request_id, True, value)
+            except Exception as e:
+                # The value could not be pickled (nothing is sent in that case), so the
+                #  failure is sent instead and the line keeps serving requests.
+                self.reply(request_id, False, _pack_exception(e))
+
+    def _perform(self, kind, args):
+        if self.host is None:
+            import crow.host
+            # The host (and so the HostSerialPort) is kept for the life of the worker.
+            self.host = crow.host.Host(self.serial_port_name)
+        if kind == 'send':
+            address, port, payload, response_expected, idempotent, timeout, cacheable = args
+            t = self.host.send_command(address, port, payload, response_expected, idempotent=idempotent, timeout=timeout, cacheable=cacheable)
+            try:
+                response = None if t.response is None else bytes(t.response)
+                return PoolResult(self.serial_port_name, t.address, t.port, response, t.attempts, t.cached)
+            finally:
+                self.host.release_transaction(t)
+        elif kind == 'call':
+            method_name, method_args = args
+            value = getattr(self.host.serial_port, method_name)(*method_args)
+            # Objects that live in the worker (e.g. the CaptureWriter returned by
+            #  start_capture) are of no use to the caller and can not be pickled.
+            return value if _is_picklable(value) else None
+        raise RuntimeError("Programming error. Unknown request kind: " + str(kind))
+
+
+def _is_picklable(value):
+    import pickle
+    try:
+        pickle.dumps(value)
+    except Exception:
+        return False
+    return True
+
+
+def _pack_exception(e):
+    # Returns a picklable description of an exception. The Crow errors can not be pickled
+    #  directly (their constructors take arguments that are not kept in args), so the class,
+    #  args, and attributes are sent and the exception is rebuilt by _unpack_exception.
+    description = (e.__class__, e.args, dict(e.__dict__))
+    if not _is_picklable(description):
+        description = (RuntimeError, ("{0}: {1}".format(e.__class__.__name__, e),), {})
+    return description
+
+
+def _unpack_exception(description):
+    cls, args, attributes = description
+    e = cls.__new__(cls, *args)
+    e.args = args
+    e.__dict__.update(attributes)
+    return e
@@ -0,0 +1,55 @@
+# retry.py
+# Crow Retry Policies
+# project: https://pypi.org/project/crow-serial/
+# source: https://github.com/chris-siedell/PyCrow
+# homepage: http://siedell.com/projects/Crow/
+
+
+import random
+import crow.errors
+
+
+class RetryPolicy:
+
+    # A RetryPolicy tells a host whether and when to resend a command that failed with a
+    #  transient error. A policy may be assigned to a Host (its retry_policy property) or to
+    #  a HostSerialPort (used by all hosts on the port that do not have their own policy).
+    # Only commands declared idempotent (the idempotent argument to send_command) are
+    #  retried, since a command whose response was lost may have been performed.
+    # The transient errors are:
+    #   NoResponseError - no response, an unparseable (bad checksum) response, or a stale one
+    #   CorruptCommandPayloadError - the device received a command with a bad checksum
+    #   DeviceIsBusyError, DeviceLowResourcesError - the device asked the host to back off
+    # Between attempts the host releases the line and waits for an exponentially increasing
+    #  delay, base_delay*2**(attempt - 1) up to max_delay, reduced by a random fraction of
+    #  up to jitter so that hosts retrying together spread out.
+
+    RETRYABLE_ERRORS = (crow.errors.NoResponseError, crow.errors.CorruptCommandPayloadError,
+                        crow.errors.DeviceIsBusyError, crow.errors.DeviceLowResourcesError)
+
+    def __init__(self, max_attempts=3, base_delay=0.002, max_delay=0.1, jitter=0.5, retryable_errors=None):
+        if max_attempts < 1:
+            raise ValueError("max_attempts must be at least 1.")
+        if base_delay < 0 or max_delay < 0:
+            raise ValueError("The delays must not be negative.")
+        if jitter < 0 or jitter > 1:
+            raise ValueError("jitter must be 0 to 1.")
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.jitter = jitter
+        self.retryable_errors = tuple(retryable_errors) if retryable_errors is not None else RetryPolicy.RETRYABLE_ERRORS
+        self._random = random.Random()
+
+    def __repr__(self):
+        return "<{0} instance at {1:#x}, max_attempts={2}, base_delay={3}, max_delay={4}, jitter={5}>".format(self.__class__.__name__, id(self), self.max_attempts, self.base_delay, self.max_delay, self.jitter)
+
+    def should_retry(self, error, attempts):
+        """Returns True if a command that has failed with error after the given number of attempts should be sent again."""
+        return attempts < self.max_attempts and isinstance(error, self.retryable_errors)
+
+    def delay(self, attempts):
+        """Returns the time, in seconds, to wait before the next attempt."""
+        delay = min(self.base_delay*(2**(attempts - 1)), self.max_delay)
+        return delay*(1.0 - self.jitter*self._random.random())
+
@@ -0,0 +1,256 @@
+# scheduler.py
+# Crow Transaction Scheduler
+# project: https://pypi.org/project/crow-serial/
+# source: https://github.com/chris-siedell/PyCrow
+# homepage: http://siedell.com/projects/Crow/
+
+
+import asyncio
+import collections
+import contextlib
+import threading
+import time
+
+
+class TransactionScheduler:
+
+    # A TransactionScheduler owns the line of a serial port. Crow is half-duplex, so only
+    #  one transaction may be in progress at a time. Each HostSerialPort has a scheduler,
+    #  and hosts acquire the line from it before sending a command and release it after
+    #  the response has been received (or the transaction has failed).
+    # When the line is busy callers are queued, and the line is granted with fair queuing:
+    #  round-robin across clients (the objects passed to acquire, typically hosts), and
+    #  within each client round-robin across the addresses it is waiting to talk to. This
+    #  way a client with a lot of traffic can not starve the others.
+    # Threads block in acquire. Coroutines use acquire_async, which does not block the
+    #  event loop. Both kinds of callers may share a scheduler.
+    # If the scheduler is given baudrate_for (a function returning the baudrate for an
+    #  address) it reduces baudrate switching on mixed-baud lines: when the line is released
+    #  it looks at up to reorder_window waiting callers (in round-robin order) and grants the
+    #  line to the first one whose address uses the current baudrate. A caller can be passed
+    #  over at most reorder_window times, so the reordering is bounded.
+
+    def __init__(self, baudrate_for=None, reorder_window=4):
+        self.reorder_window = reorder_window
+        self._baudrate_for = baudrate_for
+        self._line_baudrate = None
+        self._lock = threading.Lock()
+        self._busy = False
+        # _clients maps client -> OrderedDict(address -> deque of tickets). The order of
+        #  both levels is the round-robin order.
+        self._clients = collections.OrderedDict()
+        self._queue_depth = 0
+        # statistics
+        self._max_queue_depth = 0
+        self._num_granted = 0
+        self._num_waited = 0
+        self._total_wait = 0.0
+        self._max_wait = 0.0
+        self._num_reordered = 0
+
+    @property
+    def queue_depth(self):
+        """The number of callers currently waiting for the line."""
+        return self._queue_depth
+
+    def acquire(self, client, address):
+        """Blocks until the line is granted to the caller."""
+        with self._lock:
+            if not self._busy and self._queue_depth == 0:
+                self._busy = True
+                self._num_granted += 1
+                self._line_baudrate = self._baudrate(address)
+                return
+            ticket = _Ticket(threading.Event(), None)
+            self._enqueue(client, address, ticket)
+        ticket.waiter.wait()
+
+    async def acquire_async(self, client, address):
+        """Waits (without blocking the event loop) until the line is granted to the caller."""
+        with self._lock:
+            if not self._busy and self._queue_depth == 0:
+                self._busy = True
+                self._num_granted += 1
+                self._line_baudrate = self._baudrate(address)
+                return
+            loop = asyncio.get_running_loop()
+            ticket = _Ticket(loop.create_future(), loop)
+            self._enqueue(client, address, ticket)
+        try:
+            await ticket.waiter
+        except asyncio.CancelledError:
+            with self._lock:
+                if ticket.granted:
+                    # The line was granted just as the caller was cancelled.
+                    granted = True
+                else:
+                    granted = False
+                    self._remove(client, address, ticket)
+            if granted:
+                self.release()
+            raise
+
+    def release(self):
+        """Releases the line, granting it to the next waiting caller (if any)."""
+        while True:
+            with self._lock:
+                if self._queue_depth == 0:
+                    self._busy = False
+                    return
+                ticket = self._dequeue()
+                ticket.granted = True
+                wait = time.perf_counter() - ticket.enqueue_time
+                self._num_granted += 1
+                self._num_waited += 1
+                self._total_wait += wait
+                if wait > self._max_wait:
+                    self._max_wait = wait
+            if ticket.loop is None:
+                ticket.waiter.set()
+                return
+            try:
+                ticket.loop.call_soon_threadsafe(_set_future_result, ticket.waiter)
+                return
+            except RuntimeError:
+                # The caller's event loop has been closed, so it will never take the line.
+                #  The ticket is treated as cancelled and the line goes to the next caller.
+                with self._lock:
+                    self._num_granted -= 1
+                    self._num_waited -= 1
+                    self._total_wait -= wait
+
+    @contextlib.contextmanager
+    def slot(self, client, address):
+        """A context manager that holds the line for the duration of the with block."""
+        self.acquire(client, address)
+        try:
+            yield
+        finally:
+            self.release()
+
+    def stats(self):
+        """Returns a dictionary of queuing statistics (times in seconds)."""
+        with self._lock:
+            return {
+                'queue_depth': self._queue_depth,
+                'max_queue_depth': self._max_queue_depth,
+                'transactions': self._num_granted,
+                'waited': self._num_waited,
+                'total_wait': self._total_wait,
+                'mean_wait': self._total_wait/self._num_waited if self._num_waited > 0 else 0.0,
+                'max_wait': self._max_wait,
+                'reordered': self._num_reordered,
+            }
+
+    def reset_stats(self):
+        with self._lock:
+            self._max_queue_depth = self._queue_depth
+            self._num_granted = 0
+            self._num_waited = 0
+            self._total_wait = 0.0
+            self._max_wait = 0.0
+            self._num_reordered = 0
+
+    def _baudrate(self, address):
+        # Returns the baudrate for the address, or None if it is not known.
+        if self._baudrate_for is None:
+            return None
+        try:
+            return self._baudrate_for(address)
+        except (TypeError, ValueError):
+            return None
+
+    def _enqueue(self, client, address, ticket):
+        # _lock must be held.
+        ticket.enqueue_time = time.perf_counter()
+        addresses = self._clients.get(client)
+        if addresses is None:
+            addresses = collections.OrderedDict()
+            self._clients[client] = addresses
+        tickets = addresses.get(address)
+        if tickets is None:
+            tickets = collections.deque()
+            addresses[address] = tickets
+        tickets.append(ticket)
+        self._queue_depth += 1
+        if self._queue_depth > self._max_queue_depth:
+            self._max_queue_depth = self._queue_depth
+
+    def _dequeue(self):
+        # _lock must be held, and the queue must not be empty. Takes the next ticket in
+        #  round-robin order (adjusted for baudrate) and rotates the client and address to
+        #  the end of their queues.
+        client, address = self._choose()
+        addresses = self._clients[client]
+        tickets = addresses[address]
+        ticket = tickets.popleft()
+        if len(tickets) > 0:
+            addresses.move_to_end(address)
+        else:
+            del addresses[address]
+        if len(addresses) > 0:
+            self._clients.move_to_end(client)
+        else:
+            del self._clients[client]
+        self._queue_depth -= 1
+        self._line_baudrate = self._baudrate(address)
+        return ticket
+
+    def _choose(self):
+        # _lock must be held. Returns the (client, address) to grant the line to next. This is
+        #  the first in round-robin order, unless one of the next reorder_window candidates
+        #  uses the current baudrate and the first has not already been passed over
+        #  reorder_window times.
+        line_baudrate = self._line_baudrate
+        passed_over = []
+        first = None
+        for client, addresses in self._clients.items():
+            for address, tickets in addresses.items():
+                if first is None:
+                    first = (client, address)
+                    if self._baudrate_for is None or line_baudrate is None or self.reorder_window <= 1 or tickets[0].passed_over >= self.reorder_window:
+                        return first
+                baudrate = self._baudrate(address)
+                if baudrate is None or baudrate == line_baudrate:
+                    if len(passed_over) > 0:
+                        for ticket in passed_over:
+                            ticket.passed_over += 1
+                        self._num_reordered += 1
+                    return (client, address)
+                passed_over.append(tickets[0])
+                if len(passed_over) >= self.reorder_window:
+                    return first
+        return first
+
+    def _remove(self, client, address, ticket):
+        # _lock must be held. Removes a ticket that will never be granted.
+        addresses = self._clients[client]
+        tickets = addresses[address]
+        tickets.remove(ticket)
+        if len(tickets) == 0:
+            del addresses[address]
+            if len(addresses) == 0:
+                del self._clients[client]
+        self._queue_depth -= 1
+
+
+class _Ticket:
+
+    # A waiting caller. waiter is a threading.Event, or an asyncio.Future when loop is
+    #  the event loop of a coroutine caller.
+
+    __slots__ = ('waiter', 'loop', 'granted', 'enqueue_time', 'passed_over')
+
+    def __init__(self, waiter, loop):
+        self.waiter = waiter
+        self.loop = loop
+        self.granted = False
+        self.enqueue_time = 0.0
+        # the number of times another caller was granted the line ahead of this one for baudrate
+        self.passed_over = 0
+
+
+def _set_future_result(future):
+    if not future.done():
+        future.set_result(None)
+
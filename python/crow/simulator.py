@@ -0,0 +1,296 @@
+# simulator.py
+# Crow Bus Simulator
+# project: https://pypi.org/project/crow-serial/
+# source: https://github.com/chris-siedell/PyCrow
+# homepage: http://siedell.com/projects/Crow/
+
+
+import time
+import serial
+import crow.device
+import crow.transport
+
+
+# The simulator provides an in-process Crow bus with virtual devices, so that hosts and
+#  clients can be tested and benchmarked without hardware.
+#
+# Example:
+#   bus = VirtualBus()
+#   device = VirtualDevice(5, processing_delay=0.0005)
+#   device.add_service(16, EchoService())
+#   bus.add_device(device)
+#   bus.attach('sim://bus0')
+#   host = crow.host.Host('sim://bus0')
+#   host.send_command(address=5, port=16, payload=b'hello')
+#
+# By default the bus runs on a VirtualClock, which only advances when the host waits for
+#  data. Transactions then take no real time, and all timing (including the timing seen
+#  by the host, since HostSerialPort uses the serial object's clock) is deterministic.
+#  Use RealClock to have the bus run in real time.
+# The simulated serial port does not have a file descriptor, so it can not be used by
+#  AsyncHost.
+
+
+class VirtualClock:
+
+    # A clock that only advances when told to. Times are in seconds.
+
+    def __init__(self, start=0.0):
+        self._now = start
+
+    def now(self):
+        return self._now
+
+    def advance(self, seconds):
+        self._now += seconds
+
+    def sleep_until(self, t):
+        if t > self._now:
+            self._now = t
+
+
+class RealClock:
+
+    # A clock that follows time.perf_counter.
+
+    def now(self):
+        return time.perf_counter()
+
+    def advance(self, seconds):
+        time.sleep(seconds)
+
+    def sleep_until(self, t):
+        delay = t - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+
+
+class VirtualBus:
+
+    # A VirtualBus is a simulated serial line with a host end and any number of virtual
+    #  devices. The host end is a VirtualSerial object, which is given to HostSerialPort
+    #  when a Host uses a serial port name that has been attached to the bus.
+    # If baud_timing is True bytes take the time to transmit at the serial port's baudrate
+    #  (and framing settings) to cross the bus. If it is False they arrive instantly.
+
+    def __init__(self, clock=None, baud_timing=True):
+        self.clock = clock if clock is not None else VirtualClock()
+        self.baud_timing = baud_timing
+        self.serial = None
+        self._devices = {}
+        self._attached_names = []
+        # the time at which the line will be idle
+        self._line_free_time = self.clock.now()
+
+    def add_device(self, device):
+        """Adds a VirtualDevice to the bus. Replaces any device with the same address."""
+        self._devices[device.address] = device
+
+    def remove_device(self, address):
+        self._devices.pop(address, None)
+
+    def get_device(self, address):
+        return self._devices.get(address)
+
+    def attach(self, serial_port_name):
+        """Makes hosts using serial_port_name use this bus."""
+        crow.transport.register_factory(serial_port_name, self._make_serial)
+        self._attached_names.append(serial_port_name)
+
+    def detach(self):
+        """Undoes all attach calls. Hosts that already use the bus are not affected."""
+        for name in self._attached_names:
+            crow.transport.unregister_factory(name)
+        self._attached_names = []
+
+    def inject(self, data, delay=0.0):
+        """Sends raw bytes (e.g. noise) to the host, starting delay seconds from now."""
+        ser = self._get_serial()
+        start = max(self.clock.now() + delay, self._line_free_time)
+        self._line_free_time = ser._receive(start, bytes(data))
+
+    def _make_serial(self, serial_port_name):
+        ser = self._get_serial()
+        ser.port = serial_port_name
+        return ser
+
+    def _get_serial(self):
+        if self.serial is None:
+            self.serial = VirtualSerial(self)
+        return self.serial
+
+    def _host_write(self, ser, data):
+        # Called by VirtualSerial.write. The devices see the bytes immediately, but any
+        #  responses are scheduled to arrive at the host according to the bus timing.
+        byte_time = ser.byte_time()
+        start = max(self.clock.now(), self._line_free_time)
+        end = start + len(data)*byte_time
+        self._line_free_time = end
+        ser._write_end_time = end
+        for device in list(self._devices.values()):
+            if device.baudrate is not None and device.baudrate != ser.baudrate:
+                # The device can not make sense of data at the wrong baudrate.
+                continue
+            packets = []
+            device.process(data, lambda packet: packets.append(bytes(packet)))
+            for packet in packets:
+                rsp_start = max(end + device.processing_delay, self._line_free_time)
+                self._line_free_time = ser._receive(rsp_start, packet)
+
+
+class VirtualSerial:
+
+    # VirtualSerial is the host end of a VirtualBus. It implements the parts of the
+    #  serial.Serial interface used by the host.
+
+    def __init__(self, bus):
+        self.bus = bus
+        self.port = None
+        self.baudrate = 9600
+        self.bytesize = serial.EIGHTBITS
+        self.parity = serial.PARITY_NONE
+        self.stopbits = serial.STOPBITS_ONE
+        self.timeout = None
+        self.write_timeout = None
+        self.is_open = True
+        # the time at which the last byte written will have been sent
+        self._write_end_time = 0.0
+        # Received data is kept as segments of [start time, byte time, data, index of next byte].
+        self._segments = []
+
+    def clock(self):
+        return self.bus.clock.now()
+
+    def sleep(self, seconds):
+        clock = self.bus.clock
+        clock.sleep_until(clock.now() + seconds)
+
+    def byte_time(self):
+        """The time taken to transmit one byte with the current settings."""
+        if not self.bus.baud_timing:
+            return 0.0
+        bits = 1 + self.bytesize + self.stopbits
+        if self.parity != serial.PARITY_NONE:
+            bits += 1
+        return bits / self.baudrate
+
+    def open(self):
+        self.is_open = True
+
+    def close(self):
+        self.is_open = False
+
+    @property
+    def in_waiting(self):
+        return self._num_available(self.bus.clock.now())
+
+    def reset_input_buffer(self):
+        self._take(None, self.bus.clock.now())
+
+    def flush(self):
+        """Waits until all written data has been sent."""
+        self.bus.clock.sleep_until(self._write_end_time)
+
+    def write(self, data):
+        if not self.is_open:
+            raise serial.SerialException("Attempting to use a port that is not open")
+        data = bytes(data)
+        self.bus._host_write(self, data)
+        return len(data)
+
+    def read(self, size=1):
+        if not self.is_open:
+            raise serial.SerialException("Attempting to use a port that is not open")
+        clock = self.bus.clock
+        now = clock.now()
+        ready_time = self._time_available(size)
+        if self.timeout is None:
+            if ready_time is not None:
+                clock.sleep_until(ready_time)
+            # Otherwise a real port would block forever -- return what is available instead.
+        else:
+            deadline = now + self.timeout
+            if ready_time is not None and ready_time <= deadline:
+                clock.sleep_until(ready_time)
+            else:
+                clock.sleep_until(deadline)
+        return self._take(size, clock.now())
+
+    def _receive(self, start, data):
+        # Schedules data to arrive at the host starting at the given time. Returns the time
+        #  the last byte arrives.
+        byte_time = self.byte_time()
+        self._segments.append([start, byte_time, data, 0])
+        return start + len(data)*byte_time
+
+    def _segment_available(self, segment, now):
+        # Returns the number of bytes of the segment that have arrived by now (including
+        #  bytes already taken).
+        start, byte_time, data, index = segment
+        if now < start:
+            return 0
+        if byte_time == 0.0:
+            return len(data)
+        # A small tolerance keeps floating point error from delaying a byte.
+        return min(len(data), int((now - start)/byte_time + 1e-6))
+
+    def _num_available(self, now):
+        count = 0
+        for segment in self._segments:
+            count += self._segment_available(segment, now) - segment[3]
+        return count
+
+    def _time_available(self, size):
+        # Returns the time at which size more bytes will have arrived, or None if not
+        #  enough data is scheduled.
+        for segment in self._segments:
+            start, byte_time, data, index = segment
+            remaining = len(data) - index
+            if size <= remaining:
+                return start + (index + size)*byte_time
+            size -= remaining
+        return None
+
+    def _take(self, size, now):
+        # Removes and returns up to size bytes (or all bytes if size is None) that have
+        #  arrived by now.
+        result = bytearray()
+        while len(self._segments) > 0 and (size is None or len(result) < size):
+            segment = self._segments[0]
+            available = self._segment_available(segment, now)
+            index = segment[3]
+            if size is None:
+                end = available
+            else:
+                end = min(available, index + size - len(result))
+            result += segment[2][index:end]
+            segment[3] = end
+            if end == len(segment[2]):
+                self._segments.pop(0)
+            else:
+                break
+        return bytes(result)
+
+
+class VirtualDevice(crow.device.Device):
+
+    # A VirtualDevice is a Device (see crow.device) on a VirtualBus. Services are registered
+    #  with add_service. In addition to the Device settings there are:
+    #   processing_delay - the time between the end of a command and the start of the response
+    #   baudrate - if not None the device ignores data sent at any other baudrate
+
+    def __init__(self, address, processing_delay=0.0, baudrate=None, impl_identifier='PyCrow Simulator', **kwargs):
+        super().__init__(address, impl_identifier=impl_identifier, **kwargs)
+        self.processing_delay = processing_delay
+        self.baudrate = baudrate
+
+
+# The services and error helpers are defined in crow.device. They are available here too
+#  for convenience.
+Service = crow.device.Service
+EchoService = crow.device.EchoService
+ErrorEchoService = crow.device.ErrorEchoService
+AdminService = crow.device.AdminService
+TransferService = crow.device.TransferService
+ErrorResponse = crow.device.ErrorResponse
+encode_error = crow.device.encode_error
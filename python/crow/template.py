@@ -0,0 +1,153 @@
+# template.py
+# Crow Command Templates
+# project: https://pypi.org/project/crow-serial/
+# source: https://github.com/chris-siedell/PyCrow
+# homepage: http://siedell.com/projects/Crow/
+
+
+import crow.transaction
+import crow.utils
+
+
+class CommandTemplate:
+
+    # A CommandTemplate is a command (address, port, payload, response_expected) that is
+    #  encoded once and then sent many times with Host.send_template, e.g. by a poller.
+    #  Sending it copies the pre-encoded packet into the transaction's buffer and patches
+    #  only the token (CH4) and the header check bytes (CH5, CH6).
+    # Parts of the payload that change from send to send may be declared as fields:
+    #   fields - a dictionary of name -> (offset, size), where offset is the field's byte
+    #    offset in the payload (in standard byte order) and size is its length in bytes
+    #    (fields may not overlap)
+    # Field values are given to send_template (or encode) as a dictionary of name -> value,
+    #  where a value is a bytes-like object of the field's size or an int (encoded in
+    #  big-endian order). Fields without a value keep the template payload's bytes. Only the
+    #  chunk check bytes covering the changed bytes are recomputed, and they are updated
+    #  incrementally from the template payload's Fletcher sums, so fields should be small.
+    # The template is encoded for the PropCR byte order if the serial port's propcr_order
+    #  setting for the address requires it (it is encoded again if the setting changes).
+
+    def __init__(self, address=1, port=32, payload=None, response_expected=True, fields=None, propcr_order=False):
+        self.address = address
+        self.port = port
+        self.payload = bytes(payload) if payload is not None else b''
+        self.response_expected = response_expected
+        self.fields = {}
+        for name, (offset, size) in (fields or {}).items():
+            if offset < 0 or size < 1 or offset + size > len(self.payload):
+                raise ValueError("The field '{0}' must lie within the payload.".format(name))
+            # The check bytes are patched field by field relative to the template payload,
+            #  so the fields must not share bytes.
+            for other, (other_offset, other_size) in self.fields.items():
+                if offset < other_offset + other_size and other_offset < offset + size:
+                    raise ValueError("The fields '{0}' and '{1}' overlap.".format(other, name))
+            self.fields[name] = (offset, size)
+        self._compile(propcr_order)
+
+    def __repr__(self):
+        return "<{0} instance at {1:#x}, address={2}, port={3}, payload size={4}, fields={5}>".format(self.__class__.__name__, id(self), self.address, self.port, len(self.payload), sorted(self.fields))
+
+    def _compile(self, propcr_order):
+        # Encodes the packet (with token 0) and precomputes what is needed to patch it.
+        t = crow.transaction.Transaction()
+        t.new_command(self.address, self.port, self.payload, self.response_expected, 0, propcr_order)
+        packet = bytes(t.cmd_packet)
+        self.propcr_order = propcr_order
+        self.packet = packet
+        self.packet_size = len(packet)
+        # The header's Fletcher sums with token 0. The token is the last byte summed, so
+        #  it adds to both sums with weight 1.
+        self._header_sums = crow.utils.fletcher16_sums(packet[0:4] + b'\x00')
+        # The sums of each chunk, and the packet index of each payload byte.
+        size = len(self.payload)
+        self._chunk_sums = []
+        for start in range(0, size, 128):
+            chunk_start = 7 + (start//128)*130
+            chunk_size = min(size - start, 128)
+            self._chunk_sums.append(crow.utils.fletcher16_sums(packet[chunk_start:chunk_start+chunk_size]))
+        self._packet_index = [0]*size
+        for i in range(size):
+            j = i
+            if propcr_order:
+                # every group of up to 4 bytes is reversed
+                group = i - i%4
+                group_size = min(4, size - group)
+                j = group + group_size - 1 - (i - group)
+            self._packet_index[i] = 7 + (j//128)*130 + j%128
+
+    def encode(self, t, token, values=None, propcr_order=None):
+        """Encodes the command into the transaction t with the given token and field values."""
+        if token < 0 or token > 255:
+            raise ValueError('token must be 0 to 255.')
+        if propcr_order is not None and propcr_order != self.propcr_order:
+            self._compile(propcr_order)
+
+        size = self.packet_size
+        buff = t.cmd_packet_buff
+        buff[0:size] = self.packet
+
+        # CH4, CH5, CH6
+        upper, lower = self._header_sums
+        upper = (upper + token)%0xff
+        lower = (lower + token)%0xff
+        buff[4] = token
+        check0 = 0xff - ((lower + upper)%0xff)
+        buff[5] = check0
+        buff[6] = 0xff - ((lower + check0)%0xff)
+
+        command = self.payload
+        if values:
+            command = self._patch(buff, values)
+
+        t.address = self.address
+        t.port = self.port
+        t.command = command
+        t.response_expected = self.response_expected
+        t.token = token
+        t.propcr_order = self.propcr_order
+        t.response = None
+        t.cmd_packet_size = size
+        t.cached = False
+        t.timeout = None
+        t.template = self
+        t.template_values = values
+
+    def _patch(self, buff, values):
+        # Writes the field values into the packet and updates the affected chunks' check bytes.
+        #  Returns the patched payload (in standard byte order), for the transaction's command.
+        payload = self.payload
+        packet_index = self._packet_index
+        payload_size = len(payload)
+        patched = bytearray(payload)
+        deltas = {}
+        for name, value in values.items():
+            field = self.fields.get(name)
+            if field is None:
+                raise ValueError("The template has no field named '{0}'.".format(name))
+            offset, size = field
+            if isinstance(value, int):
+                value = value.to_bytes(size, 'big')
+            elif len(value) != size:
+                raise ValueError("The value for the field '{0}' must be {1} bytes.".format(name, size))
+            patched[offset:offset+size] = value
+            for k in range(size):
+                diff = value[k] - payload[offset+k]
+                if diff == 0:
+                    continue
+                ind = packet_index[offset+k]
+                buff[ind] = value[k]
+                # A byte at position p of an n byte chunk adds to the lower sum once and to
+                #  the upper sum n - p times.
+                chunk = (ind - 7)//130
+                chunk_size = min(payload_size - chunk*128, 128)
+                upper, lower = deltas.get(chunk, (0, 0))
+                deltas[chunk] = (upper + (chunk_size - (ind - 7)%130)*diff, lower + diff)
+        for chunk, (upper_delta, lower_delta) in deltas.items():
+            upper, lower = self._chunk_sums[chunk]
+            upper = (upper + upper_delta)%0xff
+            lower = (lower + lower_delta)%0xff
+            ind = 7 + chunk*130 + min(payload_size - chunk*128, 128)
+            check0 = 0xff - ((lower + upper)%0xff)
+            buff[ind] = check0
+            buff[ind+1] = 0xff - ((lower + check0)%0xff)
+        return patched
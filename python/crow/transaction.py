@@ -11,7 +11,11 @@ import crow.utils
 class Transaction():
     """A class that holds information pertaining to a Crow transaction."""
 
-    def __init__(self):
+    def __init__(self, cmd_packet_buff=None):
+
+        # cmd_packet_buff is an optional bytearray of at least 2086 bytes to encode command
+        #  packets into. HostSerialPort uses this to have its pooled transactions share one
+        #  buffer, since a serial port only transmits one packet at a time.
 
         self.address = 1
         self.port = 32
@@ -21,9 +25,42 @@ class Transaction():
         self.propcr_order = False
         
         self.response = None
+
+        # The clock time (see HostSerialPort.clock) at which the command packet was written.
+        self.start_time = 0.0
+
+        # The number of times the command was sent (see crow.retry).
+        self.attempts = 1
+
+        # True if the response was served from a response cache (see crow.cache), in which
+        #  case no command was sent for this transaction.
+        self.cached = False
+
+        # The time to wait for the response, if it overrides the serial port's setting (see
+        #  Host.send_command).
+        self.timeout = None
+
+        # The CommandTemplate (and field values) the command was encoded from, if any.
+        self.template = None
+        self.template_values = None
+
+        # True while the transaction is idle in a HostSerialPort's pool, so that releasing
+        #  it twice does not pool it twice.
+        self.in_pool = False
         
-        self.cmd_packet_buff = bytearray(2086) # 2086 is max command packet size
+        if cmd_packet_buff is None:
+            cmd_packet_buff = bytearray(2086) # 2086 is max command packet size
+        self.cmd_packet_buff = cmd_packet_buff
         self.cmd_packet_size = 0
+        self._cmd_packet_view = memoryview(cmd_packet_buff)
+
+        # A buffer for reordering PropCR payloads, allocated when first needed.
+        self._propcr_view = None
+
+    @property
+    def cmd_packet(self):
+        """A memoryview of the encoded command packet (no copy is made)."""
+        return self._cmd_packet_view[0:self.cmd_packet_size]
 
 
     def new_command(self, address=1, port=32, command=None, response_expected=True, token=0, propcr_order=False):
@@ -42,12 +79,16 @@ class Transaction():
             raise ValueError('token must be 0 to 255.')
         
         if command is not None:
-            cmd_size = len(command)
+            # Any bytes-like object may be given (bytes, bytearray, memoryview, array, NumPy
+            #  array, etc.). Its bytes are accessed through a memoryview, so no copy is made.
+            payload = _byte_view(command)
+            cmd_size = len(payload)
             if cmd_size > 2047:
                 raise ValueError("The command payload must be 2047 bytes or less.")
             remainder = cmd_size%128
             cmd_body_size = (cmd_size//128)*130 + ((remainder + 2) if (remainder > 0) else 0)
         else:
+            payload = None
             cmd_size = 0
             cmd_body_size = 0
 
@@ -57,6 +98,10 @@ class Transaction():
         self.response_expected = response_expected
         self.token = token
         self.propcr_order = propcr_order
+        self.cached = False
+        self.timeout = None
+        self.template = None
+        self.template_values = None
 
         self.response = None
         
@@ -86,45 +131,89 @@ class Transaction():
         cmd_buff[5] = check[0]
         cmd_buff[6] = check[1]
    
-        # Send the payload in chunks with up to 128 payload bytes followed by 2 F16 check bytes.
-        buff_ind = 7
-        cmd_rem = cmd_size
-        cmd_ind = 0
+        if cmd_size == 0:
+            return
+
         if propcr_order:
-            # PropCR uses non-standard payload byte ordering (for command payloads only).
-            while cmd_rem > 0:
-                chk_size = min(cmd_rem, 128)
-                cmd_rem -= chk_size
-                start_buff_ind = buff_ind
-    
-                # In PropCR every group of up to 4 bytes is reversed (last group may be less than 4 bytes).
-                chk_rem = chk_size
-                while chk_rem > 0:
-                    grp_size = min(chk_rem, 4)
-                    chk_rem -= grp_size
-                    cmd_buff[buff_ind:buff_ind+grp_size] = command[cmd_ind:cmd_ind+grp_size][::-1]
-                    buff_ind += grp_size
-                    cmd_ind += grp_size
-                
-                check = crow.utils.fletcher16_checkbytes(cmd_buff[start_buff_ind:buff_ind])
-                cmd_buff[buff_ind] = check[0]
-                cmd_buff[buff_ind+1] = check[1]
-                buff_ind += 2
-        else:
-            # standard order
-            while cmd_rem > 0:
-                chk_size = min(cmd_rem, 128)
-                cmd_rem -= chk_size
-                next_cmd_ind = cmd_ind + chk_size
-                cmd_slice = command[cmd_ind:next_cmd_ind]
-                cmd_buff[buff_ind:buff_ind+chk_size] = cmd_slice
-                buff_ind += chk_size
-                check = crow.utils.fletcher16_checkbytes(cmd_slice)
-                cmd_buff[buff_ind] = check[0]
-                cmd_buff[buff_ind+1] = check[1]
-                buff_ind += 2
-                cmd_ind = next_cmd_ind
-    
+            # PropCR uses non-standard payload byte ordering (for command payloads only): every
+            #  group of up to 4 bytes is reversed. Chunks hold a whole number of groups, so the
+            #  reordering is done for the whole payload at once, into a scratch buffer, and the
+            #  reordered payload is then encoded in the standard way.
+            if self._propcr_view is None:
+                self._propcr_view = memoryview(bytearray(2047))
+            payload = crow.utils.reverse_propcr_order(payload, self._propcr_view)
+
+        # The payload is sent in chunks with up to 128 payload bytes followed by 2 F16 check
+        #  bytes. The check bytes for all chunks are computed in one batch, and the chunks are
+        #  copied straight from the payload's buffer into the packet buffer.
+        checks = crow.utils.fletcher16_checkbytes_chunks(payload)
+        buff_ind = 7
+        chk_ind = 0
+        for cmd_ind in range(0, cmd_size, 128):
+            chunk = payload[cmd_ind:cmd_ind+128]
+            next_buff_ind = buff_ind + len(chunk)
+            cmd_buff[buff_ind:next_buff_ind] = chunk
+            cmd_buff[next_buff_ind:next_buff_ind+2] = checks[chk_ind:chk_ind+2]
+            buff_ind = next_buff_ind + 2
+            chk_ind += 2
 
 
-        
+def _byte_view(data):
+    # Returns a one dimensional, unsigned byte memoryview of a bytes-like object (other
+    #  sequences of ints 0 to 255, e.g. lists, are copied into bytes).
+    try:
+        view = memoryview(data)
+    except TypeError:
+        view = memoryview(bytes(data))
+    if view.format != 'B' or view.ndim != 1:
+        view = view.cast('B')
+    return view
+
+
+def encode_response(buff, token, payload=None, is_error=False):
+    """Encodes a response packet into buff (a bytearray of at least 2084 bytes). Returns the packet size."""
+
+    # This is the device side counterpart of Transaction.new_command. Response payloads
+    #  always use standard byte ordering.
+
+    if token < 0 or token > 255:
+        raise ValueError('token must be 0 to 255.')
+
+    if payload is not None:
+        rsp_size = len(payload)
+        if rsp_size > 2047:
+            raise ValueError("The response payload must be 2047 bytes or less.")
+    else:
+        rsp_size = 0
+
+    # RH0, RH1
+    buff[0] = ((rsp_size >> 8) << 3) | 0x02
+    if is_error:
+        buff[0] |= 0x80
+    buff[1] = rsp_size & 0xff
+
+    # RH2
+    buff[2] = token
+
+    # RH3, RH4
+    check = crow.utils.fletcher16(buff[0:3])
+    buff[3] = check[0]
+    buff[4] = check[1]
+
+    # The payload is sent in chunks with up to 128 payload bytes followed by the two F16 sums.
+    if rsp_size == 0:
+        return 5
+    sums = crow.utils.fletcher16_chunks(payload)
+    buff_ind = 5
+    rsp_ind = 0
+    sums_ind = 0
+    while rsp_ind < rsp_size:
+        chk_size = min(rsp_size - rsp_ind, 128)
+        buff[buff_ind:buff_ind+chk_size] = payload[rsp_ind:rsp_ind+chk_size]
+        buff_ind += chk_size
+        buff[buff_ind] = sums[sums_ind]
+        buff[buff_ind+1] = sums[sums_ind+1]
+        buff_ind += 2
+        sums_ind += 2
+        rsp_ind += chk_size
+    return buff_ind
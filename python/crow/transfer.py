@@ -0,0 +1,121 @@
+# transfer.py
+# Crow Segmented Transfers
+# project: https://pypi.org/project/crow-serial/
+# source: https://github.com/chris-siedell/PyCrow
+# homepage: http://siedell.com/projects/Crow/
+
+
+import struct
+
+
+# Crow payloads are limited to 2047 bytes, so larger blocks of data (firmware images, tables,
+#  logs) are moved as a sequence of segments using the transfer sub-protocol below. The host
+#  side is Host.upload and Host.download, and the device side is crow.device.TransferService.
+#
+# A device has numbered streams (0 to 255), each a block of bytes. Every command begins with
+#  the bytes 'CT' and a command code. Integers are big-endian.
+#   status: 'CT' 0x00 stream -> 'CT' 0x00 size(4)
+#     Returns the stream's size.
+#   write: 'CT' 0x01 stream offset(4) data -> 'CT' 0x01 size(4)
+#     Truncates the stream to offset (which must not exceed its size), then appends data.
+#     Returns the new size.
+#   read: 'CT' 0x02 stream offset(4) length(2) -> 'CT' 0x02 flags data
+#     Returns up to length bytes starting at offset (which must not exceed the size). Bit 0
+#     of flags is set if the data reaches the end of the stream.
+# Since each segment names its offset, sending a segment again has no further effect. So
+#  segments can be retried after a lost response, and an interrupted transfer can be resumed
+#  from the size reported by the status command (for uploads) or from the number of bytes
+#  received (for downloads).
+
+
+STATUS = 0
+WRITE = 1
+READ = 2
+
+END_FLAG = 0x01
+
+STATUS_COMMAND = struct.Struct('>2sBB')
+WRITE_COMMAND = struct.Struct('>2sBBI')
+READ_COMMAND = struct.Struct('>2sBBIH')
+SIZE_RESPONSE = struct.Struct('>2sBI')
+READ_RESPONSE = struct.Struct('>2sBB')
+
+SIGNATURE = b'CT'
+
+# The get_device_info response's max_command_size and max_response_size (see
+#  crow.admin.CrowAdmin.parse_get_device_info).
+_DEVICE_LIMITS = struct.Struct('>HH')
+
+
+class TransferResult:
+
+    # The outcome of Host.upload or Host.download.
+    #   num_bytes - the number of data bytes transferred
+    #   offset - the stream offset after the last byte transferred
+    #   num_segments - the number of segments (commands) performed, not counting retries
+    #   num_retries - the number of segments that were sent again after a transient error
+    #   elapsed - the time taken, in seconds (by the serial port's clock)
+    #   data - the downloaded bytes (None for uploads, or if a sink was given)
+
+    def __init__(self, num_bytes, offset, num_segments, num_retries, elapsed, data=None):
+        self.num_bytes = num_bytes
+        self.offset = offset
+        self.num_segments = num_segments
+        self.num_retries = num_retries
+        self.elapsed = elapsed
+        self.data = data
+
+    def __repr__(self):
+        return "<{0} instance at {1:#x}, num_bytes={2}, num_segments={3}, elapsed={4:.6f}, throughput={5:.1f}>".format(self.__class__.__name__, id(self), self.num_bytes, self.num_segments, self.elapsed, self.throughput)
+
+    @property
+    def throughput(self):
+        """The effective data rate, in bytes per second."""
+        if self.elapsed <= 0:
+            return 0.0
+        return self.num_bytes/self.elapsed
+
+
+def pack_status(stream):
+    return STATUS_COMMAND.pack(SIGNATURE, STATUS, stream)
+
+
+def pack_write(buff, stream, offset, data):
+    # Encodes a write command into buff (a bytearray with room for the header and data).
+    #  Returns a memoryview of the command payload.
+    size = WRITE_COMMAND.size + len(data)
+    WRITE_COMMAND.pack_into(buff, 0, SIGNATURE, WRITE, stream, offset)
+    buff[WRITE_COMMAND.size:size] = data
+    return memoryview(buff)[0:size]
+
+
+def pack_read(buff, stream, offset, length):
+    READ_COMMAND.pack_into(buff, 0, SIGNATURE, READ, stream, offset, length)
+    return memoryview(buff)[0:READ_COMMAND.size]
+
+
+def parse_size_response(response, code):
+    # Returns the size from a status or write response.
+    if len(response) != SIZE_RESPONSE.size:
+        raise RuntimeError("The transfer response has the wrong size.")
+    signature, rsp_code, size = SIZE_RESPONSE.unpack_from(response)
+    if signature != SIGNATURE or rsp_code != code:
+        raise RuntimeError("The transfer response has the wrong header.")
+    return size
+
+
+def parse_read_response(response):
+    # Returns (at_end, data), where data is a view of the response.
+    if len(response) < READ_RESPONSE.size:
+        raise RuntimeError("The transfer response has the wrong size.")
+    signature, code, flags = READ_RESPONSE.unpack_from(response)
+    if signature != SIGNATURE or code != READ:
+        raise RuntimeError("The transfer response has the wrong header.")
+    return bool(flags & END_FLAG), memoryview(response)[READ_RESPONSE.size:]
+
+
+def parse_device_limits(response):
+    # Returns (max_command_size, max_response_size) from a get_device_info response.
+    if len(response) < 9 or response[0] != 0x43 or response[1] != 0x41 or response[2] != 0x01:
+        raise RuntimeError("Invalid get_device_info response.")
+    return _DEVICE_LIMITS.unpack_from(response, 5)
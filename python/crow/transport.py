@@ -0,0 +1,381 @@
+# transport.py
+# Crow Transports
+# project: https://pypi.org/project/crow-serial/
+# source: https://github.com/chris-siedell/PyCrow
+# homepage: http://siedell.com/projects/Crow/
+
+
+import collections
+import select
+import socket
+import threading
+import time
+import serial
+
+try:
+    # used for TcpTransport.in_waiting (POSIX only)
+    import fcntl
+    import termios
+except ImportError:
+    fcntl = None
+
+
+# A transport is the object a HostSerialPort (or a crow.device.SerialDevice) uses to reach
+#  the line. It has the parts of the serial.Serial interface used by the host: the port,
+#  baudrate, stopbits, and timeout attributes, and the read, write, reset_input_buffer,
+#  open, and close methods. A transport may also provide fileno (for AsyncHost), in_waiting
+#  (for SerialDevice), and clock and sleep functions (see HostSerialPort).
+#
+# open_transport picks the transport for a serial port name:
+#   - a factory registered for the exact name with register_factory (e.g. by the simulator)
+#   - a factory registered for the name's scheme with register_scheme, including:
+#       tcp://<host>:<port> - a raw TCP connection to a serial device server (TcpTransport)
+#       mem://<name> - an in-process line (MemoryTransport)
+#   - pyserial's serial_for_url for other URLs (e.g. rfc2217://<host>:<port>, socket://, loop://)
+#   - serial.Serial for plain device names (e.g. /dev/ttyUSB0, COM3)
+
+
+_factories = {}
+_schemes = {}
+
+
+def register_factory(name, factory):
+    """Makes open_transport(name) return factory(name)."""
+    _factories[name] = factory
+
+
+def unregister_factory(name):
+    _factories.pop(name, None)
+
+
+def register_scheme(scheme, factory):
+    """Makes open_transport return factory(name) for names of the form '<scheme>://...'."""
+    _schemes[scheme] = factory
+
+
+def open_transport(name):
+    """Returns an open transport for the serial port name."""
+    factory = _factories.get(name)
+    if factory is not None:
+        return factory(name)
+    scheme, sep, rest = name.partition('://')
+    if sep != '':
+        factory = _schemes.get(scheme)
+        if factory is not None:
+            return factory(name)
+        return serial.serial_for_url(name)
+    return serial.Serial(name)
+
+
+def _port_not_open():
+    return serial.SerialException("Attempting to use a port that is not open")
+
+
+class TcpConnectionPool:
+
+    # A TcpConnectionPool keeps idle TCP connections for reuse, so that closing and reopening
+    #  a TcpTransport (e.g. when the last Host using a serial port goes away and another is
+    #  created) does not require a new connection. Connections idle for more than
+    #  idle_timeout seconds are closed.
+
+    def __init__(self, idle_timeout=60.0):
+        self.idle_timeout = idle_timeout
+        self._lock = threading.Lock()
+        # (host, port) -> deque of (socket, time released)
+        self._idle = {}
+
+    def acquire(self, host, port, connect_timeout=5.0):
+        """Returns a connected, non-blocking socket with TCP_NODELAY set."""
+        key = (host, port)
+        now = time.monotonic()
+        while True:
+            with self._lock:
+                idle = self._idle.get(key)
+                if not idle:
+                    break
+                sock, released = idle.pop()
+            if now - released <= self.idle_timeout and TcpConnectionPool._is_alive(sock):
+                return sock
+            sock.close()
+        sock = socket.create_connection(key, connect_timeout)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        sock.setblocking(False)
+        return sock
+
+    def release(self, host, port, sock):
+        """Returns a healthy connection to the pool."""
+        now = time.monotonic()
+        expired = []
+        with self._lock:
+            idle = self._idle.setdefault((host, port), collections.deque())
+            idle.append((sock, now))
+            for key, connections in self._idle.items():
+                while len(connections) > 0 and now - connections[0][1] > self.idle_timeout:
+                    expired.append(connections.popleft()[0])
+        for s in expired:
+            s.close()
+
+    def close_all(self):
+        with self._lock:
+            idle = self._idle
+            self._idle = {}
+        for connections in idle.values():
+            for sock, released in connections:
+                sock.close()
+
+    @staticmethod
+    def _is_alive(sock):
+        # An idle connection should have nothing to read. If it is readable the peer has
+        #  closed it (or sent stale data, which makes it unsuitable anyway).
+        try:
+            readable, _, _ = select.select([sock], [], [], 0)
+        except (OSError, ValueError):
+            return False
+        return len(readable) == 0
+
+
+tcp_pool = TcpConnectionPool()
+
+
+class TcpTransport:
+
+    # TcpTransport sends the line's bytes over a raw TCP connection, as used by serial
+    #  device servers (ser2net in raw mode, etc.). The connection comes from a
+    #  TcpConnectionPool, and is returned to it when the transport is closed.
+    # The serial settings (baudrate, stopbits) are configured on the server, not through the
+    #  connection, so the attributes are only used for timing. Use an rfc2217:// name for
+    #  servers that allow the host to set the baudrate.
+    # If the connection has been lost it is reestablished before the next write.
+
+    def __init__(self, name, host, port, pool=None, connect_timeout=5.0):
+        self.port = name
+        self.baudrate = 115200
+        self.bytesize = serial.EIGHTBITS
+        self.parity = serial.PARITY_NONE
+        self.stopbits = serial.STOPBITS_ONE
+        self.timeout = None
+        self.write_timeout = None
+        self.is_open = False
+        self.address = (host, port)
+        self.connect_timeout = connect_timeout
+        self._pool = pool if pool is not None else tcp_pool
+        self._sock = None
+        self.open()
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:
+            pass
+
+    def open(self):
+        if self.is_open:
+            return
+        self._sock = self._pool.acquire(self.address[0], self.address[1], self.connect_timeout)
+        self.is_open = True
+
+    def close(self):
+        if not self.is_open:
+            return
+        self.is_open = False
+        sock = self._sock
+        self._sock = None
+        if sock is not None:
+            self._pool.release(self.address[0], self.address[1], sock)
+
+    def fileno(self):
+        if self._sock is None:
+            raise _port_not_open()
+        return self._sock.fileno()
+
+    @property
+    def in_waiting(self):
+        if self._sock is None or fcntl is None:
+            return 0
+        buff = bytearray(4)
+        fcntl.ioctl(self._sock.fileno(), termios.FIONREAD, buff)
+        return int.from_bytes(buff, 'little')
+
+    def reset_input_buffer(self):
+        sock = self._check_open()
+        try:
+            while True:
+                if len(sock.recv(4096)) == 0:
+                    self._connection_lost()
+                    return
+        except BlockingIOError:
+            pass
+        except OSError:
+            self._connection_lost()
+
+    def write(self, data):
+        if not self.is_open:
+            raise _port_not_open()
+        if self._sock is None:
+            # reconnect after a lost connection
+            self._sock = self._pool.acquire(self.address[0], self.address[1], self.connect_timeout)
+        view = memoryview(data)
+        total = len(view)
+        deadline = None if self.write_timeout is None else time.monotonic() + self.write_timeout
+        try:
+            while len(view) > 0:
+                try:
+                    num = self._sock.send(view)
+                    view = view[num:]
+                except BlockingIOError:
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    if remaining is not None and remaining <= 0:
+                        raise serial.SerialTimeoutException("Write timeout")
+                    select.select([], [self._sock], [], remaining)
+        except (BrokenPipeError, ConnectionResetError) as e:
+            self._connection_lost()
+            raise serial.SerialException("The connection to {0}:{1} was lost.".format(*self.address)) from e
+        return total
+
+    def read(self, size=1):
+        sock = self._check_open()
+        result = bytearray()
+        deadline = None if self.timeout is None else time.monotonic() + self.timeout
+        while len(result) < size:
+            try:
+                data = sock.recv(size - len(result))
+            except BlockingIOError:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    break
+                readable, _, _ = select.select([sock], [], [], remaining)
+                if len(readable) == 0:
+                    break
+                continue
+            except OSError as e:
+                self._connection_lost()
+                raise serial.SerialException("The connection to {0}:{1} was lost.".format(*self.address)) from e
+            if len(data) == 0:
+                self._connection_lost()
+                raise serial.SerialException("The connection to {0}:{1} was closed by the server.".format(*self.address))
+            result += data
+        return bytes(result)
+
+    def _check_open(self):
+        if not self.is_open:
+            raise _port_not_open()
+        if self._sock is None:
+            self._sock = self._pool.acquire(self.address[0], self.address[1], self.connect_timeout)
+        return self._sock
+
+    def _connection_lost(self):
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+
+
+def _open_tcp(name):
+    # tcp://<host>:<port>
+    address = name.partition('://')[2].rstrip('/')
+    host, sep, port = address.rpartition(':')
+    if sep == '' or host == '':
+        raise ValueError("TCP transport names must have the form tcp://<host>:<port>.")
+    return TcpTransport(name, host.strip('[]'), int(port))
+
+
+class MemoryLine:
+
+    # A MemoryLine is an in-process line with two ends, each a MemoryTransport. Bytes written
+    #  to one end are read from the other. It is useful for running a host and a device
+    #  (crow.device.SerialDevice) in one process, e.g. in different threads.
+    # The name 'mem://<name>' opens the host end of the line with that name (which is
+    #  created if needed), and 'mem://<name>/device' opens the device end.
+
+    def __init__(self, name):
+        self.name = name
+        self._cond = threading.Condition()
+        self.host_end = MemoryTransport(self, 0, 'mem://' + name)
+        self.device_end = MemoryTransport(self, 1, 'mem://' + name + '/device')
+
+
+_memory_lines = {}
+_memory_lines_lock = threading.Lock()
+
+
+def memory_line(name):
+    """Returns the MemoryLine with the given name, creating it if needed."""
+    with _memory_lines_lock:
+        line = _memory_lines.get(name)
+        if line is None:
+            line = MemoryLine(name)
+            _memory_lines[name] = line
+        return line
+
+
+def remove_memory_line(name):
+    with _memory_lines_lock:
+        _memory_lines.pop(name, None)
+
+
+class MemoryTransport:
+
+    # One end of a MemoryLine. See MemoryLine.
+
+    def __init__(self, line, end, name):
+        self.port = name
+        self.baudrate = 115200
+        self.bytesize = serial.EIGHTBITS
+        self.parity = serial.PARITY_NONE
+        self.stopbits = serial.STOPBITS_ONE
+        self.timeout = None
+        self.write_timeout = None
+        self.is_open = True
+        self._line = line
+        self._end = end
+        self._rx = bytearray()
+
+    def open(self):
+        self.is_open = True
+
+    def close(self):
+        self.is_open = False
+
+    @property
+    def in_waiting(self):
+        return len(self._rx)
+
+    def reset_input_buffer(self):
+        with self._line._cond:
+            self._rx.clear()
+
+    def write(self, data):
+        if not self.is_open:
+            raise _port_not_open()
+        line = self._line
+        peer = line.device_end if self._end == 0 else line.host_end
+        with line._cond:
+            peer._rx += data
+            line._cond.notify_all()
+        return len(data)
+
+    def read(self, size=1):
+        if not self.is_open:
+            raise _port_not_open()
+        cond = self._line._cond
+        rx = self._rx
+        with cond:
+            if self.timeout is None:
+                cond.wait_for(lambda: len(rx) >= size)
+            else:
+                cond.wait_for(lambda: len(rx) >= size, self.timeout)
+            data = bytes(rx[0:size])
+            del rx[0:size]
+        return data
+
+
+def _open_memory(name):
+    # mem://<name> or mem://<name>/device
+    path = name.partition('://')[2]
+    if path.endswith('/device'):
+        return memory_line(path[:-len('/device')]).device_end
+    return memory_line(path).host_end
+
+
+register_scheme('tcp', _open_tcp)
+register_scheme('mem', _open_memory)
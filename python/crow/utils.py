@@ -6,6 +6,8 @@
 
 # todo: revisit the errors raised by unpack functions
 
+import array
+
 def unpack_int(info, transaction, num_bytes, prop_name, rsp_name, byteorder='big', signed=False):
     # Will raise RuntimeError if the value can not be extracted.
     # This function helps extract an integer from a response payload that was packed using the method
@@ -60,29 +62,127 @@ def unpack_ascii(info, transaction, num_arg_bytes, prop_name, rsp_name):
     info[prop_name] = rsp[offset:offset+length].decode(encoding='ascii', errors='replace')
 
 
+def fletcher16_sums(data):
+    # Returns the Fletcher-16 sums (upper, lower) of data, each reduced modulo 0xff.
+    # data may be any bytes-like object (or sequence of ints 0-255) of any length.
+    # Rather than looping over the bytes in Python, this function relies on the fact that
+    #  256 = 1 (mod 0xff). If P is the polynomial with coefficients data (big-endian), then
+    #  int.from_bytes(data) is P(256), and reducing P(256) modulo 0xff**2 gives
+    #  P(1) + 0xff*P'(1), where P(1) is the lower sum and P(1) + P'(1) is the upper sum.
+    #  So the only per-byte work is done by int.from_bytes and sum, which run in C.
+    lower = sum(data)
+    r = int.from_bytes(data, 'big') % 0xfe01
+    upper = ((r - lower) % 0xfe01) // 0xff + lower
+    return upper % 0xff, lower % 0xff
+
+
 def fletcher16(data):
     # Adapted from PropCRInternal.cpp (2 April 2018).
-    # Overflow not a problem if called on short chunks of data (128 bytes is fine).
-    lower = 0
-    upper = 0
-    for d in data:
-        lower += d
-        upper += lower
-    lower %= 0xff
-    upper %= 0xff
+    upper, lower = fletcher16_sums(data)
     return bytes([upper, lower])
 
 
 def fletcher16_checkbytes(data):
     # Adapted from PropCRInternal.cpp (2 April 2018).
-    # Overflow not a problem if called on short chunks of data (128 bytes is fine).
-    lower = 0
-    upper = 0
-    for d in data:
-        lower += d
-        upper += lower
+    upper, lower = fletcher16_sums(data)
     check0 = 0xff - ((lower + upper) % 0xff)
     check1 = 0xff - ((lower + check0) % 0xff)
     return bytes([check0, check1])
 
 
+def fletcher16_chunks(payload):
+    # Returns a bytearray with the two Fletcher-16 sums (upper, lower) of every 128 byte
+    #  chunk of payload (the last chunk may be shorter). This is the checksum format used
+    #  in the body of a response packet. An empty payload gives an empty bytearray.
+    uppers, lowers = _chunk_sums(payload)
+    result = bytearray(2*len(uppers))
+    result[0::2] = uppers
+    result[1::2] = lowers
+    return result
+
+
+def fletcher16_checkbytes_chunks(payload):
+    # Returns a bytearray with the two Fletcher-16 check bytes of every 128 byte chunk
+    #  of payload (the last chunk may be shorter). This is the checksum format used in the
+    #  body of a command packet. An empty payload gives an empty bytearray.
+    uppers, lowers = _chunk_sums(payload)
+    result = bytearray(2*len(uppers))
+    for i in range(len(uppers)):
+        lower = lowers[i]
+        check0 = 0xff - ((lower + uppers[i]) % 0xff)
+        result[2*i] = check0
+        result[2*i+1] = 0xff - ((lower + check0) % 0xff)
+    return result
+
+
+# NumPy is optional. If it is installed it is used to compute the sums of all chunks of
+#  a large payload in one batch. For a single short chunk fletcher16_sums is faster.
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+if numpy is not None:
+    _F16_WEIGHTS = numpy.arange(128, 0, -1, dtype=numpy.int64)
+
+
+def _chunk_sums(payload):
+    # Returns two lists, the upper and lower Fletcher-16 sums (modulo 0xff) of every
+    #  128 byte chunk of payload.
+    if isinstance(payload, memoryview):
+        payload = payload.cast('B')
+    size = len(payload)
+    if numpy is not None and size > 128:
+        try:
+            a = numpy.frombuffer(payload, dtype=numpy.uint8)
+        except (TypeError, ValueError):
+            a = numpy.frombuffer(bytes(payload), dtype=numpy.uint8)
+        full_size = (size//128)*128
+        m = a[0:full_size].reshape(-1, 128)
+        uppers = (m @ _F16_WEIGHTS) % 0xff
+        lowers = m.sum(axis=1, dtype=numpy.int64) % 0xff
+        uppers = uppers.tolist()
+        lowers = lowers.tolist()
+        if full_size < size:
+            t = a[full_size:]
+            uppers.append(int(t @ _F16_WEIGHTS[128-len(t):]) % 0xff)
+            lowers.append(int(t.sum(dtype=numpy.int64)) % 0xff)
+        return uppers, lowers
+    uppers = []
+    lowers = []
+    for i in range(0, size, 128):
+        upper, lower = fletcher16_sums(payload[i:i+128])
+        uppers.append(upper)
+        lowers.append(lower)
+    return uppers, lowers
+
+
+
+# The array typecode for 4 byte unsigned integers (used by reverse_propcr_order).
+_U32_TYPECODE = next((c for c in 'IL' if array.array(c).itemsize == 4), None)
+
+
+def reverse_propcr_order(payload, out=None):
+    # Applies (or undoes, since it is its own inverse) the PropCR payload byte ordering, in
+    #  which every group of up to four bytes is reversed. payload may be any bytes-like
+    #  object (a memoryview must have format 'B'). The result is written to out (a writable
+    #  bytes-like object at least as large as payload), or to a new bytearray if out is
+    #  None, and a memoryview of the result is returned.
+    # The full groups are reversed in one pass by byteswapping them as 32-bit integers.
+    size = len(payload)
+    if out is None:
+        out = bytearray(size)
+    out = memoryview(out)[0:size]
+    full = size - size%4
+    if _U32_TYPECODE is not None:
+        words = array.array(_U32_TYPECODE)
+        words.frombytes(payload[0:full])
+        words.byteswap()
+        out[0:full] = memoryview(words).cast('B')
+    else:
+        for k in range(4):
+            # byte k of each full group comes from byte 3-k of the group
+            out[k:full:4] = payload[3-k:full:4]
+    if full < size:
+        out[full:size] = bytes(payload[full:size])[::-1]
+    return out
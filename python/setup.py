@@ -71,6 +71,10 @@ setup(
         },
     packages=find_packages(),
     install_requires=['pyserial'],
+    extras_require={'numpy': ['numpy']},
+    entry_points={
+        'console_scripts': ['crow=crow.cli:main'],
+        },
     python_requires='>=3',
 )
 